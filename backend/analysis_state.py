@@ -0,0 +1,138 @@
+import asyncio
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from content_planner import plan_posts
+from image_cache import post_cache_key
+
+# How many analyzed post keys to remember per username
+MAX_REMEMBERED_POSTS = 100
+
+class AnalysisStateStore:
+    """
+    Remembers, per username, which posts have already been analyzed and the
+    profile summary they produced, so a refresh only has to send new posts.
+    """
+
+    def __init__(self, path: str = "cache/analysis_state.sqlite3"):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS analysis_state (
+                username TEXT PRIMARY KEY,
+                post_keys TEXT NOT NULL,
+                analysis TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+
+    def get(self, username: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the stored state for a username.
+
+        Args:
+            username: Instagram username
+
+        Returns:
+            Dictionary with post_keys, analysis and updated_at, or None
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT post_keys, analysis, updated_at FROM analysis_state WHERE username = ?",
+                (username.lower(),),
+            ).fetchone()
+        if row is None:
+            return None
+        return {"post_keys": json.loads(row[0]), "analysis": row[1], "updated_at": row[2]}
+
+    def put(self, username: str, post_keys: List[str], analysis: str) -> None:
+        """
+        Store the analyzed post keys (most recent first) and the profile summary.
+
+        Args:
+            username: Instagram username
+            post_keys: Keys of every post reflected in the analysis
+            analysis: Profile summary text
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO analysis_state (username, post_keys, analysis, updated_at) VALUES (?, ?, ?, ?)",
+                (username.lower(), json.dumps(post_keys[:MAX_REMEMBERED_POSTS]), analysis, time.time()),
+            )
+
+    async def aget(self, username: str) -> Optional[Dict[str, Any]]:
+        """
+        Async variant of get; the query runs in a worker thread.
+        """
+        return await asyncio.to_thread(self.get, username)
+
+    async def aput(self, username: str, post_keys: List[str], analysis: str) -> None:
+        """
+        Async variant of put; the write runs in a worker thread.
+        """
+        await asyncio.to_thread(self.put, username, post_keys, analysis)
+
+def load_state_from_outputs(username: str, output_dir: str = "outputs") -> Optional[Dict[str, Any]]:
+    """
+    Rebuild analysis state from the newest timestamped full-service outputs
+    for a username, so accounts analyzed before incremental mode existed
+    don't start from scratch.
+
+    Args:
+        username: Instagram username
+        output_dir: Directory the full service writes its files to
+
+    Returns:
+        State dictionary like AnalysisStateStore.get, or None if no usable
+        outputs exist or the username contains a path separator
+    """
+    # Usernames come from requests; keep them to a file name prefix in output_dir
+    if not username or username in (".", "..") or "/" in username or "\\" in username:
+        return None
+    pattern = os.path.join(glob.escape(output_dir), glob.escape(username) + "_analysis_*.json")
+    for analysis_file in sorted(glob.glob(pattern), reverse=True):
+        timestamp = analysis_file[len(os.path.join(output_dir, f"{username}_analysis_")):-len(".json")]
+        data_file = os.path.join(output_dir, f"{username}_instagram_data_{timestamp}.json")
+        try:
+            with open(analysis_file, "r") as f:
+                analysis = json.load(f).get("analysis")
+            with open(data_file, "r") as f:
+                posts = json.load(f).get("data", [])
+        except (OSError, ValueError):
+            continue
+        if not analysis or analysis.startswith("Error"):
+            continue
+        # Exports don't record which posts were sent; assume the planner's default choice
+        post_keys = [key for key in (post_cache_key(post) for post in plan_posts(posts)["posts"]) if key]
+        if post_keys:
+            return {"post_keys": post_keys, "analysis": analysis, "updated_at": os.path.getmtime(analysis_file)}
+    return None
+
+_state_store: Optional[AnalysisStateStore] = None
+
+def get_analysis_state_store() -> AnalysisStateStore:
+    """
+    Return the process-wide analysis state store.
+
+    Environment variables:
+        ANALYSIS_STATE_PATH: SQLite database file
+
+    Returns:
+        Shared AnalysisStateStore instance
+    """
+    global _state_store
+    if _state_store is None:
+        _state_store = AnalysisStateStore(os.getenv("ANALYSIS_STATE_PATH", "cache/analysis_state.sqlite3"))
+    return _state_store
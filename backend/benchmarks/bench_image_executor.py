@@ -0,0 +1,110 @@
+"""
+Measure image preprocessing throughput with prepare_image run in threads
+(the old path) and in the image worker process pool at increasing worker
+counts, together with how long the event loop stalls meanwhile.
+
+Thread-based preprocessing holds the GIL, so it neither scales with cores
+nor lets the event loop run; the process pool should do both.
+
+Run from the backend directory:
+    python benchmarks/bench_image_executor.py --images 200 --concurrency 16
+    python benchmarks/bench_image_executor.py --workers 0,1,2,4,8
+"""
+import argparse
+import asyncio
+import io
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_executor import ImageExecutor
+
+def make_image(width: int, height: int, seed: int) -> bytes:
+    """
+    A JPEG about the size of an Instagram post image: noise over a gradient,
+    so it neither compresses to nothing nor decodes unrealistically fast.
+    """
+    from PIL import Image
+
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 30 + seed % 20)
+    image = Image.merge("RGB", (gradient, noise, Image.blend(gradient, noise, 0.5)))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+async def measure_loop_lag(stop: asyncio.Event, interval: float = 0.005) -> list:
+    # How late each short sleep wakes up: time the loop was blocked
+    lags = []
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, time.perf_counter() - started - interval) * 1000)
+    return lags
+
+async def run(executor: ImageExecutor, images: list, count: int, concurrency: int) -> dict:
+    await executor.warm_up()
+    # One untimed image per worker so imports and first-use costs are paid
+    await asyncio.gather(*[executor.prepare(images[i % len(images)]) for i in range(max(executor.workers, 1))])
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for i in range(count):
+        queue.put_nowait(images[i % len(images)])
+
+    async def worker() -> None:
+        while not queue.empty():
+            await executor.prepare(queue.get_nowait())
+
+    stop = asyncio.Event()
+    lag_task = asyncio.ensure_future(measure_loop_lag(stop))
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    stop.set()
+    lags = sorted(await lag_task)
+    return {
+        "images_per_second": count / elapsed,
+        "lag_p50_ms": statistics.median(lags) if lags else 0.0,
+        "lag_p99_ms": lags[min(len(lags) - 1, int(len(lags) * 0.99))] if lags else 0.0,
+        "lag_max_ms": lags[-1] if lags else 0.0,
+    }
+
+def main():
+    cores = os.cpu_count() or 1
+    default_workers = sorted({0, 1, cores} | {w for w in (2, 4) if w <= cores})
+    parser = argparse.ArgumentParser(description="Benchmark image preprocessing in threads vs. worker processes")
+    parser.add_argument("--images", type=int, default=120, help="Images prepared per configuration")
+    parser.add_argument("--concurrency", type=int, default=16, help="Images requested at once")
+    parser.add_argument("--width", type=int, default=1080, help="Source image width")
+    parser.add_argument("--height", type=int, default=1350, help="Source image height")
+    parser.add_argument(
+        "--workers",
+        default=",".join(str(w) for w in default_workers),
+        help="Comma-separated worker counts to try; 0 prepares images in threads",
+    )
+    args = parser.parse_args()
+
+    images = [make_image(args.width, args.height, seed) for seed in range(8)]
+    mean_kib = sum(len(image) for image in images) / len(images) / 1024
+    print(f"{cores} CPU(s); {args.images} images of {args.width}x{args.height} (~{mean_kib:.0f} KiB), {args.concurrency} at once\n")
+    print(f"{'executor':<14}{'images/s':>10}{'speedup':>9}{'loop lag p50':>14}{'p99':>9}{'max':>9}")
+
+    baseline = None
+    for workers in [int(w) for w in args.workers.split(",")]:
+        executor = ImageExecutor(workers=workers, max_pending=max(args.concurrency, 1), inline_max_bytes=0)
+        try:
+            result = asyncio.run(run(executor, images, args.images, args.concurrency))
+        finally:
+            executor.shutdown()
+        baseline = baseline or result["images_per_second"]
+        label = "threads" if workers == 0 else f"{workers} process{'es' if workers > 1 else ''}"
+        print(
+            f"{label:<14}{result['images_per_second']:>10.1f}{result['images_per_second'] / baseline:>8.2f}x"
+            f"{result['lag_p50_ms']:>12.1f}ms{result['lag_p99_ms']:>7.1f}ms{result['lag_max_ms']:>7.1f}ms"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+"""
+Offline load and latency benchmark of the real app.
+
+Starts local stand-ins for Apify, the image CDN and Gemini (see fakes.py),
+runs the app under uvicorn pointed at them with empty caches, then drives
+each route in turn at a fixed concurrency. Reports p50/p95/p99 latency,
+throughput, error rate, the app's peak RSS and the mean time per pipeline
+stage (from the Server-Timing header) for every route.
+
+Run from the backend directory:
+    python benchmarks/bench_load.py --concurrency 8 --requests 32
+    python benchmarks/bench_load.py --save-baseline
+    python benchmarks/bench_load.py --compare
+
+--compare exits with status 1 when a route's p95 latency or throughput is
+worse than the stored baseline by more than --tolerance. Baselines are only
+comparable when taken with the same settings on the same machine.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeBehavior, FakeServices
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(BACKEND_DIR, "benchmarks", "baselines", "bench_load.json")
+
+# Route name -> (method, path, JSON body). {username} is filled per request;
+# each route gets its own usernames so it starts from cold caches.
+ROUTES = {
+    "health": ("GET", "/health", None),
+    "profile": ("GET", "/instagram/{username}", None),
+    "analysis": ("GET", "/instagram/{username}/analysis", None),
+    "recommendations": ("GET", "/instagram/{username}/restaurant-recommendations", None),
+    "full_service": ("GET", "/instagram/{username}/full-service", None),
+    "full_service_stream": ("GET", "/instagram/{username}/full-service/stream", None),
+    "batch": ("POST", "/batch/full-service", {"usernames": ["{username}a", "{username}b", "{username}c"]}),
+    # Reads what the full_service run stored
+    "results": ("GET", "/results/{username}", None),
+    "cache_stats": ("GET", "/cache/stats", None),
+    "metrics": ("GET", "/metrics", None),
+}
+# Routes that read another route's users instead of their own
+_USERNAME_SOURCE = {"results": "full_service"}
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """
+    Nearest-rank percentile of a list of values.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+def parse_server_timing(header: str) -> Dict[str, float]:
+    """
+    Parse a Server-Timing header into milliseconds per metric name.
+    """
+    timings = {}
+    for entry in header.split(","):
+        name, *params = [part.strip() for part in entry.split(";")]
+        for param in params:
+            if param.startswith("dur="):
+                timings[name] = timings.get(name, 0.0) + float(param[4:])
+    return timings
+
+class RssSampler:
+    """
+    Samples a process's resident set size from /proc in a background thread,
+    keeping the peak since the last reset. Reports None where /proc isn't available.
+    """
+
+    def __init__(self, pid: int, interval: float = 0.05):
+        self.path = f"/proc/{pid}/status"
+        self.interval = interval
+        self.peak_kib: Optional[int] = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def _read(self, field: str) -> Optional[int]:
+        try:
+            with open(self.path, "r") as f:
+                for line in f:
+                    if line.startswith(field + ":"):
+                        return int(line.split()[1])
+        except OSError:
+            return None
+        return None
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            rss = self._read("VmRSS")
+            if rss is not None and (self.peak_kib is None or rss > self.peak_kib):
+                self.peak_kib = rss
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def reset(self) -> None:
+        self.peak_kib = self._read("VmRSS")
+
+    def high_water_mark_kib(self) -> Optional[int]:
+        return self._read("VmHWM")
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_app(env: Dict[str, str], port: int) -> subprocess.Popen:
+    """
+    Run the app under uvicorn and wait until /health answers.
+    """
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App exited during startup with status {process.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/health", timeout=1).status_code == 200:
+                return process
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("App did not become ready within 60 seconds")
+
+def _fill(value: Any, username: str) -> Any:
+    if isinstance(value, str):
+        return value.replace("{username}", username)
+    if isinstance(value, list):
+        return [_fill(item, username) for item in value]
+    if isinstance(value, dict):
+        return {key: _fill(item, username) for key, item in value.items()}
+    return value
+
+async def run_route(client: httpx.AsyncClient, route: str, requests: int, concurrency: int, users: int) -> Dict[str, Any]:
+    """
+    Send requests to one route from concurrency workers and collect per-request results.
+    """
+    method, path, body = ROUTES[route]
+    prefix = _USERNAME_SOURCE.get(route, route).replace("_", "")
+    samples: List[Dict[str, Any]] = []
+    next_index = iter(range(requests))
+
+    async def worker() -> None:
+        for i in next_index:
+            username = f"bench{prefix}{i % users}"
+            url = _fill(path, username)
+            started = time.perf_counter()
+            try:
+                async with client.stream(method, url, json=_fill(body, username)) as response:
+                    await response.aread()
+                status = response.status_code
+                timing = parse_server_timing(response.headers.get("server-timing", ""))
+            except httpx.HTTPError as e:
+                status, timing = 0, {}
+                print(f"  {route}: {type(e).__name__}: {e}")
+            samples.append({"latency": time.perf_counter() - started, "status": status, "timing": timing})
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+
+    latencies_ms = [sample["latency"] * 1000 for sample in samples]
+    errors = sum(1 for sample in samples if not 200 <= sample["status"] < 400)
+    stages: Dict[str, float] = {}
+    for sample in samples:
+        for name, duration in sample["timing"].items():
+            if name != "total":
+                stages[name] = stages.get(name, 0.0) + duration
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "p50_ms": round(percentile(latencies_ms, 50), 1),
+        "p95_ms": round(percentile(latencies_ms, 95), 1),
+        "p99_ms": round(percentile(latencies_ms, 99), 1),
+        "max_ms": round(max(latencies_ms), 1),
+        "throughput_rps": round(len(samples) / elapsed, 2),
+        "stages_ms": {name: round(total / len(samples), 1) for name, total in sorted(stages.items())},
+    }
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """
+    List the routes whose p95 latency, throughput or error rate regressed
+    against the baseline by more than tolerance (a fraction).
+    """
+    regressions = []
+    for route, current in results["routes"].items():
+        base = baseline.get("routes", {}).get(route)
+        if base is None:
+            continue
+        if current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{route}: p95 {base['p95_ms']:.1f} -> {current['p95_ms']:.1f} ms")
+        if current["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{route}: throughput {base['throughput_rps']:.2f} -> {current['throughput_rps']:.2f} req/s")
+        if current["error_rate"] > base["error_rate"] + 0.01:
+            regressions.append(f"{route}: error rate {base['error_rate']:.2%} -> {current['error_rate']:.2%}")
+    return regressions
+
+def print_results(results: Dict[str, Any]) -> None:
+    print(f"\n{'route':<22}{'req':>5}{'err':>5}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>9}{'peak MiB':>10}")
+    for route, result in results["routes"].items():
+        peak = f"{result['peak_rss_mib']:.0f}" if result["peak_rss_mib"] is not None else "n/a"
+        print(
+            f"{route:<22}{result['requests']:>5}{result['errors']:>5}{result['p50_ms']:>10.1f}"
+            f"{result['p95_ms']:>10.1f}{result['p99_ms']:>10.1f}{result['throughput_rps']:>9.2f}{peak:>10}"
+        )
+    print("\nMean stage time per request (ms):")
+    for route, result in results["routes"].items():
+        if result["stages_ms"]:
+            print(f"  {route:<20} " + ", ".join(f"{name} {ms:.0f}" for name, ms in result["stages_ms"].items()))
+    print(f"\nApp peak RSS: {results['app_peak_rss_mib']} MiB; stand-ins: {results['fakes']}")
+
+async def drive(base_url: str, args: argparse.Namespace, sampler: RssSampler) -> Dict[str, Any]:
+    routes = {}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        for route in args.routes:
+            print(f"Running {route}: {args.requests} requests at concurrency {args.concurrency}")
+            sampler.reset()
+            result = await run_route(client, route, args.requests, args.concurrency, args.users or args.requests)
+            result["peak_rss_mib"] = round(sampler.peak_kib / 1024, 1) if sampler.peak_kib is not None else None
+            routes[route] = result
+    return routes
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the app against local Apify, CDN and Gemini stand-ins")
+    parser.add_argument("--routes", default=",".join(ROUTES), help=f"Comma-separated routes to drive, from: {', '.join(ROUTES)}")
+    parser.add_argument("--requests", type=int, default=32, help="Requests per route")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight at once")
+    parser.add_argument("--users", type=int, default=0, help="Distinct usernames per route (default: one per request, so every request is a cache miss)")
+    parser.add_argument("--timeout", type=float, default=300, help="Per-request timeout in seconds")
+    parser.add_argument("--apify-latency", type=float, default=1.0, help="Seconds an Apify actor run takes")
+    parser.add_argument("--cdn-latency", type=float, default=0.05, help="Seconds per image download")
+    parser.add_argument("--gemini-latency", type=float, default=1.5, help="Seconds per Gemini call")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Latency varies by up to +/- this fraction")
+    parser.add_argument("--apify-failure-rate", type=float, default=0.0, help="Share of Apify API calls that fail with 500")
+    parser.add_argument("--cdn-failure-rate", type=float, default=0.0, help="Share of image downloads that fail with 503")
+    parser.add_argument("--gemini-failure-rate", type=float, default=0.0, help="Share of Gemini calls that fail with UNAVAILABLE")
+    parser.add_argument("--posts", type=int, default=8, help="Posts per Apify run")
+    parser.add_argument("--apify-poll-interval", type=float, default=0.25, help="APIFY_POLL_INTERVAL for the app")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="Extra environment for the app, e.g. JOB_WORKERS=16")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--save-baseline", nargs="?", const=DEFAULT_BASELINE, help="Store the results as the baseline")
+    parser.add_argument("--compare", nargs="?", const=DEFAULT_BASELINE, help="Compare with a stored baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed regression against the baseline, as a fraction")
+    args = parser.parse_args()
+    args.routes = [route.strip() for route in args.routes.split(",") if route.strip()]
+    unknown = [route for route in args.routes if route not in ROUTES]
+    if unknown:
+        parser.error(f"unknown routes: {', '.join(unknown)}")
+
+    settings = {
+        key: value for key, value in vars(args).items()
+        if key not in ("output", "save_baseline", "compare", "tolerance", "timeout")
+    }
+    fakes = FakeServices(
+        apify=FakeBehavior(args.apify_latency, args.jitter, args.apify_failure_rate),
+        cdn=FakeBehavior(args.cdn_latency, args.jitter, args.cdn_failure_rate),
+        gemini=FakeBehavior(args.gemini_latency, args.jitter, args.gemini_failure_rate),
+        posts_per_run=args.posts,
+        sample_file=os.path.join(BACKEND_DIR, "ig_test_data.json"),
+    )
+    with fakes, tempfile.TemporaryDirectory(prefix="bench-load-") as state_dir:
+        env = {
+            **os.environ,
+            **fakes.app_env(),
+            # Fresh caches and stores, so runs don't warm each other up
+            "LLM_CACHE_PATH": os.path.join(state_dir, "llm_cache.sqlite3"),
+            "IMAGE_CACHE_DIR": os.path.join(state_dir, "images"),
+            "ANALYSIS_STATE_PATH": os.path.join(state_dir, "analysis_state.sqlite3"),
+            "JOB_QUEUE_PATH": os.path.join(state_dir, "jobs.sqlite3"),
+            "RESULTS_STORE_PATH": os.path.join(state_dir, "results.sqlite3"),
+            "APIFY_POLL_INTERVAL": str(args.apify_poll_interval),
+            "ACCESS_LOG_SAMPLE_RATE": "0",
+            "ACCESS_LOG_SLOW_SECONDS": "3600",
+            "PYTHONWARNINGS": "ignore::FutureWarning",
+        }
+        env.update(dict(item.split("=", 1) for item in args.env))
+        port = _free_port()
+        app = start_app(env, port)
+        sampler = RssSampler(app.pid)
+        sampler.start()
+        try:
+            routes = asyncio.run(drive(f"http://127.0.0.1:{port}", args, sampler))
+            hwm = sampler.high_water_mark_kib()
+        finally:
+            sampler.stop()
+            app.terminate()
+            app.wait(timeout=30)
+
+    results = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "settings": settings,
+        "app_peak_rss_mib": round(hwm / 1024, 1) if hwm is not None else None,
+        "fakes": fakes.stats(),
+        "routes": routes,
+    }
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.save_baseline), exist_ok=True)
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        if baseline.get("settings") != settings:
+            print("Warning: the baseline was taken with different settings")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\nRegressions against {args.compare} (tolerance {args.tolerance:.0%}):")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\nNo regressions against {args.compare} (tolerance {args.tolerance:.0%})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Measure the per-request cost of rendering /instagram/{username} style
+payloads: FastAPI's default jsonable_encoder + json path against orjson,
+and the size/time trade-off of gzip and brotli.
+
+Run from the backend directory:
+    python benchmarks/bench_serialization.py --posts 50 --iterations 200
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+
+from posts import posts_to_dicts, project_posts
+from responses import FastJSONResponse, brotli, compress
+
+def build_payload(sample_file: str, post_count: int, slim: bool):
+    with open(sample_file, "r") as f:
+        items = json.load(f)
+    data = [dict(items[i % len(items)], id=str(i)) for i in range(post_count)]
+    if slim:
+        data = posts_to_dicts(project_posts(data))
+    return {"username": "kyliejenner", "data": data, "cache": {"status": "hit", "age_seconds": 1.0, "fetched_at": time.time()}}
+
+def measure(fn, iterations: int) -> float:
+    fn()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - started) / iterations * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark JSON rendering and response compression")
+    parser.add_argument("--sample-file", default="ig_test_data.json", help="Apify items to build payloads from")
+    parser.add_argument("--posts", type=int, default=50, help="Posts per payload")
+    parser.add_argument("--iterations", type=int, default=200, help="Renders per measurement")
+    args = parser.parse_args()
+
+    default_response = JSONResponse(None)
+    fast_response = FastJSONResponse(None)
+
+    for label, slim in (("raw Apify items", False), ("slim posts", True)):
+        payload = build_payload(args.sample_file, args.posts, slim)
+        body = fast_response.render(payload)
+        print(f"\n{label}: {args.posts} posts, {len(body) / 1024:.1f} KiB of JSON")
+        print(f"  {'path':<38}{'ms/request':>12}")
+        rows = [
+            ("jsonable_encoder + json (before)", lambda: default_response.render(jsonable_encoder(payload))),
+            ("jsonable_encoder + orjson", lambda: fast_response.render(jsonable_encoder(payload))),
+            ("orjson, encoder skipped (after)", lambda: fast_response.render(payload)),
+        ]
+        for name, fn in rows:
+            print(f"  {name:<38}{measure(fn, args.iterations):>12.3f}")
+
+        print(f"  {'encoding':<38}{'ms/request':>12}{'KiB':>10}")
+        encodings = ["gzip"] + (["br"] if brotli is not None else [])
+        for encoding in encodings:
+            elapsed = measure(lambda: compress(body, encoding), args.iterations)
+            print(f"  {encoding:<38}{elapsed:>12.3f}{len(compress(body, encoding)) / 1024:>10.1f}")
+
+if __name__ == "__main__":
+    main()
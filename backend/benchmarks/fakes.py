@@ -0,0 +1,441 @@
+"""
+Local stand-ins for the services the app depends on, for offline benchmarks:
+
+- Apify: the actor run / run status / dataset items endpoints used by
+  profile_fetcher, with the run taking a configurable time and its items
+  landing in the dataset while it runs
+- Image CDN: JPEG images for the posts' displayUrls
+- Gemini: the GenerativeService gRPC API (over TLS with a throwaway
+  certificate, since the client only opens secure channels), answering
+  analysis prompts with prose and recommendation prompts with JSON
+
+Each stand-in has a configurable latency (with jitter) and failure rate.
+Point the app at them with APIFY_API_URL, GEMINI_API_ENDPOINT and
+GRPC_DEFAULT_SSL_ROOTS_FILE_PATH (see FakeServices.app_env).
+
+Needs grpcio (installed with google-generativeai) and cryptography.
+"""
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from concurrent import futures
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+@dataclass
+class FakeBehavior:
+    """
+    Latency and failure settings of one stand-in.
+
+    latency is in seconds (for Apify, how long a run takes); each call
+    varies by up to +/- jitter of it. failure_rate is the share of calls
+    answered with a server error.
+    """
+
+    latency: float
+    jitter: float = 0.2
+    failure_rate: float = 0.0
+
+    def delay(self) -> float:
+        return max(0.0, self.latency * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def fails(self) -> bool:
+        return random.random() < self.failure_rate
+
+class _Counters:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.values: Dict[str, int] = {}
+
+    def inc(self, name: str) -> None:
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + 1
+
+def _load_template_items(sample_file: str) -> List[Dict[str, Any]]:
+    with open(sample_file, "r") as f:
+        return json.load(f)
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fakes: "FakeServices"
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+    def _send_json(self, status: int, data: Any, headers: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status: int) -> None:
+        self._send_json(status, {"error": {"type": "fake-failure", "message": "Injected failure"}})
+
+    def do_GET(self) -> None:
+        self._dispatch("GET")
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        self._body = self.rfile.read(length) if length else b""
+        if self.headers.get("Content-Encoding") == "gzip":
+            self._body = gzip.decompress(self._body)
+        self._dispatch("POST")
+
+    def _dispatch(self, method: str) -> None:
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            if parts[:1] == ["cdn"]:
+                self.fakes._serve_image(self, parts[1:])
+            elif parts[:1] == ["v2"]:
+                self.fakes._serve_apify(self, method, parts[1:], query)
+            else:
+                self._send_json(404, {"error": {"type": "not-found"}})
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up, e.g. a losing hedged request was cancelled
+            self.close_connection = True
+        except Exception as e:
+            print(f"Fake service error on {method} {self.path}: {type(e).__name__}: {e}")
+            self._send_json(500, {"error": {"type": "internal-error", "message": str(e)}})
+
+class FakeServices:
+    """
+    The Apify, CDN and Gemini stand-ins, served from background threads.
+
+    Use as a context manager, or call start() and stop().
+    """
+
+    def __init__(
+        self,
+        apify: FakeBehavior,
+        cdn: FakeBehavior,
+        gemini: FakeBehavior,
+        posts_per_run: int = 8,
+        image_size: tuple = (1080, 1350),
+        sample_file: str = "ig_test_data.json",
+    ):
+        self.apify = apify
+        self.cdn = cdn
+        self.gemini = gemini
+        self.posts_per_run = posts_per_run
+        self.counters = _Counters()
+        self._templates = _load_template_items(sample_file)
+        self._images = self._render_images(image_size)
+        self._runs: Dict[str, Dict[str, Any]] = {}
+        self._runs_lock = threading.Lock()
+        self._http: Optional[ThreadingHTTPServer] = None
+        self._grpc = None
+        self._tempdir = tempfile.TemporaryDirectory(prefix="fake-services-")
+        self.http_url = ""
+        self.gemini_endpoint = ""
+        self.ca_file = ""
+
+    # Lifecycle
+
+    def start(self) -> "FakeServices":
+        handler = type("Handler", (_Handler,), {"fakes": self})
+        self._http = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._http.daemon_threads = True
+        threading.Thread(target=self._http.serve_forever, name="fake-http", daemon=True).start()
+        self.http_url = f"http://127.0.0.1:{self._http.server_port}"
+        self._start_gemini()
+        return self
+
+    def stop(self) -> None:
+        if self._http is not None:
+            self._http.shutdown()
+            self._http.server_close()
+        if self._grpc is not None:
+            self._grpc.stop(grace=None)
+        self._tempdir.cleanup()
+
+    def __enter__(self) -> "FakeServices":
+        return self.start()
+
+    def __exit__(self, *exc: Any) -> None:
+        self.stop()
+
+    def app_env(self) -> Dict[str, str]:
+        """
+        Environment variables that point the app at these stand-ins.
+        """
+        return {
+            "APIFY_API_URL": self.http_url,
+            "APIFY_API_TOKEN": "fake-token",
+            "GEMINI_API_ENDPOINT": self.gemini_endpoint,
+            "GEMINI_API_KEY": "fake-key",
+            "GRPC_DEFAULT_SSL_ROOTS_FILE_PATH": self.ca_file,
+        }
+
+    # Image CDN
+
+    @staticmethod
+    def _render_images(size: tuple) -> List[bytes]:
+        from PIL import Image
+
+        images = []
+        for i in range(16):
+            image = Image.new("RGB", size, ((i * 53) % 256, (i * 97) % 256, (i * 151) % 256))
+            # A gradient band so the JPEG isn't trivially small, placed and
+            # angled differently per image so they aren't near-duplicates
+            band = Image.linear_gradient("L").rotate(i * 360 / 16).resize((size[0], size[1] // 3))
+            image.paste(Image.merge("RGB", (band, band, band)), (0, (i % 3) * size[1] // 3))
+            buffer = io.BytesIO()
+            image.save(buffer, "JPEG", quality=90)
+            images.append(buffer.getvalue())
+        return images
+
+    def _serve_image(self, request: _Handler, parts: List[str]) -> None:
+        self.counters.inc("cdn_requests")
+        time.sleep(self.cdn.delay())
+        if self.cdn.fails():
+            self.counters.inc("cdn_failures")
+            request._send_error(503)
+            return
+        digest = hashlib.sha1("/".join(parts).encode("utf-8")).digest()
+        body = self._images[digest[0] % len(self._images)]
+        request.send_response(200)
+        request.send_header("Content-Type", "image/jpeg")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    # Apify
+
+    def _items_for(self, username: str, count: int) -> List[Dict[str, Any]]:
+        items = []
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for i in range(count):
+            template = self._templates[i % len(self._templates)]
+            short_code = hashlib.sha1(f"{username}/{i}".encode("utf-8")).hexdigest()[:11]
+            items.append({
+                **template,
+                "id": f"{username}-{i}",
+                "shortCode": short_code,
+                "displayUrl": f"{self.http_url}/cdn/{username}/{short_code}.jpg",
+                "caption": f"{template.get('caption') or ''} (@{username} post {i})",
+                "timestamp": (now - datetime.timedelta(days=i)).isoformat(),
+            })
+        return items
+
+    def _run_view(self, run: Dict[str, Any]) -> Dict[str, Any]:
+        if run["status"] == "RUNNING" and time.monotonic() >= run["finishes_at"]:
+            run["status"] = "SUCCEEDED"
+        return {"id": run["id"], "status": run["status"], "defaultDatasetId": run["id"], "actId": run["actor"]}
+
+    def _serve_apify(self, request: _Handler, method: str, parts: List[str], query: Dict[str, str]) -> None:
+        self.counters.inc("apify_requests")
+        if self.apify.fails():
+            self.counters.inc("apify_failures")
+            request._send_error(500)
+            return
+
+        # POST /v2/acts/{actor}/runs
+        if method == "POST" and len(parts) == 3 and parts[0] == "acts" and parts[2] == "runs":
+            run_input = json.loads(request._body or b"{}")
+            direct_urls = run_input.get("directUrls") or ["https://www.instagram.com/unknown"]
+            username = direct_urls[0].rstrip("/").rsplit("/", 1)[-1]
+            count = min(int(run_input.get("resultsLimit") or self.posts_per_run), self.posts_per_run)
+            run_id = uuid.uuid4().hex[:17]
+            started = time.monotonic()
+            run = {
+                "id": run_id,
+                "actor": parts[1],
+                "status": "RUNNING",
+                "started": started,
+                "finishes_at": started + self.apify.delay(),
+                "items": self._items_for(username, count),
+            }
+            with self._runs_lock:
+                self._runs[run_id] = run
+            self.counters.inc("apify_runs")
+            request._send_json(201, {"data": self._run_view(run)})
+            return
+
+        # GET /v2/actor-runs/{id}, POST /v2/actor-runs/{id}/abort
+        if len(parts) >= 2 and parts[0] == "actor-runs":
+            run = self._runs.get(parts[1])
+            if run is None:
+                request._send_json(404, {"error": {"type": "record-not-found"}})
+                return
+            if method == "POST" and parts[2:] == ["abort"]:
+                if run["status"] == "RUNNING":
+                    run["status"] = "ABORTED"
+                    self.counters.inc("apify_aborts")
+            request._send_json(200, {"data": self._run_view(run)})
+            return
+
+        # GET /v2/datasets/{id}/items
+        if method == "GET" and len(parts) == 3 and parts[0] == "datasets" and parts[2] == "items":
+            run = self._runs.get(parts[1])
+            if run is None:
+                request._send_json(404, {"error": {"type": "record-not-found"}})
+                return
+            # Items land evenly over the run
+            items = run["items"]
+            duration = max(run["finishes_at"] - run["started"], 1e-6)
+            if self._run_view(run)["status"] == "RUNNING":
+                landed = int(len(items) * (time.monotonic() - run["started"]) / duration)
+            else:
+                landed = len(items)
+            offset = int(query.get("offset") or 0)
+            page = items[offset:landed]
+            if query.get("fields"):
+                fields = query["fields"].split(",")
+                page = [{key: item[key] for key in fields if key in item} for item in page]
+            request._send_json(200, page, headers={
+                "x-apify-pagination-total": str(landed),
+                "x-apify-pagination-offset": str(offset),
+                "x-apify-pagination-count": str(len(page)),
+                "x-apify-pagination-limit": "999999999999",
+                "x-apify-pagination-desc": "",
+            })
+            return
+
+        request._send_json(404, {"error": {"type": "page-not-found"}})
+
+    # Gemini
+
+    def _write_certificate(self) -> tuple:
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec
+        from cryptography.x509.oid import NameOID
+        import ipaddress
+
+        key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        certificate = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(minutes=5))
+            .not_valid_after(now + datetime.timedelta(days=1))
+            .add_extension(x509.SubjectAlternativeName([
+                x509.DNSName("localhost"), x509.IPAddress(ipaddress.ip_address("127.0.0.1"))
+            ]), critical=False)
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+            .sign(key, hashes.SHA256())
+        )
+        key_pem = key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        )
+        cert_pem = certificate.public_bytes(serialization.Encoding.PEM)
+        self.ca_file = os.path.join(self._tempdir.name, "fake-gemini.pem")
+        with open(self.ca_file, "wb") as f:
+            f.write(cert_pem)
+        return key_pem, cert_pem
+
+    def _gemini_answer(self, request: Any) -> str:
+        has_images = any("inline_data" in part for content in request.contents for part in content.parts)
+        digest = hashlib.sha1(type(request).serialize(request)).hexdigest()[:8]
+        if has_images:
+            return (
+                f"Profile {digest}: enjoys brunch spots, natural wine bars and street food. "
+                "Posts show a preference for bright, casual places, shared plates and "
+                "weekend trips to coastal towns. Likely budget: moderate."
+            )
+        recommendations = [
+            {
+                "restaurant_name": f"Fake Bistro {digest}-{i}",
+                "cuisine_type": cuisine,
+                "price_range": "$$",
+                "description": "Casual spot with shared plates.",
+                "why_recommended": "Matches the brunch and wine bar posts.",
+            }
+            for i, cuisine in enumerate(("Brunch", "Wine bar", "Street food"))
+        ]
+        return "```json\n" + json.dumps(recommendations, indent=2) + "\n```"
+
+    @staticmethod
+    def _prompt_token_count(request: Any) -> int:
+        # Roughly what Gemini bills: about 4 characters per text token, 258 tokens per image
+        tokens = 0
+        for content in request.contents:
+            for part in content.parts:
+                tokens += 258 if "inline_data" in part else len(part.text) // 4
+        return tokens
+
+    def _gemini_response(self, glm: Any, request: Any, text: str) -> Any:
+        prompt_tokens = self._prompt_token_count(request)
+        return glm.GenerateContentResponse(
+            candidates=[glm.Candidate(
+                content=glm.Content(parts=[glm.Part(text=text)], role="model"),
+                finish_reason=glm.Candidate.FinishReason.STOP,
+                index=0,
+            )],
+            usage_metadata=glm.GenerateContentResponse.UsageMetadata(
+                prompt_token_count=prompt_tokens,
+                candidates_token_count=len(text) // 4,
+                total_token_count=prompt_tokens + len(text) // 4,
+            ),
+        )
+
+    def _start_gemini(self) -> None:
+        import grpc
+        from google.ai import generativelanguage_v1beta as glm
+
+        def generate(request: Any, context: Any) -> Any:
+            self.counters.inc("gemini_requests")
+            time.sleep(self.gemini.delay())
+            if self.gemini.fails():
+                self.counters.inc("gemini_failures")
+                context.abort(grpc.StatusCode.UNAVAILABLE, "Injected failure")
+            return self._gemini_response(glm, request, self._gemini_answer(request))
+
+        def stream_generate(request: Any, context: Any) -> Any:
+            self.counters.inc("gemini_requests")
+            if self.gemini.fails():
+                time.sleep(self.gemini.delay())
+                self.counters.inc("gemini_failures")
+                context.abort(grpc.StatusCode.UNAVAILABLE, "Injected failure")
+            text = self._gemini_answer(request)
+            chunks = 5
+            size = -(-len(text) // chunks)
+            delay = self.gemini.delay() / chunks
+            for i in range(0, len(text), size):
+                time.sleep(delay)
+                yield self._gemini_response(glm, request, text[i:i + size])
+
+        handler = grpc.method_handlers_generic_handler("google.ai.generativelanguage.v1beta.GenerativeService", {
+            "GenerateContent": grpc.unary_unary_rpc_method_handler(
+                generate,
+                request_deserializer=glm.GenerateContentRequest.deserialize,
+                response_serializer=glm.GenerateContentResponse.serialize,
+            ),
+            "StreamGenerateContent": grpc.unary_stream_rpc_method_handler(
+                stream_generate,
+                request_deserializer=glm.GenerateContentRequest.deserialize,
+                response_serializer=glm.GenerateContentResponse.serialize,
+            ),
+        })
+        key_pem, cert_pem = self._write_certificate()
+        self._grpc = grpc.server(futures.ThreadPoolExecutor(max_workers=128, thread_name_prefix="fake-gemini"))
+        self._grpc.add_generic_rpc_handlers((handler,))
+        port = self._grpc.add_secure_port("127.0.0.1:0", grpc.ssl_server_credentials([(key_pem, cert_pem)]))
+        self._grpc.start()
+        self.gemini_endpoint = f"localhost:{port}"
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Return request and injected-failure counts per stand-in.
+        """
+        return dict(self.counters.values)
@@ -0,0 +1,145 @@
+import asyncio
+import importlib
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Optional
+
+from dotenv import load_dotenv
+
+from metrics import get_logger
+
+if TYPE_CHECKING:
+    from apify_client import ApifyClientAsync
+
+logger = get_logger("clients")
+
+# Load environment variables from .env file if it exists
+load_dotenv()
+
+APIFY_API_TOKEN = os.getenv("APIFY_API_TOKEN", "apify_api_NijTGDp3Pvbbd0dydzaDP9g4O78tnG3EHHSN")
+# Send API calls to another server, e.g. the stand-ins used by benchmarks/bench_load.py;
+# unset for the real Apify and Gemini APIs
+APIFY_API_URL = os.getenv("APIFY_API_URL")
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT")
+
+# google.generativeai, PIL and apify_client are imported on first use rather
+# than at import time, so a replica can start serving cheap routes quickly
+_lock = threading.Lock()
+_gemini_configured = False
+_gemini_models: Dict[str, Any] = {}
+
+_apify_client: Optional["ApifyClientAsync"] = None
+_apify_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+_startup: Dict[str, Any] = {}
+
+def get_gemini_model(name: str) -> Any:
+    """
+    Return the shared Gemini model for a model name, configuring the Gemini
+    API on first use.
+
+    Args:
+        name: Gemini model name, e.g. "gemini-2.0-flash"
+
+    Returns:
+        Shared google.generativeai.GenerativeModel instance
+
+    Raises:
+        ValueError: If GEMINI_API_KEY is not set
+    """
+    global _gemini_configured
+    model = _gemini_models.get(name)
+    if model is not None:
+        return model
+    with _lock:
+        import google.generativeai as genai
+
+        if not _gemini_configured:
+            # You should set this in an environment variable for security
+            api_key = os.getenv("GEMINI_API_KEY")
+            if not api_key:
+                raise ValueError("GEMINI_API_KEY environment variable is not set")
+            client_options = {"api_endpoint": GEMINI_API_ENDPOINT} if GEMINI_API_ENDPOINT else None
+            genai.configure(api_key=api_key, client_options=client_options)
+            _gemini_configured = True
+        model = _gemini_models.get(name)
+        if model is None:
+            model = _gemini_models[name] = genai.GenerativeModel(name)
+    return model
+
+def get_apify_client() -> "ApifyClientAsync":
+    """
+    Return the process-wide async Apify client, whose HTTP connections are
+    pooled across requests. The pool is bound to the event loop it was
+    opened on, so the client is rebuilt when the sync wrappers start a new loop.
+
+    Returns:
+        Shared ApifyClientAsync instance
+    """
+    global _apify_client, _apify_client_loop
+    loop = asyncio.get_running_loop()
+    if _apify_client is None or _apify_client_loop is not loop:
+        from apify_client import ApifyClientAsync
+
+        _apify_client = ApifyClientAsync(APIFY_API_TOKEN, api_url=APIFY_API_URL)
+        _apify_client_loop = loop
+    return _apify_client
+
+async def warm_up(model_names: Iterable[str]) -> Dict[str, float]:
+    """
+    Do the first-use work of every client ahead of the first request:
+    import the heavy modules, configure Gemini and build the models.
+
+    Args:
+        model_names: Gemini models to build
+
+    Returns:
+        Milliseconds spent per client
+    """
+    timings = {}
+
+    started = time.perf_counter()
+    await asyncio.to_thread(lambda: [get_gemini_model(name) for name in model_names])
+    timings["gemini_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+    started = time.perf_counter()
+    await asyncio.to_thread(importlib.import_module, "PIL.Image")
+    timings["pillow_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+    started = time.perf_counter()
+    await asyncio.to_thread(importlib.import_module, "apify_client")
+    get_apify_client()
+    timings["apify_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+    return timings
+
+def record_startup(started_at: float, warmup: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Record how long the app took to become ready and compare it with
+    STARTUP_TIME_TARGET_MS, warning when the target is missed.
+
+    Args:
+        started_at: time.perf_counter() value taken when startup began
+        warmup: Result of warm_up, if it ran
+
+    Returns:
+        Dictionary with startup_ms, target_ms, within_target and warmup
+    """
+    startup_ms = round((time.perf_counter() - started_at) * 1000, 1)
+    target_ms = float(os.getenv("STARTUP_TIME_TARGET_MS", "2000"))
+    _startup.update({
+        "startup_ms": startup_ms,
+        "target_ms": target_ms,
+        "within_target": startup_ms <= target_ms,
+        "warmup": warmup,
+    })
+    if startup_ms > target_ms:
+        logger.warning("Startup took %g ms, over the %g ms target", startup_ms, target_ms)
+    return dict(_startup)
+
+def startup_stats() -> Dict[str, Any]:
+    """
+    Return what record_startup measured, or an empty dictionary before startup finishes.
+    """
+    return dict(_startup)
@@ -0,0 +1,215 @@
+import math
+import os
+import re
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from gemini_scheduler import CHARS_PER_TOKEN, IMAGE_TOKENS
+from posts import Post
+
+# Prompt tokens an analysis may use when the route sets no budget of its own.
+# 2000 fits MAX_POSTS (5) posts with full captions: 5 * (258 image + ~105
+# caption tokens) plus ~70 for the prompt. With a smaller budget the planner
+# sends fewer posts or shorter captions; raising MAX_POSTS only helps when
+# the budget is raised with it, by about 360 tokens per post.
+DEFAULT_TOKEN_BUDGET = int(os.getenv("CONTENT_TOKEN_BUDGET", "2000"))
+# Per-route budgets, each overridable with CONTENT_TOKEN_BUDGET_<ROUTE>. The
+# stream route is tuned for time to first chunk, batch for Gemini quota.
+ROUTE_TOKEN_BUDGETS = {
+    "analysis": 2000,
+    "full_service": 2000,
+    "stream": 1400,
+    "batch": 1600,
+}
+# Most posts sent in one analysis, and how many recent posts they are picked from
+MAX_POSTS = int(os.getenv("CONTENT_MAX_POSTS", "5"))
+CANDIDATE_POSTS = int(os.getenv("CONTENT_CANDIDATE_POSTS", "12"))
+# Captions are cut to this length, keeping at most MAX_HASHTAGS distinct hashtags
+MAX_CAPTION_CHARS = int(os.getenv("CONTENT_MAX_CAPTION_CHARS", "400"))
+MAX_HASHTAGS = int(os.getenv("CONTENT_MAX_HASHTAGS", "3"))
+# A post whose caption can't get this many characters into the budget is left out
+MIN_CAPTION_CHARS = 40
+
+# The thumbnail of a video shows much less than a photo or an album's cover
+TYPE_WEIGHTS = {"Image": 1.0, "Sidecar": 0.9, "Video": 0.4}
+UNKNOWN_TYPE_WEIGHT = 0.8
+
+# Room for the "Post N Caption: " prefix each caption is sent with
+_CAPTION_PREFIX_CHARS = 18
+_HASHTAG = re.compile(r"#\w+")
+_MENTION_OR_URL = re.compile(r"@[\w.]+|https?://\S+")
+_WORD = re.compile(r"[^\W\d_]{2,}")
+# Lines Instagram users add to push hashtags below the fold: ".", "-", "•"
+_SPACER_LINE = re.compile(r"[\s.\-_•·|]*")
+
+def token_budget_for(route: str, override: Optional[int] = None) -> int:
+    """
+    Return the prompt token budget of a route.
+
+    Environment variables:
+        CONTENT_TOKEN_BUDGET_<ROUTE>: Budget of that route (e.g. CONTENT_TOKEN_BUDGET_STREAM)
+        CONTENT_TOKEN_BUDGET: Budget of routes without their own
+
+    Args:
+        route: Route name (analysis, full_service, stream or batch)
+        override: Budget given with the request, used as is when set
+
+    Returns:
+        Prompt token budget
+    """
+    if override is not None:
+        return override
+    value = os.getenv(f"CONTENT_TOKEN_BUDGET_{route.upper()}")
+    if value:
+        return int(value)
+    return ROUTE_TOKEN_BUDGETS.get(route, DEFAULT_TOKEN_BUDGET)
+
+def caption_tokens(caption: str) -> int:
+    """
+    Estimated prompt tokens of a caption as build_analysis_request sends it.
+    """
+    return (len(caption) + _CAPTION_PREFIX_CHARS) // CHARS_PER_TOKEN + 1
+
+def truncate_caption(caption: str, max_chars: int) -> str:
+    """
+    Cut a caption to at most max_chars characters at a word boundary.
+    """
+    if len(caption) <= max_chars:
+        return caption
+    cut = caption[:max(max_chars - 1, 0)]
+    if " " in cut:
+        cut = cut.rsplit(" ", 1)[0]
+    return cut.rstrip(" ,;:-") + "…"
+
+def condense_caption(caption: str, max_hashtags: int = MAX_HASHTAGS, max_chars: int = MAX_CAPTION_CHARS) -> Tuple[str, int]:
+    """
+    Shorten a caption without losing what it says: drop spacer lines,
+    collapse whitespace, keep only the first max_hashtags distinct hashtags
+    and cut the rest to max_chars at a word boundary.
+
+    Args:
+        caption: Original caption
+        max_hashtags: Distinct hashtags kept, in order of appearance
+        max_chars: Longest caption returned
+
+    Returns:
+        Condensed caption and the number of hashtags removed
+    """
+    seen = set()
+    removed = 0
+
+    def keep_hashtag(match: "re.Match") -> str:
+        nonlocal removed
+        tag = match.group(0).lower()
+        if tag not in seen and len(seen) < max_hashtags:
+            seen.add(tag)
+            return match.group(0)
+        removed += 1
+        return ""
+
+    text = _HASHTAG.sub(keep_hashtag, caption)
+    lines = [" ".join(line.split()) for line in text.splitlines() if not _SPACER_LINE.fullmatch(line)]
+    return truncate_caption(" ".join(line for line in lines if line), max_chars), removed
+
+def _informative_words(caption: str) -> int:
+    return len(_WORD.findall(_MENTION_OR_URL.sub(" ", _HASHTAG.sub(" ", caption))))
+
+def _engagement(post: Any) -> float:
+    # Comments say more about a post than likes do
+    comments = post.get("commentsCount") or 0
+    likes = post.get("likesCount") or 0
+    return math.log1p(max(comments, 0)) + 0.5 * math.log1p(max(likes, 0))
+
+def score_post(post: Any, caption: str, rank: int, candidates: int, max_engagement: float) -> float:
+    """
+    How much a post is expected to tell the analysis.
+
+    The post type sets the base weight; a caption with real words (not
+    only hashtags and mentions), comments and likes relative to the user's
+    other candidate posts, and recency each add to it.
+
+    Args:
+        post: Post or raw Apify item
+        caption: Its condensed caption
+        rank: Position among the candidates, 0 for the newest
+        candidates: Number of candidate posts
+        max_engagement: Highest engagement among the candidates
+
+    Returns:
+        Score, higher is better
+    """
+    type_weight = TYPE_WEIGHTS.get(post.get("type"), UNKNOWN_TYPE_WEIGHT)
+    words = min(_informative_words(caption), 30) / 30
+    engagement = _engagement(post) / max_engagement if max_engagement > 0 else 0.0
+    recency = 1 - rank / candidates
+    return type_weight * (1 + 0.6 * words + 0.3 * engagement + 0.5 * recency)
+
+def plan_posts(
+    posts: Sequence[Any],
+    token_budget: Optional[int] = None,
+    reserved_tokens: int = 0,
+    max_posts: int = MAX_POSTS,
+    candidates: int = CANDIDATE_POSTS,
+) -> Dict[str, Any]:
+    """
+    Pick the posts, and how much of each caption, to send to the analysis
+    within a prompt token budget.
+
+    The newest candidates posts with an image are scored (see score_post)
+    and taken best first while their image and condensed caption fit the
+    budget. A post that doesn't fit with its whole caption is still taken
+    when at least MIN_CAPTION_CHARS of the caption do. Token counts use the
+    same estimate as the Gemini scheduler.
+
+    Args:
+        posts: Posts or raw Apify items, newest first
+        token_budget: Prompt tokens available; DEFAULT_TOKEN_BUDGET when None
+        reserved_tokens: Tokens already used by the prompt and any context
+        max_posts: Most posts selected
+        candidates: Newest posts considered
+
+    Returns:
+        Dictionary with the selected posts (as Posts with condensed
+        captions, in their original order), the budget, the estimated
+        prompt tokens, and counts of posts considered and selected,
+        captions shortened and hashtags removed
+    """
+    token_budget = DEFAULT_TOKEN_BUDGET if token_budget is None else token_budget
+    window = [post for post in list(posts)[:candidates] if post.get("displayUrl")]
+    condensed = [condense_caption(post.get("caption") or "") for post in window]
+    max_engagement = max((_engagement(post) for post in window), default=0.0)
+    scores = [
+        score_post(post, caption, rank, len(window), max_engagement)
+        for rank, (post, (caption, _)) in enumerate(zip(window, condensed))
+    ]
+
+    available = token_budget - reserved_tokens
+    selected: Dict[int, str] = {}
+    shortened = 0
+    for i in sorted(range(len(window)), key=lambda i: -scores[i]):
+        if len(selected) >= max_posts:
+            break
+        caption = condensed[i][0]
+        if IMAGE_TOKENS + caption_tokens(caption) > available:
+            room = (available - IMAGE_TOKENS - 1) * CHARS_PER_TOKEN - _CAPTION_PREFIX_CHARS
+            if room < min(len(caption), MIN_CAPTION_CHARS):
+                continue
+            caption = truncate_caption(caption, room)
+        if len(caption) < len(window[i].get("caption") or ""):
+            shortened += 1
+        selected[i] = caption
+        available -= IMAGE_TOKENS + caption_tokens(caption)
+
+    planned: List[Post] = []
+    for i in sorted(selected):
+        post = Post(*(window[i].get(field) for field in Post.FIELDS))
+        post.caption = selected[i]
+        planned.append(post)
+    return {
+        "posts": planned,
+        "token_budget": token_budget,
+        "estimated_tokens": token_budget - available,
+        "considered": len(window),
+        "selected": len(planned),
+        "captions_shortened": shortened,
+        "hashtags_removed": sum(condensed[i][1] for i in selected),
+    }
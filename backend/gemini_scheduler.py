@@ -0,0 +1,579 @@
+import asyncio
+import atexit
+import collections
+import heapq
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from jobs import PRIORITY_BATCH, PRIORITY_INTERACTIVE, current_priority
+from metrics import GEMINI_CALLS, GEMINI_PROMPT_TOKENS, GEMINI_QUEUE_DEPTH, GEMINI_QUEUE_WAIT, GEMINI_QUOTA_TIMEOUTS, OpenStage
+from resilience import resilient_call
+from stage_limits import stage_slot
+from tracing import span
+
+# Labels used in stats and metrics, highest first
+PRIORITY_CLASSES = ("interactive", "default", "batch")
+
+# Tokens Gemini bills per image tile; prepared images are at most IMAGE_MAX_EDGE (768px), about one tile
+IMAGE_TOKENS = 258
+# Rough average for English text, good enough to plan with until the response reports the real count
+CHARS_PER_TOKEN = 4
+
+WaitingCounts = Callable[[], Dict[int, int]]
+
+def priority_class(priority: int) -> str:
+    """
+    Map a job priority to the class it is reported under.
+    """
+    if priority >= PRIORITY_INTERACTIVE:
+        return "interactive"
+    if priority <= PRIORITY_BATCH:
+        return "batch"
+    return "default"
+
+def estimate_prompt_tokens(contents: Any) -> int:
+    """
+    Estimate the prompt tokens of a generate_content request from its text
+    length and number of images.
+
+    Args:
+        contents: Prompt string or list of parts (strings and inline_data images)
+
+    Returns:
+        Estimated token count
+    """
+    parts = [contents] if isinstance(contents, str) else list(contents)
+    tokens = 0
+    for part in parts:
+        if isinstance(part, str):
+            tokens += len(part) // CHARS_PER_TOKEN + 1
+        else:
+            tokens += IMAGE_TOKENS
+    return tokens
+
+class QuotaWaitTimeout(RuntimeError):
+    """
+    Raised when a Gemini call would have to wait longer than the
+    scheduler's max_wait for quota.
+    """
+
+    def __init__(self, waited: float):
+        super().__init__(f"Gemini quota exhausted (gave up after waiting {waited:.0f}s)")
+        self.waited = waited
+
+def _refill(level: float, elapsed: float, budget: float) -> float:
+    return min(float(budget), level + max(elapsed, 0.0) * budget / 60)
+
+def _shortfall(levels: Dict[str, float], needs: Dict[str, float], budgets: Dict[str, float]) -> float:
+    # Seconds until every limited bucket holds what the call needs; a call
+    # bigger than a whole budget only needs a full bucket (and leaves it in debt)
+    wait = 0.0
+    for name, budget in budgets.items():
+        if budget <= 0:
+            continue
+        need = min(needs[name], budget)
+        if levels[name] < need:
+            wait = max(wait, (need - levels[name]) * 60 / budget)
+    return wait
+
+def _debit(levels: Dict[str, float], amounts: Dict[str, float], budgets: Dict[str, float]) -> None:
+    for name, amount in amounts.items():
+        if budgets[name] > 0:
+            levels[name] -= amount
+
+class _LocalBuckets:
+    """
+    Token buckets held in this process.
+    """
+
+    shared = False
+
+    def __init__(self, budgets: Dict[str, float]):
+        self.budgets = budgets
+        self._lock = threading.Lock()
+        self._levels = {name: float(max(budget, 0)) for name, budget in budgets.items()}
+        self._updated_at = time.time()
+
+    def _refresh(self) -> None:
+        # Caller holds the lock
+        now = time.time()
+        elapsed = now - self._updated_at
+        self._levels = {name: _refill(self._levels[name], elapsed, budget) for name, budget in self.budgets.items()}
+        self._updated_at = now
+
+    def take(self, needs: Dict[str, float], priority: int, waiting: WaitingCounts) -> float:
+        with self._lock:
+            self._refresh()
+            wait = _shortfall(self._levels, needs, self.budgets)
+            if wait <= 0:
+                _debit(self._levels, needs, self.budgets)
+            return wait
+
+    def adjust(self, amounts: Dict[str, float]) -> None:
+        with self._lock:
+            self._refresh()
+            _debit(self._levels, amounts, self.budgets)
+
+    def publish_waiting(self, waiting: WaitingCounts) -> None:
+        pass
+
+    def levels(self) -> Dict[str, float]:
+        with self._lock:
+            self._refresh()
+            return dict(self._levels)
+
+class _SharedBuckets:
+    """
+    Token buckets in a SQLite file shared by every process on the host.
+
+    Each process also records how many calls it has waiting per priority,
+    so a process only takes quota while no other process has a
+    higher-priority call waiting.
+    """
+
+    shared = True
+
+    # Waiting counts not refreshed for this long belong to a process that died
+    STALE_SECONDS = 5.0
+    # How long to hold back while another process has higher-priority calls waiting
+    YIELD_SECONDS = 0.05
+
+    def __init__(self, budgets: Dict[str, float], path: str):
+        self.budgets = budgets
+        self.path = path
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, level REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS waiting (
+                pid INTEGER NOT NULL,
+                priority INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                heartbeat REAL NOT NULL,
+                PRIMARY KEY (pid, priority)
+            )
+            """
+        )
+        atexit.register(self._clear_waiting)
+
+    def _transaction(self, fn: Callable[[float], Any]) -> Any:
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock up front so two processes can't spend the same quota
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(time.time())
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def _load(self, now: float) -> Dict[str, float]:
+        # Caller holds the lock
+        rows = {name: (level, updated_at) for name, level, updated_at in self._conn.execute("SELECT name, level, updated_at FROM buckets")}
+        levels = {}
+        for name, budget in self.budgets.items():
+            level, updated_at = rows.get(name, (float(max(budget, 0)), now))
+            levels[name] = _refill(level, now - updated_at, budget)
+        return levels
+
+    def _save(self, levels: Dict[str, float], now: float) -> None:
+        # Caller holds the lock
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO buckets (name, level, updated_at) VALUES (?, ?, ?)",
+            [(name, level, now) for name, level in levels.items()],
+        )
+
+    def _write_waiting(self, waiting: WaitingCounts, now: float) -> None:
+        # Caller holds the lock; counts are read here so a late write can't overwrite a newer one
+        self._conn.execute("DELETE FROM waiting WHERE pid = ?", (self._pid,))
+        self._conn.executemany(
+            "INSERT INTO waiting (pid, priority, count, heartbeat) VALUES (?, ?, ?, ?)",
+            [(self._pid, priority, count, now) for priority, count in waiting().items() if count],
+        )
+
+    def take(self, needs: Dict[str, float], priority: int, waiting: WaitingCounts) -> float:
+        def take(now: float) -> float:
+            self._write_waiting(waiting, now)
+            ahead = self._conn.execute(
+                "SELECT 1 FROM waiting WHERE pid != ? AND priority > ? AND heartbeat > ? LIMIT 1",
+                (self._pid, priority, now - self.STALE_SECONDS),
+            ).fetchone()
+            if ahead:
+                return self.YIELD_SECONDS
+            levels = self._load(now)
+            wait = _shortfall(levels, needs, self.budgets)
+            if wait <= 0:
+                _debit(levels, needs, self.budgets)
+                self._save(levels, now)
+            return wait
+
+        return self._transaction(take)
+
+    def adjust(self, amounts: Dict[str, float]) -> None:
+        def adjust(now: float) -> None:
+            levels = self._load(now)
+            _debit(levels, amounts, self.budgets)
+            self._save(levels, now)
+
+        self._transaction(adjust)
+
+    def publish_waiting(self, waiting: WaitingCounts) -> None:
+        self._transaction(lambda now: self._write_waiting(waiting, now))
+
+    def levels(self) -> Dict[str, float]:
+        with self._lock:
+            return self._load(time.time())
+
+    def _clear_waiting(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM waiting WHERE pid = ?", (self._pid,))
+
+class _Waiter:
+    __slots__ = ("priority", "loop", "event")
+
+    def __init__(self, priority: int):
+        self.priority = priority
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+
+    def wake(self) -> None:
+        # Waiters may belong to other event loops (sync wrappers run their own)
+        try:
+            self.loop.call_soon_threadsafe(self.event.set)
+        except RuntimeError:
+            pass
+
+class GeminiScheduler:
+    """
+    Admits Gemini calls within a requests-per-minute and a tokens-per-minute
+    budget, highest priority first.
+
+    Each budget is a token bucket that holds up to one minute's worth and
+    refills continuously. Waiting calls form a priority queue and only the
+    one at the front may take from the buckets, so an interactive call that
+    arrives while batch calls are waiting goes next. Prompt tokens are
+    estimated before a call and corrected from the response's usage
+    metadata afterwards. With state_path set, the buckets live in a SQLite
+    file shared by every process on the host.
+    """
+
+    # With shared buckets the front waiter re-checks at least this often,
+    # since other processes spend and wait too
+    SHARED_POLL_SECONDS = 0.5
+
+    def __init__(
+        self,
+        requests_per_minute: float = 2000,
+        tokens_per_minute: float = 4_000_000,
+        state_path: Optional[str] = None,
+        max_wait: float = 300.0,
+    ):
+        self.budgets = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.state_path = state_path
+        self.max_wait = max_wait
+        self._buckets = _SharedBuckets(self.budgets, state_path) if state_path else _LocalBuckets(self.budgets)
+        self._lock = threading.Lock()
+        self._queue: List[Tuple[int, int, _Waiter]] = []
+        self._sequence = itertools.count()
+        self._counters = {
+            klass: {"calls": 0, "waited": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0, "timeouts": 0}
+            for klass in PRIORITY_CLASSES
+        }
+        self._tokens = {"estimated": 0, "actual": 0, "unreported_calls": 0}
+
+    def _head(self) -> Optional[_Waiter]:
+        with self._lock:
+            return self._queue[0][2] if self._queue else None
+
+    def _waiting_counts(self) -> Dict[int, int]:
+        with self._lock:
+            return dict(collections.Counter(waiter.priority for _, _, waiter in self._queue))
+
+    async def _publish(self) -> None:
+        if self._buckets.shared:
+            await asyncio.to_thread(self._buckets.publish_waiting, self._waiting_counts)
+
+    async def _enqueue(self, waiter: _Waiter) -> None:
+        with self._lock:
+            previous = self._queue[0][2] if self._queue else None
+            heapq.heappush(self._queue, (-waiter.priority, next(self._sequence), waiter))
+        if previous is not None and self._head() is waiter:
+            # Let the displaced waiter notice it is no longer first
+            previous.wake()
+        GEMINI_QUEUE_DEPTH.inc(priority=priority_class(waiter.priority))
+        await self._publish()
+
+    async def _dequeue(self, waiter: _Waiter) -> None:
+        with self._lock:
+            self._queue = [entry for entry in self._queue if entry[2] is not waiter]
+            heapq.heapify(self._queue)
+            head = self._queue[0][2] if self._queue else None
+        if head is not None:
+            head.wake()
+        GEMINI_QUEUE_DEPTH.dec(priority=priority_class(waiter.priority))
+        await self._publish()
+
+    async def _take(self, needs: Dict[str, float], priority: int) -> float:
+        if self._buckets.shared:
+            wait = await asyncio.to_thread(self._buckets.take, needs, priority, self._waiting_counts)
+            return min(wait, self.SHARED_POLL_SECONDS) if wait > 0 else wait
+        return self._buckets.take(needs, priority, self._waiting_counts)
+
+    async def acquire(self, tokens: int, priority: Optional[int] = None) -> float:
+        """
+        Wait until a call of the given prompt size fits the budgets and
+        take it from them.
+
+        Args:
+            tokens: Estimated prompt tokens (see estimate_prompt_tokens)
+            priority: Defaults to the priority of the current context (see jobs.use_priority)
+
+        Returns:
+            Seconds waited
+
+        Raises:
+            QuotaWaitTimeout: If the call would wait longer than max_wait seconds
+        """
+        priority = current_priority() if priority is None else priority
+        klass = priority_class(priority)
+        needs = {"requests": 1, "tokens": tokens}
+        waiter = _Waiter(priority)
+        started = time.monotonic()
+        try:
+            # Inside the try: a caller cancelled while the queue is published must still leave it
+            await self._enqueue(waiter)
+            with span("gemini_queue", priority=klass, tokens=tokens):
+                while True:
+                    waiter.event.clear()
+                    wait = None
+                    if self._head() is waiter:
+                        wait = await self._take(needs, priority)
+                        if wait <= 0:
+                            break
+                    timeout = wait
+                    if self.max_wait:
+                        remaining = started + self.max_wait - time.monotonic()
+                        if remaining <= 0 or (wait is not None and wait > remaining):
+                            with self._lock:
+                                self._counters[klass]["timeouts"] += 1
+                            GEMINI_QUOTA_TIMEOUTS.inc(priority=klass)
+                            raise QuotaWaitTimeout(time.monotonic() - started)
+                        timeout = remaining if wait is None else wait
+                    try:
+                        await asyncio.wait_for(waiter.event.wait(), timeout=timeout)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            await asyncio.shield(self._dequeue(waiter))
+        waited = time.monotonic() - started
+        GEMINI_CALLS.inc(priority=klass)
+        GEMINI_QUEUE_WAIT.observe(waited, priority=klass)
+        with self._lock:
+            counters = self._counters[klass]
+            counters["calls"] += 1
+            counters["wait_seconds"] += waited
+            counters["max_wait_seconds"] = max(counters["max_wait_seconds"], waited)
+            if waited >= 0.001:
+                counters["waited"] += 1
+        self._tokens["estimated"] += tokens
+        GEMINI_PROMPT_TOKENS.inc(tokens, kind="estimated")
+        return waited
+
+    async def settle(self, estimated: int, actual: Optional[int]) -> None:
+        """
+        Correct the tokens taken for a call once its real prompt size is known.
+
+        Args:
+            estimated: Tokens passed to acquire
+            actual: Prompt tokens reported by Gemini, or None if it didn't report them
+        """
+        if actual is None:
+            self._tokens["unreported_calls"] += 1
+            return
+        self._tokens["actual"] += actual
+        GEMINI_PROMPT_TOKENS.inc(actual, kind="actual")
+        if actual == estimated:
+            return
+        amounts = {"tokens": actual - estimated}
+        if self._buckets.shared:
+            await asyncio.to_thread(self._buckets.adjust, amounts)
+        else:
+            self._buckets.adjust(amounts)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return the budgets, what is left of them, queue depth per priority
+        class, wait counters and estimated vs reported prompt tokens.
+        """
+        depth = dict.fromkeys(PRIORITY_CLASSES, 0)
+        for priority, count in self._waiting_counts().items():
+            depth[priority_class(priority)] += count
+        with self._lock:
+            priorities = {
+                klass: {
+                    **counters,
+                    "wait_seconds": round(counters["wait_seconds"], 3),
+                    "max_wait_seconds": round(counters["max_wait_seconds"], 3),
+                    "mean_wait_seconds": round(counters["wait_seconds"] / counters["calls"], 3) if counters["calls"] else None,
+                }
+                for klass, counters in self._counters.items()
+            }
+        available = {
+            name: round(level, 1) if self.budgets[name] > 0 else None
+            for name, level in self._buckets.levels().items()
+        }
+        return {
+            "requests_per_minute": self.budgets["requests"] or None,
+            "tokens_per_minute": self.budgets["tokens"] or None,
+            "shared_state": self.state_path,
+            "available": available,
+            "queue_depth": depth,
+            "priorities": priorities,
+            "prompt_tokens": dict(self._tokens),
+        }
+
+def prompt_tokens(response: Any) -> Optional[int]:
+    """
+    Return the prompt tokens a Gemini response reports, or None if it doesn't.
+    """
+    usage = getattr(response, "usage_metadata", None)
+    tokens = getattr(usage, "prompt_token_count", None)
+    return tokens if isinstance(tokens, int) and tokens > 0 else None
+
+async def generate_content(model: Any, contents: Any, stream: bool = False) -> Any:
+    """
+    Call model.generate_content_async once the Gemini quota allows, at the
+    priority of the current context. Every Gemini call goes through here.
+
+    Only the call itself goes through the Gemini circuit breaker and retry
+    policy (see resilient_call): time spent waiting for quota is neither a
+    failure nor a success of Gemini, and must not hold a half-open
+    circuit's trial slot. Retries reuse the quota taken for the call.
+    Streams are charged their estimated prompt size, since usage is only
+    reported once the stream has been read; for them only errors before
+    the first chunk are retried.
+
+    Args:
+        model: GenerativeModel
+        contents: Prompt string or list of parts
+        stream: Return a streaming response
+
+    Returns:
+        The model's response
+
+    Raises:
+        QuotaWaitTimeout: If quota doesn't become available within the scheduler's max_wait
+        CircuitOpenError: If Gemini's circuit is open
+    """
+    scheduler = get_gemini_scheduler()
+    estimated = estimate_prompt_tokens(contents)
+    await scheduler.acquire(estimated)
+    response = await resilient_call("gemini", lambda: model.generate_content_async(contents, stream=stream))
+    if not stream:
+        await scheduler.settle(estimated, prompt_tokens(response))
+    return response
+
+async def stream_content(model: Any, contents: Any, stage: str, usage: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+    """
+    Stream the text of a Gemini response, holding a "gemini" stage slot
+    (see stage_slot) and timing the stage only while Gemini is sending.
+
+    A separate task reads the response into a queue, so a slow or
+    disconnected consumer doesn't keep the slot: the task releases it as
+    soon as the stream is drained, and is cancelled when the consumer
+    stops early.
+
+    Args:
+        model: GenerativeModel
+        contents: Prompt string or list of parts
+        stage: Stage the call is timed as, e.g. "gemini_analysis"
+        usage: Optional dictionary that gets the reported prompt_tokens once the stream is drained
+
+    Yields:
+        Text of each non-empty chunk
+
+    Raises:
+        Any error of generate_content or of reading the stream
+    """
+    chunks: asyncio.Queue = asyncio.Queue()
+    finished = object()
+
+    async def read() -> None:
+        try:
+            async with stage_slot("gemini"):
+                # Ended explicitly: a tracing context must not stay open across the consumer's yields
+                timer = OpenStage(stage)
+                try:
+                    with timer.span.active():
+                        # Errors before the first chunk are retried; a stream that breaks midway is not
+                        response = await generate_content(model, contents, stream=True)
+                    async for chunk in response:
+                        if chunk.text:
+                            chunks.put_nowait(chunk.text)
+                    # Usage is reported with the stream's last chunk
+                    if usage is not None:
+                        usage["prompt_tokens"] = prompt_tokens(response)
+                except Exception as e:
+                    timer.end(e)
+                    raise
+                finally:
+                    timer.end()
+        except Exception as e:
+            chunks.put_nowait(e)
+            return
+        chunks.put_nowait(finished)
+
+    # The task copies this context, so it keeps the trace and priority
+    reader = asyncio.ensure_future(read())
+    try:
+        while True:
+            item = await chunks.get()
+            if item is finished:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        reader.cancel()
+        await asyncio.gather(reader, return_exceptions=True)
+
+_scheduler: Optional[GeminiScheduler] = None
+_scheduler_lock = threading.Lock()
+
+def get_gemini_scheduler() -> GeminiScheduler:
+    """
+    Return the process-wide Gemini scheduler, configured from the environment.
+
+    Environment variables:
+        GEMINI_REQUESTS_PER_MINUTE: Request budget, 0 for unlimited
+        GEMINI_TOKENS_PER_MINUTE: Prompt token budget, 0 for unlimited
+        GEMINI_SCHEDULER_PATH: SQLite file to share the budgets between processes; unset keeps them per process
+        GEMINI_QUOTA_MAX_WAIT: Seconds a call may wait for quota before failing, 0 to wait indefinitely
+
+    Returns:
+        Shared GeminiScheduler instance
+    """
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = GeminiScheduler(
+                    requests_per_minute=float(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "2000")),
+                    tokens_per_minute=float(os.getenv("GEMINI_TOKENS_PER_MINUTE", "4000000")),
+                    state_path=os.getenv("GEMINI_SCHEDULER_PATH") or None,
+                    max_wait=float(os.getenv("GEMINI_QUOTA_MAX_WAIT", "300")),
+                )
+    return _scheduler
@@ -0,0 +1,349 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from metrics import get_logger
+
+logger = get_logger("image_cache")
+
+def post_cache_key(post: Dict[str, Any]) -> Optional[str]:
+    """
+    Build a stable cache key for a post's display image.
+
+    Instagram CDN URLs are signed and change between scrapes, so the post
+    id (or shortCode) is used when available and the URL path otherwise.
+
+    Args:
+        post: Apify post item
+
+    Returns:
+        Cache key, or None if the post has no image
+    """
+    if post.get("id"):
+        return f"id-{post['id']}"
+    if post.get("shortCode"):
+        return f"sc-{post['shortCode']}"
+    if post.get("displayUrl"):
+        path = post["displayUrl"].split("?", 1)[0]
+        return "url-" + hashlib.sha256(path.encode("utf-8")).hexdigest()[:32]
+    return None
+
+class ImageCache:
+    """
+    Two-tier cache for downloaded post images.
+
+    The first tier is an in-memory LRU bounded by a byte budget. The second is
+    an on-disk store with one file per key, bounded by a TTL and a byte budget
+    (oldest files are evicted first). Disk hits are promoted into memory.
+
+    Each image's perceptual hashes can be stored next to it (a small .hash
+    file), so near-duplicate detection doesn't decode a cached image again.
+    They are kept in memory only while the image is, and dropped from disk
+    together with the image.
+    """
+
+    def __init__(
+        self,
+        directory: str = "cache/images",
+        memory_budget_bytes: int = 64 * 1024 * 1024,
+        disk_budget_bytes: int = 512 * 1024 * 1024,
+        ttl_seconds: float = 24 * 3600,
+    ):
+        self.directory = directory
+        self.memory_budget_bytes = memory_budget_bytes
+        self.disk_budget_bytes = disk_budget_bytes
+        self.ttl_seconds = ttl_seconds
+
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, Tuple[bytes, float]]" = OrderedDict()
+        self._memory_bytes = 0
+        # key -> (size, mtime) for every file in the disk tier
+        self._disk_index: Dict[str, Tuple[int, float]] = {}
+        self._disk_bytes = 0
+        self._hashes: Dict[str, Dict[str, str]] = {}
+        self._counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "memory_evictions": 0,
+            "disk_evictions": 0,
+            "expired": 0,
+            "hash_hits": 0,
+            "hash_misses": 0,
+        }
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_disk_index()
+
+    def _path(self, key: str) -> str:
+        safe_key = re.sub(r"[^A-Za-z0-9_.-]", "_", key)
+        return os.path.join(self.directory, safe_key + ".img")
+
+    def _hash_path(self, key: str) -> str:
+        return self._path(key)[:-len(".img")] + ".hash"
+
+    def _load_disk_index(self) -> None:
+        for name in os.listdir(self.directory):
+            if not name.endswith(".img"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            self._disk_index[name[:-4]] = (stat.st_size, stat.st_mtime)
+            self._disk_bytes += stat.st_size
+
+    def _remember(self, key: str, data: bytes, stored_at: float) -> None:
+        # Caller holds the lock
+        if len(data) > self.memory_budget_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous[0])
+        self._memory[key] = (data, stored_at)
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_budget_bytes:
+            evicted_key, (evicted, _) = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self._hashes.pop(evicted_key, None)
+            self._counters["memory_evictions"] += 1
+
+    def _remember_hashes(self, key: str, hashes: Dict[str, str]) -> None:
+        # Caller holds the lock. Hashes of images outside the memory tier stay
+        # on disk only, so this dictionary is bounded by the memory LRU
+        if key in self._memory:
+            self._hashes[key] = hashes
+
+    def _drop_disk(self, key: str) -> None:
+        # Caller holds the lock
+        entry = self._disk_index.pop(key, None)
+        if entry is None:
+            return
+        self._disk_bytes -= entry[0]
+        self._hashes.pop(key, None)
+        for path in (self._path(key), self._hash_path(key)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Look up an image, checking memory first and then disk.
+
+        Args:
+            key: Cache key from post_cache_key
+
+        Returns:
+            Image bytes, or None on a miss
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                data, stored_at = entry
+                if now - stored_at <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self._counters["memory_hits"] += 1
+                    return data
+                self._memory.pop(key)
+                self._memory_bytes -= len(data)
+                self._hashes.pop(key, None)
+
+            disk_entry = self._disk_index.get(key)
+            if disk_entry is None:
+                self._counters["misses"] += 1
+                return None
+            if now - disk_entry[1] > self.ttl_seconds:
+                self._drop_disk(key)
+                self._counters["expired"] += 1
+                self._counters["misses"] += 1
+                return None
+
+        # Read outside the lock; put replaces files atomically, so this sees
+        # either the old or the new image, and the index is checked again below
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            with self._lock:
+                if self._disk_index.get(key) is disk_entry:
+                    self._drop_disk(key)
+                self._counters["misses"] += 1
+            return None
+
+        with self._lock:
+            self._counters["disk_hits"] += 1
+            # A put or eviction in the meantime owns the entry now; don't
+            # promote what may be the image it replaced
+            if self._disk_index.get(key) is disk_entry:
+                self._remember(key, data, disk_entry[1])
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        """
+        Store an image in both tiers.
+
+        Args:
+            key: Cache key from post_cache_key
+            data: Image bytes
+        """
+        now = time.time()
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Error writing image cache entry %s: %s", key, e)
+            with self._lock:
+                self._remember(key, data, now)
+            return
+
+        with self._lock:
+            self._remember(key, data, now)
+            previous = self._disk_index.pop(key, None)
+            if previous is not None:
+                self._disk_bytes -= previous[0]
+            self._disk_index[key] = (len(data), now)
+            self._disk_bytes += len(data)
+            if self._disk_bytes > self.disk_budget_bytes:
+                for old_key, _ in sorted(self._disk_index.items(), key=lambda item: item[1][1]):
+                    if self._disk_bytes <= self.disk_budget_bytes:
+                        break
+                    self._drop_disk(old_key)
+                    self._counters["disk_evictions"] += 1
+
+    def get_hashes(self, key: str) -> Optional[Dict[str, str]]:
+        """
+        Look up the perceptual hashes stored for an image.
+
+        Args:
+            key: Cache key from post_cache_key
+
+        Returns:
+            Hashes as stored by put_hashes, or None if there are none
+        """
+        with self._lock:
+            hashes = self._hashes.get(key)
+            if hashes is not None:
+                self._counters["hash_hits"] += 1
+                return hashes
+            on_disk = key in self._disk_index
+
+        if on_disk:
+            try:
+                with open(self._hash_path(key), "r", encoding="utf-8") as f:
+                    hashes = json.load(f)
+            except (OSError, ValueError):
+                hashes = None
+
+        with self._lock:
+            if hashes is not None:
+                self._remember_hashes(key, hashes)
+                self._counters["hash_hits"] += 1
+            else:
+                self._counters["hash_misses"] += 1
+        return hashes
+
+    def put_hashes(self, key: str, hashes: Dict[str, str]) -> None:
+        """
+        Store an image's perceptual hashes next to it.
+
+        Args:
+            key: Cache key from post_cache_key
+            hashes: Result of image_hashing.image_hashes
+        """
+        path = self._hash_path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(hashes, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Error writing image hashes %s: %s", key, e)
+        with self._lock:
+            self._remember_hashes(key, hashes)
+
+    async def aget(self, key: str) -> Optional[bytes]:
+        """
+        Async variant of get; memory hits are served inline, disk reads run
+        in a worker thread.
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            fresh = entry is not None and time.time() - entry[1] <= self.ttl_seconds
+        if fresh:
+            return self.get(key)
+        return await asyncio.to_thread(self.get, key)
+
+    async def aput(self, key: str, data: bytes) -> None:
+        """
+        Async variant of put; the disk write runs in a worker thread.
+        """
+        await asyncio.to_thread(self.put, key, data)
+
+    async def aget_hashes(self, key: str) -> Optional[Dict[str, str]]:
+        """
+        Async variant of get_hashes; only disk reads run in a worker thread.
+        """
+        with self._lock:
+            cached = key in self._hashes
+        if cached:
+            return self.get_hashes(key)
+        return await asyncio.to_thread(self.get_hashes, key)
+
+    async def aput_hashes(self, key: str, hashes: Dict[str, str]) -> None:
+        """
+        Async variant of put_hashes; the disk write runs in a worker thread.
+        """
+        await asyncio.to_thread(self.put_hashes, key, hashes)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return hit/miss/eviction counters and current tier sizes.
+        """
+        with self._lock:
+            lookups = self._counters["memory_hits"] + self._counters["disk_hits"] + self._counters["misses"]
+            hits = self._counters["memory_hits"] + self._counters["disk_hits"]
+            return {
+                **self._counters,
+                "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": len(self._disk_index),
+                "disk_bytes": self._disk_bytes,
+                "hashed_entries": len(self._hashes),
+            }
+
+_image_cache: Optional[ImageCache] = None
+
+def get_image_cache() -> ImageCache:
+    """
+    Return the process-wide image cache, configured from the environment.
+
+    Environment variables:
+        IMAGE_CACHE_DIR: Directory for the disk tier
+        IMAGE_CACHE_MEMORY_MB: Byte budget of the in-memory LRU, in MiB
+        IMAGE_CACHE_DISK_MB: Byte budget of the disk tier, in MiB
+        IMAGE_CACHE_TTL: Seconds an entry stays valid
+
+    Returns:
+        Shared ImageCache instance
+    """
+    global _image_cache
+    if _image_cache is None:
+        _image_cache = ImageCache(
+            directory=os.getenv("IMAGE_CACHE_DIR", "cache/images"),
+            memory_budget_bytes=int(float(os.getenv("IMAGE_CACHE_MEMORY_MB", "64")) * 1024 * 1024),
+            disk_budget_bytes=int(float(os.getenv("IMAGE_CACHE_DISK_MB", "512")) * 1024 * 1024),
+            ttl_seconds=float(os.getenv("IMAGE_CACHE_TTL", str(24 * 3600))),
+        )
+    return _image_cache
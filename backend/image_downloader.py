@@ -0,0 +1,208 @@
+import asyncio
+import os
+import time
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+import httpx
+
+from metrics import get_logger
+from resilience import LatencyTracker, hedged, resilient_call
+from tracing import span
+
+logger = get_logger("image_downloader")
+
+class _LoopState:
+    """
+    Per-event-loop resources. httpx clients and asyncio semaphores are bound
+    to the loop they were first used on, and the sync wrappers start a fresh
+    loop per call with asyncio.run, so these are rebuilt when the loop changes.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, max_connections: int, max_concurrency: int):
+        self.loop = loop
+        self.client = httpx.AsyncClient(
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=60,
+            ),
+        )
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.host_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+class ImageDownloader:
+    """
+    Concurrent image downloader backed by a pooled keep-alive HTTP client.
+
+    Downloads run in parallel, bounded by a global concurrency limit and a
+    per-host limit so a single CDN node is never flooded. Every image has its
+    own timeout and a batch has an overall deadline; images that miss either
+    come back as None so the rest of the batch is not held up.
+
+    A download still running after the hedge_percentile of recent download
+    times gets a duplicate request, and the first answer wins. Transient
+    failures are retried with backoff, and all downloads share the "cdn"
+    circuit breaker.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 20,
+        max_concurrency: int = 10,
+        per_host_concurrency: int = 4,
+        timeout: float = 10.0,
+        deadline: float = 20.0,
+        hedge: bool = True,
+        hedge_percentile: float = 95,
+    ):
+        self.max_connections = max_connections
+        self.max_concurrency = max_concurrency
+        self.per_host_concurrency = per_host_concurrency
+        self.timeout = timeout
+        self.deadline = deadline
+        self.hedge = hedge
+        self.latency = LatencyTracker(percentile=hedge_percentile)
+        self._state: Optional[_LoopState] = None
+
+    def _get_state(self) -> _LoopState:
+        loop = asyncio.get_running_loop()
+        if self._state is None or self._state.loop is not loop:
+            # The previous loop (if any) is gone, so its client can't be closed
+            # from here; dropping the reference releases its sockets.
+            self._state = _LoopState(loop, self.max_connections, self.max_concurrency)
+        return self._state
+
+    def _host_semaphore(self, state: _LoopState, url: str) -> asyncio.Semaphore:
+        host = urlparse(url).netloc
+        semaphore = state.host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.per_host_concurrency)
+            state.host_semaphores[host] = semaphore
+        return semaphore
+
+    async def fetch(self, url: str, timeout: Optional[float] = None) -> Optional[bytes]:
+        """
+        Download a single image.
+
+        Args:
+            url: URL of the image to download
+            timeout: Per-image timeout in seconds, defaults to the downloader's
+
+        Returns:
+            Image as bytes, or None if the download failed or timed out
+        """
+        timeout = self.timeout if timeout is None else timeout
+        state = self._get_state()
+
+        async def get() -> bytes:
+            with span("image_fetch", host=urlparse(url).netloc) as attrs:
+                started = time.perf_counter()
+                response = await asyncio.wait_for(state.client.get(url, timeout=timeout), timeout)
+                attrs["status"] = response.status_code
+                response.raise_for_status()
+                self.latency.observe(time.perf_counter() - started)
+                attrs["bytes"] = len(response.content)
+                return response.content
+
+        async def attempt() -> bytes:
+            # Backoff between attempts happens outside the concurrency slots.
+            # The host slot is taken first, so downloads queued behind a busy
+            # host don't hold global slots that other hosts could use.
+            async with self._host_semaphore(state, url), state.semaphore:
+                if not self.hedge:
+                    return await get()
+                return await hedged("cdn", get, self.latency.delay())
+
+        try:
+            return await resilient_call("cdn", attempt)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Error downloading image from %s: %s", url, str(e) or type(e).__name__)
+            return None
+
+    async def fetch_all(
+        self,
+        urls: List[Optional[str]],
+        timeout: Optional[float] = None,
+        deadline: Optional[float] = None,
+    ) -> List[Optional[bytes]]:
+        """
+        Download a batch of images concurrently.
+
+        Args:
+            urls: Image URLs; None entries are skipped
+            timeout: Per-image timeout in seconds, defaults to the downloader's
+            deadline: Overall deadline for the batch in seconds, defaults to the downloader's
+
+        Returns:
+            Image bytes in the same order as urls, with None for skipped,
+            failed or late images
+        """
+        deadline = self.deadline if deadline is None else deadline
+        tasks = {
+            i: asyncio.ensure_future(self.fetch(url, timeout=timeout))
+            for i, url in enumerate(urls)
+            if url
+        }
+        results: List[Optional[bytes]] = [None] * len(urls)
+        if not tasks:
+            return results
+
+        started = time.monotonic()
+        done, pending = await asyncio.wait(tasks.values(), timeout=deadline)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+            logger.warning(
+                "Image batch deadline of %ss hit after %.2fs, dropped %d of %d images",
+                deadline, time.monotonic() - started, len(pending), len(tasks),
+            )
+
+        for i, task in tasks.items():
+            if task in done and not task.cancelled():
+                results[i] = task.result()
+        return results
+
+    async def aclose(self) -> None:
+        """
+        Close the pooled client if it belongs to the running loop.
+        """
+        state = self._state
+        self._state = None
+        if state is not None and state.loop is asyncio.get_running_loop():
+            await state.client.aclose()
+
+_downloader: Optional[ImageDownloader] = None
+
+def get_image_downloader() -> ImageDownloader:
+    """
+    Return the process-wide image downloader, configured from the environment.
+
+    Environment variables:
+        IMAGE_DOWNLOAD_MAX_CONNECTIONS: Size of the keep-alive connection pool
+        IMAGE_DOWNLOAD_CONCURRENCY: Maximum downloads in flight overall
+        IMAGE_DOWNLOAD_PER_HOST: Maximum downloads in flight per host
+        IMAGE_DOWNLOAD_TIMEOUT: Per-image timeout in seconds
+        IMAGE_DOWNLOAD_DEADLINE: Overall deadline per batch in seconds
+        IMAGE_DOWNLOAD_HEDGE: Send a duplicate request for slow downloads ("true"/"false")
+        IMAGE_DOWNLOAD_HEDGE_PERCENTILE: Percentile of recent download times after which to hedge
+
+    Returns:
+        Shared ImageDownloader instance
+    """
+    global _downloader
+    if _downloader is None:
+        _downloader = ImageDownloader(
+            max_connections=int(os.getenv("IMAGE_DOWNLOAD_MAX_CONNECTIONS", "20")),
+            max_concurrency=int(os.getenv("IMAGE_DOWNLOAD_CONCURRENCY", "10")),
+            per_host_concurrency=int(os.getenv("IMAGE_DOWNLOAD_PER_HOST", "4")),
+            timeout=float(os.getenv("IMAGE_DOWNLOAD_TIMEOUT", "10")),
+            deadline=float(os.getenv("IMAGE_DOWNLOAD_DEADLINE", "20")),
+            hedge=os.getenv("IMAGE_DOWNLOAD_HEDGE", "true") == "true",
+            hedge_percentile=float(os.getenv("IMAGE_DOWNLOAD_HEDGE_PERCENTILE", "95")),
+        )
+    return _downloader
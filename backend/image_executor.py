@@ -0,0 +1,198 @@
+import asyncio
+import functools
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+from image_hashing import ImageHashes, image_hashes
+from image_processing import prepare_image
+from metrics import get_logger
+from tracing import span
+
+T = TypeVar("T")
+
+logger = get_logger("image_executor")
+
+def _warm_worker() -> None:
+    # Import Pillow and NumPy once per worker process rather than on its first image
+    import numpy  # noqa: F401
+    from PIL import Image, JpegImagePlugin  # noqa: F401
+
+class ImageExecutor:
+    """
+    Runs prepare_image (decode, resize, JPEG encode) and image_hashes in a
+    pool of worker processes, so Pillow's CPU work doesn't hold this
+    process's GIL while other requests are being served.
+
+    Images go to the workers as bytes and only the results come back, one
+    copy each way through the pool's pipe. Images of at most
+    inline_max_bytes cost less to process than to ship to another process,
+    so they are handled in the calling thread. At most max_pending images
+    are in the pool at once; further callers wait, which keeps a burst of
+    requests from piling image data up in the pool's queue. With workers=0
+    images are processed in threads, as before the pool existed.
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 32, inline_max_bytes: int = 16384):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.inline_max_bytes = inline_max_bytes
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+        # asyncio semaphores are bound to a loop; rebuilt when the sync wrappers start a new one
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._in_pool = 0
+        self._counters = {
+            "inline": 0,
+            "process": 0,
+            "thread": 0,
+            "waited": 0,
+            "pool_restarts": 0,
+        }
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                # spawn, not fork: forking a process that runs an event loop and threads can deadlock the child
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_warm_worker,
+                )
+            return self._pool
+
+    def _discard_pool(self, pool: ProcessPoolExecutor) -> None:
+        with self._pool_lock:
+            if self._pool is pool:
+                self._pool = None
+                self._counters["pool_restarts"] += 1
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_pending)
+        return self._semaphore
+
+    async def run(self, fn: Callable[..., T], image_bytes: bytes, **options: Any) -> T:
+        """
+        Run CPU-bound image work without blocking the event loop on large images.
+
+        Args:
+            fn: Module-level function taking the image bytes (it is pickled by reference)
+            image_bytes: Original image bytes
+            options: Keyword arguments for fn
+
+        Returns:
+            Result of fn
+        """
+        if len(image_bytes) <= self.inline_max_bytes:
+            self._counters["inline"] += 1
+            return fn(image_bytes, **options)
+        if self.workers <= 0:
+            self._counters["thread"] += 1
+            return await asyncio.to_thread(fn, image_bytes, **options)
+
+        semaphore = self._get_semaphore()
+        if semaphore.locked():
+            self._counters["waited"] += 1
+        with span("image_worker_queue"):
+            await semaphore.acquire()
+        self._in_pool += 1
+        try:
+            pool = self._get_pool()
+            try:
+                result = await asyncio.get_running_loop().run_in_executor(
+                    pool, functools.partial(fn, image_bytes, **options)
+                )
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for memory); start a fresh pool next time
+                logger.warning("Image worker pool broke, running image work in a thread")
+                self._discard_pool(pool)
+                self._counters["thread"] += 1
+                return await asyncio.to_thread(fn, image_bytes, **options)
+            self._counters["process"] += 1
+            return result
+        finally:
+            self._in_pool -= 1
+            semaphore.release()
+
+    async def prepare(self, image_bytes: bytes, **options: Any) -> Dict[str, Any]:
+        """
+        Downscale and recompress an image for Gemini (see prepare_image).
+
+        Args:
+            image_bytes: Original image bytes
+            options: Passed to prepare_image (max_edge, quality, max_bytes)
+
+        Returns:
+            Result of prepare_image
+        """
+        return await self.run(prepare_image, image_bytes, **options)
+
+    async def hashes(self, image_bytes: bytes) -> Optional[ImageHashes]:
+        """
+        Compute an image's perceptual hashes (see image_hashes).
+        """
+        return await self.run(image_hashes, image_bytes)
+
+    async def warm_up(self) -> None:
+        """
+        Start every worker process now instead of on the first large images.
+        """
+        if self.workers <= 0:
+            return
+        pool = self._get_pool()
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(pool, _warm_worker) for _ in range(self.workers)])
+
+    def shutdown(self) -> None:
+        """
+        Stop the worker processes; a later call starts a new pool.
+        """
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return the pool settings and how many images were prepared inline,
+        in the pool and in threads.
+        """
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "inline_max_bytes": self.inline_max_bytes,
+            "running": self._pool is not None,
+            "in_pool": self._in_pool,
+            **self._counters,
+        }
+
+_image_executor: Optional[ImageExecutor] = None
+
+def get_image_executor() -> ImageExecutor:
+    """
+    Return the process-wide image executor, configured from the environment.
+
+    Environment variables:
+        IMAGE_PROCESS_WORKERS: Worker processes, 0 to prepare images in threads (default: CPU count, at most 4)
+        IMAGE_PROCESS_MAX_PENDING: Images in the pool at once before callers wait
+        IMAGE_INLINE_MAX_BYTES: Images up to this size are prepared in the calling thread
+
+    Returns:
+        Shared ImageExecutor instance
+    """
+    global _image_executor
+    if _image_executor is None:
+        _image_executor = ImageExecutor(
+            workers=int(os.getenv("IMAGE_PROCESS_WORKERS", str(min(4, os.cpu_count() or 1)))),
+            max_pending=int(os.getenv("IMAGE_PROCESS_MAX_PENDING", "32")),
+            inline_max_bytes=int(os.getenv("IMAGE_INLINE_MAX_BYTES", "16384")),
+        )
+    return _image_executor
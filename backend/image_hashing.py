@@ -0,0 +1,134 @@
+import functools
+import io
+import os
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence
+
+from metrics import get_logger
+
+logger = get_logger("image_hashing")
+
+# NumPy and PIL are imported on first use to keep app startup fast
+if TYPE_CHECKING:
+    import numpy as np
+
+# Collapse near-identical post images into one before analysis
+DEDUPE_ENABLED = os.getenv("IMAGE_DEDUPE", "true").lower() == "true"
+# Images whose dHash and pHash both differ in at most this many of their 64
+# bits are treated as the same picture (recompressed, resized, slightly cropped)
+DEFAULT_MAX_DISTANCE = int(os.getenv("IMAGE_DEDUPE_MAX_DISTANCE", "8"))
+
+ImageHashes = Dict[str, str]
+
+@functools.lru_cache(maxsize=None)
+def _dct_matrix(size: int) -> "np.ndarray":
+    # Orthonormal DCT-II basis, so the 2D transform is two matrix products
+    import numpy as np
+
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+def _to_hex(bits: "np.ndarray") -> str:
+    import numpy as np
+
+    return np.packbits(bits.ravel()).tobytes().hex()
+
+def image_hashes(image_bytes: bytes) -> Optional[ImageHashes]:
+    """
+    Compute the 64-bit difference hash (dHash) and DCT perceptual hash
+    (pHash) of an image.
+
+    dHash records whether each pixel of a 9x8 grayscale thumbnail is
+    brighter than its right neighbour; pHash whether each of the 8x8
+    lowest-frequency DCT coefficients of a 32x32 thumbnail is above their
+    median. Both survive recompression and resizing.
+
+    Args:
+        image_bytes: Original image bytes
+
+    Returns:
+        Dictionary with "dhash" and "phash" as 16-digit hex strings, or None
+        if the image can't be decoded
+    """
+    import numpy as np
+    from PIL import Image, ImageOps
+
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        # Only a thumbnail is needed, so let the JPEG decoder downsample
+        if image.format == "JPEG":
+            image.draft("L", (64, 64))
+        image = ImageOps.exif_transpose(image).convert("L")
+        pixels = np.asarray(image.resize((32, 32), Image.LANCZOS), dtype=np.float64)
+        thumbnail = np.asarray(image.resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    except Exception as e:
+        logger.warning("Could not hash image: %s", e)
+        return None
+
+    dct = _dct_matrix(32)
+    low = (dct @ pixels @ dct.T)[:8, :8]
+    # The DC term only reflects overall brightness, so it is left out of the median
+    median = np.median(low.ravel()[1:])
+    return {
+        "dhash": _to_hex(thumbnail[:, 1:] > thumbnail[:, :-1]),
+        "phash": _to_hex(low > median),
+    }
+
+def hamming_distances(hashes: Sequence[str]) -> "np.ndarray":
+    """
+    Pairwise Hamming distances between 64-bit hex hashes.
+
+    Args:
+        hashes: Hashes as returned by image_hashes
+
+    Returns:
+        Square matrix of differing bit counts
+    """
+    import numpy as np
+
+    values = np.array([int(value, 16) for value in hashes], dtype=np.uint64)
+    xor = values[:, None] ^ values[None, :]
+    return np.unpackbits(xor.view(np.uint8).reshape(len(values), len(values), 8), axis=-1).sum(axis=-1)
+
+def group_near_duplicates(hashes: Sequence[Optional[ImageHashes]], max_distance: Optional[int] = None) -> List[List[int]]:
+    """
+    Group images that are near-identical: both their dHash and pHash are
+    within max_distance bits. Each image is compared with the first image
+    of every group so far, so groups don't chain through gradual changes.
+
+    Args:
+        hashes: Per-image hashes in order; None for images that couldn't be hashed
+        max_distance: Largest Hamming distance still counted as the same image
+
+    Returns:
+        Groups of indices, ordered by their first (kept) image; images
+        without hashes are always on their own
+    """
+    max_distance = DEFAULT_MAX_DISTANCE if max_distance is None else max_distance
+    hashed = [i for i, value in enumerate(hashes) if value is not None]
+    distances = {}
+    if len(hashed) > 1:
+        import numpy as np
+
+        matrix = np.maximum(
+            hamming_distances([hashes[i]["dhash"] for i in hashed]),
+            hamming_distances([hashes[i]["phash"] for i in hashed]),
+        )
+        distances = {index: row for index, row in zip(hashed, matrix)}
+    position = {index: n for n, index in enumerate(hashed)}
+
+    groups: List[List[int]] = []
+    for i, value in enumerate(hashes):
+        if value is not None:
+            for group in groups:
+                first = group[0]
+                if first in distances and distances[first][position[i]] <= max_distance:
+                    group.append(i)
+                    break
+            else:
+                groups.append([i])
+        else:
+            groups.append([i])
+    return groups
@@ -0,0 +1,111 @@
+import io
+import os
+from typing import TYPE_CHECKING, Any, Dict, Optional
+
+from metrics import get_logger
+
+logger = get_logger("image_processing")
+
+# PIL is imported on first use to keep app startup fast
+if TYPE_CHECKING:
+    from PIL import Image
+
+# Formats Gemini accepts as inline image data
+SUPPORTED_MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+    "HEIC": "image/heic",
+    "HEIF": "image/heif",
+}
+
+# Gemini bills images in 768x768 tiles, so a 768px edge keeps most posts to one tile
+DEFAULT_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "768"))
+DEFAULT_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "80"))
+DEFAULT_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", "200000"))
+MIN_QUALITY = 40
+
+def _encode_jpeg(image: "Image.Image", quality: int) -> bytes:
+    buffer = io.BytesIO()
+    # No exif/icc arguments, so metadata from the source is dropped
+    image.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+def prepare_image(
+    image_bytes: bytes,
+    max_edge: Optional[int] = None,
+    quality: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Downscale and recompress an image before it is sent to Gemini.
+
+    The real format is detected from the bytes, the image is shrunk so its
+    longest edge is at most max_edge, metadata is stripped and it is
+    re-encoded as JPEG, lowering quality until it fits max_bytes. If the
+    bytes can't be decoded they are passed through unchanged.
+
+    Args:
+        image_bytes: Original image bytes
+        max_edge: Maximum length of the longest edge in pixels
+        quality: Starting JPEG quality (1-95)
+        max_bytes: Target upper bound for the encoded size
+
+    Returns:
+        Dictionary with the encoded data, its mime type, source format,
+        final dimensions, and original/encoded byte counts
+    """
+    from PIL import Image, ImageOps
+
+    max_edge = max_edge or DEFAULT_MAX_EDGE
+    quality = quality or DEFAULT_QUALITY
+    max_bytes = max_bytes or DEFAULT_MAX_BYTES
+
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        source_format = image.format
+        original_size = sorted(image.size)
+        # Let the JPEG decoder downsample while decoding (much cheaper than a full decode)
+        if source_format == "JPEG":
+            image.draft("RGB", (max_edge, max_edge))
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            rgba = image.convert("RGBA")
+            image = Image.new("RGB", rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.split()[-1])
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        data = _encode_jpeg(image, quality)
+        while len(data) > max_bytes and quality > MIN_QUALITY:
+            quality = max(MIN_QUALITY, quality - 10)
+            data = _encode_jpeg(image, quality)
+
+        return {
+            "data": data,
+            "mime_type": "image/jpeg",
+            "source_format": source_format,
+            "width": image.width,
+            "height": image.height,
+            "quality": quality,
+            "original_bytes": len(image_bytes),
+            "bytes": len(data),
+        }
+    except Exception as e:
+        logger.warning("Could not preprocess image, sending original bytes: %s", e)
+        source_format = None
+        try:
+            source_format = Image.open(io.BytesIO(image_bytes)).format
+        except Exception:
+            pass
+        return {
+            "data": image_bytes,
+            "mime_type": SUPPORTED_MIME_TYPES.get(source_format, "image/jpeg"),
+            "source_format": source_format,
+            "width": None,
+            "height": None,
+            "quality": None,
+            "original_bytes": len(image_bytes),
+            "bytes": len(image_bytes),
+        }
@@ -1,22 +1,33 @@
-import google.generativeai as genai
+import asyncio
 import base64
 import requests
-import io
-from PIL import Image
-from typing import List, Dict, Any
-import os
-from dotenv import load_dotenv
+from typing import AsyncIterator, List, Dict, Any, Optional
+from clients import get_gemini_model
+from content_planner import plan_posts
+from gemini_scheduler import estimate_prompt_tokens, generate_content, prompt_tokens, stream_content
+from image_downloader import get_image_downloader
+from image_cache import get_image_cache, post_cache_key
+from image_executor import get_image_executor
+from image_hashing import DEDUPE_ENABLED, group_near_duplicates
+from llm_cache import get_llm_cache, make_cache_key
+from analysis_state import get_analysis_state_store, load_state_from_outputs
+from stage_limits import stage_slot
+from metrics import IMAGE_BYTES, IMAGE_DUPLICATES, get_logger, track_stage
+from tracing import span
 
-# Load environment variables from .env file if it exists
-load_dotenv()
+logger = get_logger("instagram_analysis")
 
-# Configure the Gemini API with your API key
-# You should set this in an environment variable for security
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
-    raise ValueError("GEMINI_API_KEY environment variable is not set")
+# Shared session so repeated sync downloads reuse keep-alive connections
+_session = requests.Session()
 
-genai.configure(api_key=GEMINI_API_KEY)
+# Background downloads started by prefetch_post_image, keyed by image cache key
+_image_prefetches: Dict[str, asyncio.Task] = {}
+
+ANALYSIS_MODEL = 'gemini-2.0-flash'
+ANALYSIS_PROMPT = "Assume I am a business. I want to gain detailed insights about this potential customer (Instagram user) based on their latest post images and corresponding captions. Please examine these post images and captions and return relevant insights about this customer."
+INCREMENTAL_ANALYSIS_PROMPT = "Assume I am a business. Below is an existing profile of a potential customer (Instagram user), built from their earlier posts, followed by images and captions from their newest posts. Update the profile with anything the new posts add or change, and return the complete, updated insights about this customer."
+# Bump when the prompts or the way parts are assembled changes, so cached analyses are not reused
+ANALYSIS_PROMPT_VERSION = "2"
 
 def download_image(url: str) -> bytes:
     """
@@ -29,13 +40,124 @@ def download_image(url: str) -> bytes:
         Image as bytes
     """
     try:
-        response = requests.get(url, timeout=10)
+        response = _session.get(url, timeout=10)
         response.raise_for_status()
         return response.content
     except Exception as e:
-        print(f"Error downloading image from {url}: {str(e)}")
+        logger.warning("Error downloading image from %s: %s", url, e)
         return None
 
+def prefetch_post_image(post: Dict[str, Any]) -> None:
+    """
+    Start downloading a post's display image into the image cache in the
+    background, so fetch_post_images finds it ready. Meant to be called as
+    posts arrive from the scraper.
+    
+    Args:
+        post: Apify post item
+    """
+    key = post_cache_key(post)
+    url = post.get("displayUrl")
+    if not key or not url or key in _image_prefetches:
+        return
+    
+    async def prefetch() -> None:
+        try:
+            cache = get_image_cache()
+            if await cache.aget(key) is None:
+                async with stage_slot("download"):
+                    with track_stage("image_download"):
+                        image_bytes = await get_image_downloader().fetch(url)
+                if image_bytes:
+                    await cache.aput(key, image_bytes)
+        finally:
+            _image_prefetches.pop(key, None)
+    
+    _image_prefetches[key] = asyncio.ensure_future(prefetch())
+
+async def fetch_post_images(posts: List[Dict[str, Any]]) -> List[bytes]:
+    """
+    Get the display image of each post, serving from the image cache where
+    possible and downloading only the misses.
+    
+    Args:
+        posts: Apify post items
+        
+    Returns:
+        Image bytes in post order, with None for posts whose image is unavailable
+    """
+    cache = get_image_cache()
+    keys = [post_cache_key(post) for post in posts]
+    
+    # Let downloads started while the posts were still arriving finish first
+    loop = asyncio.get_running_loop()
+    pending = [_image_prefetches[key] for key in keys if key in _image_prefetches]
+    pending = [task for task in pending if task.get_loop() is loop]
+    if pending:
+        await asyncio.wait(pending, timeout=get_image_downloader().deadline)
+    
+    with span("image_cache_lookup") as attrs:
+        images = list(await asyncio.gather(*[
+            cache.aget(key) if key and post.get("displayUrl") else asyncio.sleep(0)
+            for post, key in zip(posts, keys)
+        ]))
+        attrs["hits"] = sum(1 for image in images if image is not None)
+    
+    missing = [i for i, image in enumerate(images) if image is None and posts[i].get("displayUrl")]
+    if missing:
+        async with stage_slot("download"):
+            with track_stage("image_download"):
+                downloaded = await get_image_downloader().fetch_all([posts[i]["displayUrl"] for i in missing])
+        for i, image_bytes in zip(missing, downloaded):
+            if image_bytes:
+                images[i] = image_bytes
+                await cache.aput(keys[i], image_bytes)
+    
+    return images
+
+async def _prepare_image_traced(image_bytes: bytes, index: int) -> Dict[str, Any]:
+    # The span covers the hand-off to the image worker processes and back
+    with span("image_prepare", post=index) as attrs:
+        prepared = await get_image_executor().prepare(image_bytes)
+        attrs.update({"original_bytes": prepared["original_bytes"], "bytes": prepared["bytes"]})
+        return prepared
+
+async def _post_image_hashes(post: Dict[str, Any], image_bytes: bytes) -> Optional[Dict[str, str]]:
+    # Hashes are kept next to the cached image, so a repeat only costs a lookup
+    cache = get_image_cache()
+    key = post_cache_key(post)
+    hashes = await cache.aget_hashes(key) if key else None
+    if hashes is None:
+        hashes = await get_image_executor().hashes(image_bytes)
+        if hashes is not None and key:
+            await cache.aput_hashes(key, hashes)
+    return hashes
+
+async def group_duplicate_images(posts: List[Dict[str, Any]], images: List[Optional[bytes]]) -> List[List[int]]:
+    """
+    Group posts whose images are near-identical (carousel frames, reposts,
+    video thumbnails) by comparing perceptual hashes, so each picture is
+    sent to Gemini once.
+    
+    Args:
+        posts: Apify post items
+        images: Image bytes in post order, None where unavailable
+        
+    Returns:
+        Groups of post indices in post order; the first post of a group
+        supplies the image. Every post is its own group when IMAGE_DEDUPE is off.
+    """
+    if not DEDUPE_ENABLED:
+        return [[i] for i in range(len(posts))]
+    with span("image_dedupe") as attrs:
+        hashes = await asyncio.gather(*[
+            _post_image_hashes(post, image_bytes) if image_bytes else asyncio.sleep(0)
+            for post, image_bytes in zip(posts, images)
+        ])
+        groups = group_near_duplicates(hashes)
+        attrs["dropped"] = len(posts) - len(groups)
+    return groups
+
 def encode_image_to_base64(image_bytes: bytes) -> str:
     """
     Encode image bytes to base64 string.
@@ -50,78 +172,214 @@ def encode_image_to_base64(image_bytes: bytes) -> str:
         return None
     return base64.b64encode(image_bytes).decode('utf-8')
 
-def analyze_instagram_posts(user_data: Dict[str, Any], save_to_file: bool = False, output_file: str = "analysis_output.json") -> str:
+def _save_analysis_output(output_file: str, output_data: Dict[str, Any]) -> None:
     """
-    Analyze Instagram posts using Gemini Vision API.
+    Write an analysis result (or error) to a JSON file.
     
     Args:
-        user_data: Instagram user data containing posts
-        save_to_file: Whether to save the output to a JSON file
         output_file: Path to the output JSON file
+        output_data: Dictionary to serialize
+    """
+    import json
+    
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(output_data, f, indent=2)
+
+async def build_analysis_request(user_data: Dict[str, Any], stats: Optional[Dict[str, Any]] = None, prompt: str = ANALYSIS_PROMPT, context: Optional[str] = None, token_budget: Optional[int] = None, plan: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Fetch, preprocess and assemble everything needed for the Gemini analysis call.
+    
+    The posts and caption text sent are picked by the content planner to
+    fit the prompt token budget (see plan_posts), unless a plan made by the
+    caller is given.
+    
+    Args:
+        user_data: Instagram user data containing posts
+        stats: Optional dictionary that is filled with per-request statistics
+        prompt: Instruction text placed before the posts
+        context: Optional text placed between the prompt and the posts (e.g. a previous profile)
+        token_budget: Prompt tokens the request may use; the planner's default when None
+        plan: Result of plan_posts to send as is, made with the same prompt and context
         
     Returns:
-        Analysis results from Gemini
+        Dictionary with the Gemini content parts, the LLM cache key, the
+        number of posts considered and their keys, or with an error message
+        when there is nothing to analyze
     """
-    # Initialize Gemini model for multimodal input
-    model = genai.GenerativeModel('gemini-2.0-flash')
-    
     # Extract posts from user data
     posts = user_data.get("data", []) if isinstance(user_data, dict) else user_data
     
     if not posts or len(posts) == 0:
-        return "No posts found in the provided data."
+        return {"error": "No posts found in the provided data."}
+    
+    # Pick the most informative posts and caption text that fit the budget
+    if plan is None:
+        header = [prompt] + ([context] if context else [])
+        plan = plan_posts(posts, token_budget=token_budget, reserved_tokens=estimate_prompt_tokens(header))
+    posts = plan["posts"]
+    if stats is not None:
+        stats.update({
+            "token_budget": plan["token_budget"],
+            "posts_considered": plan["considered"],
+            "posts_selected": plan["selected"],
+            "captions_shortened": plan["captions_shortened"],
+            "hashtags_removed": plan["hashtags_removed"],
+        })
+    if not posts:
+        return {"error": "Could not process any images from the provided posts."}
+    
+    # Get all images concurrently (cache first), keeping them in post order
+    images = await fetch_post_images(posts)
+    
+    # Send each near-identical image once, with the captions of all its posts
+    groups = await group_duplicate_images(posts, images)
+    duplicates = len(posts) - len(groups)
+    if duplicates:
+        IMAGE_DUPLICATES.inc(duplicates)
+        logger.info("Image de-duplication: dropped %d near-identical image(s)", duplicates)
+    kept = [group[0] for group in groups if images[group[0]]]
+    
+    # Downscale, strip metadata and recompress before upload
+    prepared_images = dict(zip(kept, await asyncio.gather(*[
+        _prepare_image_traced(images[i], i) for i in kept
+    ])))
+    for image in prepared_images.values():
+        IMAGE_BYTES.observe(image["original_bytes"], kind="original")
+        IMAGE_BYTES.observe(image["bytes"], kind="sent")
+    original_bytes = sum(image["original_bytes"] for image in prepared_images.values())
+    sent_bytes = sum(image["bytes"] for image in prepared_images.values())
+    if stats is not None:
+        stats.update({
+            "images_sent": len(prepared_images),
+            "images_deduplicated": duplicates,
+            "image_bytes_original": original_bytes,
+            "image_bytes_sent": sent_bytes,
+            "image_bytes_saved": original_bytes - sent_bytes,
+        })
+    if prepared_images:
+        logger.info("Image preprocessing: %d -> %d bytes (%d saved)", original_bytes, sent_bytes, original_bytes - sent_bytes)
     
     # Prepare content parts for Gemini
-    content_parts = [
-        "Assume I am a business. I want to gain detailed insights about this potential customer (Instagram user) based on their latest post images and corresponding captions. Please examine these post images and captions and return relevant insights about this customer."
-    ]
+    content_parts = [prompt]
+    if context:
+        content_parts.append(context)
+    # Raw values of every part, in order, for the cache key
+    key_parts = list(content_parts)
+    header_parts = len(content_parts)
     
     # Add post information to content parts
-    for i, post in enumerate(posts[:5]):  # Limit to 5 posts to be mindful of context
-        # Get display URL and caption
-        display_url = post.get("displayUrl")
-        caption = post.get("caption", "")
-        
-        if display_url:
-            # Download and encode image
-            image_bytes = download_image(display_url)
-            if image_bytes:
-                # Add image to content parts
-                content_parts.append({
-                    "inline_data": {
-                        "mime_type": "image/jpeg",
-                        "data": encode_image_to_base64(image_bytes)
-                    }
-                })
-                
-                # Add caption information
-                content_parts.append(f"Post {i+1} Caption: {caption}")
+    for group in groups:
+        prepared = prepared_images.get(group[0])
+        if prepared is None:
+            continue
+        # Add image to content parts
+        content_parts.append({
+            "inline_data": {
+                "mime_type": prepared["mime_type"],
+                "data": encode_image_to_base64(prepared["data"])
+            }
+        })
+        
+        # Add caption information, one line per post sharing the image
+        content_parts.append("\n".join(f"Post {i+1} Caption: {posts[i].get('caption', '')}" for i in group))
+        key_parts.extend([prepared["data"], content_parts[-1]])
     
     # If no images were successfully processed
-    if len(content_parts) <= 1:
-        return "Could not process any images from the provided posts."
+    if len(content_parts) <= header_parts:
+        return {"error": "Could not process any images from the provided posts."}
     
-    try:
+    # Re-estimated from what is actually sent, after failed downloads and duplicates
+    estimated_tokens = estimate_prompt_tokens(content_parts)
+    if stats is not None:
+        stats["prompt_tokens_estimated"] = estimated_tokens
+    
+    return {
+        "error": None,
+        "content_parts": content_parts,
+        "cache_key": make_cache_key("analysis", ANALYSIS_MODEL, ANALYSIS_PROMPT_VERSION, key_parts),
+        "post_count": len(posts),
+        "post_keys": [post_cache_key(post) for post in posts]
+    }
+
+async def _generate_analysis(request: Dict[str, Any], stats: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Return the analysis for a request built by build_analysis_request, from
+    the LLM cache if possible and from Gemini otherwise. Transient Gemini
+    errors are retried; errors that remain are raised, never cached.
+    
+    Args:
+        request: Result of build_analysis_request
+        stats: Optional dictionary that is filled with per-request statistics
+        
+    Returns:
+        Analysis text
+    """
+    llm_cache = get_llm_cache()
+    result = await llm_cache.aget(request["cache_key"])
+    if stats is not None:
+        stats["analysis_cache"] = "hit" if result is not None else "miss"
+    
+    if result is None:
+        # Shared Gemini model for multimodal input
+        model = get_gemini_model(ANALYSIS_MODEL)
+        
         # Generate content using Gemini
-        response = model.generate_content(content_parts)
+        async with stage_slot("gemini"):
+            with track_stage("gemini_analysis"):
+                response = await generate_content(model, request["content_parts"])
         result = response.text
+        if stats is not None:
+            stats["prompt_tokens_actual"] = prompt_tokens(response)
+        await llm_cache.aput(request["cache_key"], result, "analysis", ANALYSIS_PROMPT_VERSION)
+    
+    return result
+
+async def analyze_instagram_posts_async(user_data: Dict[str, Any], save_to_file: bool = False, output_file: str = "analysis_output.json", stats: Optional[Dict[str, Any]] = None, token_budget: Optional[int] = None) -> str:
+    """
+    Analyze Instagram posts using Gemini Vision API without blocking the event loop.
+    
+    Images come from the image cache or the shared pooled downloader, are
+    downscaled and recompressed, and the Gemini call is awaited with
+    generate_content_async once the shared Gemini quota allows. Responses
+    are stored in the persistent LLM cache, so an identical request (same
+    prompt, captions and images) is answered without calling Gemini.
+    
+    Args:
+        user_data: Instagram user data containing posts
+        save_to_file: Whether to save the output to a JSON file
+        output_file: Path to the output JSON file
+        stats: Optional dictionary that is filled with per-request statistics
+        token_budget: Prompt tokens the analysis may use (see build_analysis_request)
+        
+    Returns:
+        Analysis results from Gemini
+        
+    Raises:
+        Exception: The Gemini error when the call still fails after retries,
+            so it is never mistaken for an analysis
+    """
+    from datetime import datetime
+    
+    # Fetch images and assemble the request
+    request = await build_analysis_request(user_data, stats=stats, token_budget=token_budget)
+    if request["error"]:
+        return request["error"]
+    
+    try:
+        result = await _generate_analysis(request, stats=stats)
         
         # Save to JSON file if requested
         if save_to_file:
-            import json
-            from datetime import datetime
-            
             # Create a dictionary with the analysis result and metadata
             output_data = {
                 "timestamp": datetime.now().isoformat(),
                 "analysis": result,
-                "post_count": min(len(posts), 5)  # Number of posts analyzed
+                "post_count": request["post_count"]  # Number of posts analyzed
             }
             
             # Save to JSON file
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(output_data, f, indent=2)
-                print(f"Analysis saved to {output_file}")
+            await asyncio.to_thread(_save_analysis_output, output_file, output_data)
+            logger.debug("Analysis saved to %s", output_file)
         
         return result
     except Exception as e:
@@ -129,9 +387,6 @@ def analyze_instagram_posts(user_data: Dict[str, Any], save_to_file: bool = Fals
         
         # Save error to JSON file if requested
         if save_to_file:
-            import json
-            from datetime import datetime
-            
             # Create a dictionary with the error message
             output_data = {
                 "timestamp": datetime.now().isoformat(),
@@ -139,11 +394,146 @@ def analyze_instagram_posts(user_data: Dict[str, Any], save_to_file: bool = Fals
             }
             
             # Save to JSON file
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(output_data, f, indent=2)
-                print(f"Error saved to {output_file}")
+            await asyncio.to_thread(_save_analysis_output, output_file, output_data)
+            logger.debug("Error saved to %s", output_file)
+        
+        raise
+
+async def analyze_instagram_posts_incremental_async(user_data: Dict[str, Any], username: str, stats: Optional[Dict[str, Any]] = None, token_budget: Optional[int] = None) -> str:
+    """
+    Analyze only the posts that haven't been analyzed for this user before.
+    
+    The post keys (id/shortCode) already reflected in the user's stored
+    profile are remembered. New posts are sent to Gemini together with the
+    previous profile, which is updated and stored again. When there are no
+    new posts the stored profile is returned without calling Gemini. The
+    first run for a user (with no stored state or earlier full-service
+    outputs to seed from) is a normal full analysis. Only posts the content
+    planner selects within the budget count as new; the others are skipped.
+    
+    Args:
+        user_data: Instagram user data containing posts
+        username: Instagram username the state is stored under
+        stats: Optional dictionary that is filled with per-request statistics
+        token_budget: Prompt tokens the analysis may use (see build_analysis_request)
+        
+    Returns:
+        Analysis results from Gemini, or the stored profile when nothing changed
+    """
+    stats = {} if stats is None else stats
+    posts = user_data.get("data", []) if isinstance(user_data, dict) else user_data
+    
+    store = get_analysis_state_store()
+    state = await store.aget(username)
+    if state is None:
+        state = await asyncio.to_thread(load_state_from_outputs, username)
+    
+    # Plan with the previous profile counted against the budget, so every new post selected also fits in the update
+    prompt = INCREMENTAL_ANALYSIS_PROMPT if state else ANALYSIS_PROMPT
+    context = f"Existing profile: {state['analysis']}" if state else None
+    header = [prompt] + ([context] if context else [])
+    plan = plan_posts(posts or [], token_budget=token_budget, reserved_tokens=estimate_prompt_tokens(header))
+    posts = plan["posts"]
+    
+    known_keys = set(state["post_keys"]) if state else set()
+    new_posts = [post for post in posts if post_cache_key(post) not in known_keys]
+    stats["incremental"] = {
+        "previous_state": state is not None,
+        "new_posts": len(new_posts),
+        "known_posts": len(posts) - len(new_posts),
+        "skipped_model_call": False
+    }
+    
+    if state and not new_posts:
+        stats["incremental"]["skipped_model_call"] = True
+        return state["analysis"]
+    
+    # The new posts are a subset of the plan, so they fit without planning again
+    plan = {**plan, "posts": new_posts, "selected": len(new_posts)}
+    request = await build_analysis_request(new_posts, stats=stats, prompt=prompt, context=context, plan=plan)
+    if request["error"]:
+        # New posts without usable images add nothing to the existing profile
+        return state["analysis"] if state else request["error"]
+    
+    # Gemini errors are raised, leaving the stored profile untouched
+    result = await _generate_analysis(request, stats=stats)
+    
+    analyzed_keys = [key for key in request["post_keys"] if key]
+    previous_keys = [key for key in (state["post_keys"] if state else []) if key not in analyzed_keys]
+    await store.aput(username, analyzed_keys + previous_keys, result)
+    return result
+
+async def analyze_instagram_posts_stream(user_data: Dict[str, Any], stats: Optional[Dict[str, Any]] = None, token_budget: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Analyze Instagram posts, yielding progress events as they happen.
+    
+    Events are dictionaries with an "event" key:
+    - images_ready: images were fetched and preprocessed (carries the stats)
+    - analysis_chunk: a piece of the analysis text as Gemini streams it
+    - analysis_complete: the full analysis text
+    - error: nothing could be analyzed, or Gemini failed
+    
+    A cached analysis is emitted as a single chunk. Completed analyses are
+    stored in the LLM cache exactly like analyze_instagram_posts_async.
+    
+    Args:
+        user_data: Instagram user data containing posts
+        stats: Optional dictionary that is filled with per-request statistics
+        token_budget: Prompt tokens the analysis may use (see build_analysis_request)
         
-        return error_msg
+    Yields:
+        Progress event dictionaries
+    """
+    stats = {} if stats is None else stats
+    request = await build_analysis_request(user_data, stats=stats, token_budget=token_budget)
+    if request["error"]:
+        yield {"event": "error", "stage": "images", "detail": request["error"]}
+        return
+    yield {"event": "images_ready", "post_count": request["post_count"], "stats": dict(stats)}
+    
+    llm_cache = get_llm_cache()
+    result = await llm_cache.aget(request["cache_key"])
+    stats["analysis_cache"] = "hit" if result is not None else "miss"
+    if result is not None:
+        yield {"event": "analysis_chunk", "text": result}
+        yield {"event": "analysis_complete", "analysis": result, "cached": True}
+        return
+    
+    chunks = []
+    usage = {}
+    try:
+        model = get_gemini_model(ANALYSIS_MODEL)
+        # The Gemini slot is released once the response is read, however slowly the client reads
+        async for text in stream_content(model, request["content_parts"], "gemini_analysis", usage=usage):
+            chunks.append(text)
+            yield {"event": "analysis_chunk", "text": text}
+        stats["prompt_tokens_actual"] = usage.get("prompt_tokens")
+    except Exception as e:
+        yield {"event": "error", "stage": "analysis", "detail": f"Error analyzing posts with Gemini: {str(e)}"}
+        return
+    
+    result = "".join(chunks)
+    await llm_cache.aput(request["cache_key"], result, "analysis", ANALYSIS_PROMPT_VERSION)
+    yield {"event": "analysis_complete", "analysis": result, "cached": False}
+
+def analyze_instagram_posts(user_data: Dict[str, Any], save_to_file: bool = False, output_file: str = "analysis_output.json", stats: Optional[Dict[str, Any]] = None, token_budget: Optional[int] = None) -> str:
+    """
+    Analyze Instagram posts using Gemini Vision API.
+    
+    Synchronous wrapper around analyze_instagram_posts_async for scripts and
+    the CLI. Must not be called from inside a running event loop.
+    
+    Args:
+        user_data: Instagram user data containing posts
+        save_to_file: Whether to save the output to a JSON file
+        output_file: Path to the output JSON file
+        stats: Optional dictionary that is filled with per-request statistics
+        token_budget: Prompt tokens the analysis may use (see build_analysis_request)
+        
+    Returns:
+        Analysis results from Gemini
+    """
+    return asyncio.run(analyze_instagram_posts_async(user_data, save_to_file=save_to_file, output_file=output_file, stats=stats, token_budget=token_budget))
 
 def test_with_sample_data(save_to_file: bool = True, output_file: str = "analysis_output.json"):
     """
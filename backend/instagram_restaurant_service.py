@@ -1,18 +1,49 @@
 import os
 import json
+import asyncio
+import time
 import requests
 from datetime import datetime
-from typing import Dict, Any, List, Optional, Tuple
-from apify_client import ApifyClient
+from typing import AsyncIterator, Dict, Any, List, Optional, Tuple
 
 # Import services
-from instagram_analysis import analyze_instagram_posts
-from restaurant_recommendations import get_restaurant_recommendations
+from content_planner import token_budget_for
+from instagram_analysis import analyze_instagram_posts_async, analyze_instagram_posts_incremental_async, analyze_instagram_posts_stream, prefetch_post_image
+from jobs import PRIORITY_BATCH, reset_priority, use_priority
+from metrics import get_logger
+from posts import posts_to_dicts
+from profile_fetcher import fetch_instagram_profile
+from restaurant_recommendations import get_restaurant_recommendations_async, stream_restaurant_recommendations
+from results_store import get_result_store
+from singleflight import SingleFlight
+from stage_limits import StageLimits, reset_stage_limits, use_stage_limits
+from tracing import span, start_trace
+
+logger = get_logger("instagram_restaurant_service")
+
+# Concurrent requests for the same username share one analysis / recommendation run
+_analysis_flight = SingleFlight("analysis")
+_recommendations_flight = SingleFlight("recommendations")
+
+async def get_instagram_data_async(username: str, refresh: bool = False, prefetch_images: bool = False) -> Dict[str, Any]:
+    """
+    Retrieve Instagram data for a given username through the shared,
+    cached profile fetcher.
+    
+    Args:
+        username: Instagram username to fetch data for
+        refresh: Bypass the profile cache and scrape now
+        prefetch_images: Start downloading post images as posts arrive from the scraper
+        
+    Returns:
+        Dictionary with Instagram profile data
+    """
+    return await fetch_instagram_profile(username, refresh=refresh, on_post=prefetch_post_image if prefetch_images else None)
 
 def get_instagram_data(username: str) -> Dict[str, Any]:
     """
     Retrieve Instagram data for a given username using Apify API.
-    This is a copy of the function from main.py to avoid circular imports.
+    Synchronous wrapper around get_instagram_data_async.
     
     Args:
         username: Instagram username to fetch data for
@@ -20,41 +51,421 @@ def get_instagram_data(username: str) -> Dict[str, Any]:
     Returns:
         Dictionary with Instagram profile data
     """
-    # Initialize the ApifyClient with API token
-    client = ApifyClient("apify_api_NijTGDp3Pvbbd0dydzaDP9g4O78tnG3EHHSN")
-    
-    # Prepare the Actor input
-    run_input = {
-        "directUrls": [f"https://www.instagram.com/{username}"],
-        "resultsType": "posts",
-        "resultsLimit": 5,
-        "searchType": "hashtag",
-        "searchLimit": 1,
-        "addParentData": False,
+    return asyncio.run(get_instagram_data_async(username))
+
+async def analyze_user_async(username: str, refresh: bool = False, incremental: bool = False, token_budget: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Fetch and analyze a user's posts. Concurrent calls for the same username
+    wait on a single shared run instead of each scraping and calling Gemini.
+    
+    Args:
+        username: Instagram username to analyze
+        refresh: Bypass the profile cache and scrape now
+        incremental: Only send posts that weren't analyzed before, merged into the stored profile
+        token_budget: Prompt tokens the analysis may use (default: the content planner's)
+        
+    Returns:
+        Dictionary with the Instagram data, the analysis text and per-request statistics.
+        The dictionary may be shared between callers and must not be mutated.
+    """
+    async def run() -> Dict[str, Any]:
+        with span("profile_fetch", username=username) as attrs:
+            instagram_data = await get_instagram_data_async(username, refresh=refresh, prefetch_images=True)
+            attrs["cache"] = instagram_data.get("cache")
+        stats = {"profile_cache": instagram_data.get("cache")}
+        with span("analysis", incremental=incremental):
+            if incremental:
+                analysis = await analyze_instagram_posts_incremental_async(instagram_data, username, stats=stats, token_budget=token_budget)
+            else:
+                analysis = await analyze_instagram_posts_async(instagram_data, stats=stats, token_budget=token_budget)
+        return {
+            "username": username,
+            "instagram_data": instagram_data,
+            "analysis": analysis,
+            "stats": stats
+        }
+    
+    return await _analysis_flight.do((username.lower(), refresh, incremental, token_budget), run)
+
+async def recommend_for_user_async(username: str, refresh: bool = False, incremental: bool = False, token_budget: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Analyze a user and generate restaurant recommendations. Concurrent calls
+    for the same username wait on a single shared run.
+    
+    Args:
+        username: Instagram username to analyze
+        refresh: Bypass the profile cache and scrape now
+        incremental: Only send posts that weren't analyzed before, merged into the stored profile
+        token_budget: Prompt tokens the analysis may use (default: the content planner's)
+        
+    Returns:
+        Dictionary with the analysis result (see analyze_user_async) and the recommendations.
+        The dictionary may be shared between callers and must not be mutated.
+    """
+    async def run() -> Dict[str, Any]:
+        analysis_result = await analyze_user_async(username, refresh=refresh, incremental=incremental, token_budget=token_budget)
+        recommendations = await get_restaurant_recommendations_async(analysis_result["analysis"])
+        return {**analysis_result, "recommendations": recommendations}
+    
+    return await _recommendations_flight.do((username.lower(), refresh, incremental, token_budget), run)
+
+async def stream_recommendations_from_instagram(username: str, refresh: bool = False, token_budget: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Run the full pipeline, yielding an event as each stage completes so
+    clients can render progress and partial results.
+    
+    Events, in order: posts_fetched, images_ready, analysis_chunk (repeated),
+    analysis_complete, recommendation (one per restaurant), then done.
+    An error event ends the stream early. Completed runs are recorded in
+    the result store; nothing is exported to files.
+    
+    Args:
+        username: Instagram username to analyze
+        refresh: Bypass the profile cache and scrape now
+        token_budget: Prompt tokens the analysis may use (default: the content planner's)
+        
+    Yields:
+        Event dictionaries with an "event" key
+    """
+    try:
+        instagram_data = await get_instagram_data_async(username, refresh=refresh, prefetch_images=True)
+    except Exception as e:
+        yield {"event": "error", "stage": "posts", "detail": f"Error fetching Instagram data: {str(e)}"}
+        return
+    stats = {"profile_cache": instagram_data.get("cache")}
+    yield {
+        "event": "posts_fetched",
+        "username": username,
+        "post_count": len(instagram_data.get("data", [])),
+        "cache": instagram_data.get("cache")
     }
     
-    # Run the Actor and wait for it to finish
-    run = client.actor("shu8hvrXbJbY3Eb9W").call(run_input=run_input)
+    analysis = None
+    async for event in analyze_instagram_posts_stream(instagram_data, stats=stats, token_budget=token_budget):
+        yield event
+        if event["event"] == "error":
+            return
+        if event["event"] == "analysis_complete":
+            analysis = event["analysis"]
     
-    # Fetch Actor results from the run's dataset
-    results = list(client.dataset(run["defaultDatasetId"]).iterate_items())
+    recommendations = []
+    try:
+        async for recommendation in stream_restaurant_recommendations(analysis):
+            recommendations.append(recommendation)
+            yield {"event": "recommendation", "index": len(recommendations) - 1, "recommendation": recommendation}
+    except Exception as e:
+        yield {"event": "error", "stage": "recommendations", "detail": f"Error generating restaurant recommendations: {str(e)}"}
+        return
     
-    return {"username": username, "data": results}
+    stats["result_id"] = get_result_store().write(username, {
+        "instagram_data": _serializable_instagram_data(instagram_data),
+        "analysis": analysis,
+        "recommendations": recommendations
+    })
+    yield {"event": "done", "username": username, "recommendations": recommendations, "stats": stats}
 
+def resolve_batch_settings(concurrency: Optional[int] = None, stage_concurrency: Optional[Dict[str, int]] = None, token_budget: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Fill in batch concurrency and budget settings that weren't given from the environment.
+    
+    Environment variables:
+        BATCH_CONCURRENCY: Users processed at once
+        BATCH_APIFY_CONCURRENCY: Apify actor runs at once
+        BATCH_DOWNLOAD_CONCURRENCY: Users downloading images at once
+        BATCH_GEMINI_CONCURRENCY: Gemini calls at once
+        CONTENT_TOKEN_BUDGET_BATCH: Prompt tokens per analysis (see token_budget_for)
+    
+    Args:
+        concurrency: Users processed at once
+        stage_concurrency: Per-stage limits, keyed by "apify", "download" and "gemini"
+        token_budget: Prompt tokens per analysis
+        
+    Returns:
+        Dictionary with concurrency, stage_concurrency and token_budget
+    """
+    stages = {
+        "apify": int(os.getenv("BATCH_APIFY_CONCURRENCY", "4")),
+        "download": int(os.getenv("BATCH_DOWNLOAD_CONCURRENCY", "8")),
+        "gemini": int(os.getenv("BATCH_GEMINI_CONCURRENCY", "4")),
+    }
+    stages.update({stage: limit for stage, limit in (stage_concurrency or {}).items() if limit})
+    return {
+        "concurrency": concurrency or int(os.getenv("BATCH_CONCURRENCY", "8")),
+        "stage_concurrency": stages,
+        "token_budget": token_budget_for("batch", token_budget)
+    }
 
-def get_recommendations_from_instagram(
+async def _run_batch_user(
+    index: int,
+    username: str,
+    refresh: bool,
+    incremental: bool,
+    token_budget: Optional[int],
+    save_outputs: bool,
+    output_dir: str
+) -> Dict[str, Any]:
+    """
+    Run the pipeline for one batch entry, turning failures into an error result.
+    Like a single full-service run, the outcome (or the error) is recorded in
+    the result store and optionally exported to files.
+    """
+    started = time.monotonic()
+    stats = {}
+    output_files = {}
+    try:
+        recommendations, output_files = await get_recommendations_from_instagram_async(
+            username,
+            save_outputs=save_outputs,
+            output_dir=output_dir,
+            stats=stats,
+            refresh=refresh,
+            incremental=incremental,
+            token_budget=token_budget,
+            output_files=output_files,
+            raise_errors=True
+        )
+        return {
+            "index": index,
+            "username": username,
+            "status": "ok" if recommendations else "empty",
+            "recommendations": recommendations,
+            "error": None,
+            "stats": stats,
+            "output_files": output_files,
+            "duration_seconds": round(time.monotonic() - started, 3)
+        }
+    except Exception as e:
+        return {
+            "index": index,
+            "username": username,
+            "status": "error",
+            "recommendations": [],
+            "error": str(e),
+            "stats": stats,
+            "output_files": output_files,
+            "duration_seconds": round(time.monotonic() - started, 3)
+        }
+
+async def run_batch_async(
+    usernames: List[str],
+    concurrency: Optional[int] = None,
+    stage_concurrency: Optional[Dict[str, int]] = None,
+    refresh: bool = False,
+    incremental: bool = False,
+    token_budget: Optional[int] = None,
+    save_outputs: bool = False,
+    output_dir: str = "outputs"
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Run the full pipeline for many usernames with a bounded worker pool,
+    yielding each user's result as soon as it finishes.
+    
+    At most `concurrency` users are in flight, and each stage (apify,
+    download, gemini) is additionally capped by stage_concurrency, so
+    throughput scales with the settings rather than with the list length.
+    A failing account yields an error result and does not stop the batch.
+    Every result is recorded in the result store (see stats.result_id).
+    
+    Args:
+        usernames: Instagram usernames to process
+        concurrency: Users processed at once
+        stage_concurrency: Per-stage limits, keyed by "apify", "download" and "gemini"
+        refresh: Bypass the profile cache and scrape now
+        incremental: Only send posts that weren't analyzed before, merged into the stored profile
+        token_budget: Prompt tokens per analysis
+        save_outputs: Also export each user's outputs to files
+        output_dir: Directory to save output files
+        
+    Yields:
+        Per-user result dictionaries, in completion order
+    """
+    settings = resolve_batch_settings(concurrency, stage_concurrency, token_budget)
+    
+    pending: asyncio.Queue = asyncio.Queue()
+    for index, username in enumerate(usernames):
+        pending.put_nowait((index, username))
+    finished: asyncio.Queue = asyncio.Queue()
+    
+    async def worker() -> None:
+        while True:
+            try:
+                index, username = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await finished.put(await _run_batch_user(
+                index, username, refresh, incremental, settings["token_budget"], save_outputs, output_dir
+            ))
+    
+    # Workers copy the current context when created, so they all share these
+    # limits and run at batch priority (behind interactive Gemini calls)
+    token = use_stage_limits(StageLimits(settings["stage_concurrency"]))
+    priority_token = use_priority(PRIORITY_BATCH)
+    try:
+        workers = [asyncio.ensure_future(worker()) for _ in range(min(settings["concurrency"], len(usernames)))]
+    finally:
+        reset_priority(priority_token)
+        reset_stage_limits(token)
+    
+    try:
+        for _ in range(len(usernames)):
+            yield await finished.get()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+def summarize_batch(results: List[Dict[str, Any]], duration_seconds: float, settings: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Build the summary block for a finished batch.
+    
+    Args:
+        results: Per-user results from run_batch_async
+        duration_seconds: Wall-clock duration of the batch
+        settings: Result of resolve_batch_settings for the batch
+        
+    Returns:
+        Dictionary with counts per status, duration, throughput and the settings used
+    """
+    return {
+        "total": len(results),
+        "ok": sum(1 for result in results if result["status"] == "ok"),
+        "empty": sum(1 for result in results if result["status"] == "empty"),
+        "errors": sum(1 for result in results if result["status"] == "error"),
+        "failed_usernames": [result["username"] for result in results if result["status"] == "error"],
+        "duration_seconds": round(duration_seconds, 3),
+        "users_per_second": round(len(results) / duration_seconds, 3) if duration_seconds > 0 else None,
+        **settings
+    }
+
+async def run_full_service_job(params: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Job handler for "full-service" jobs.
+    
+    Args:
+        params: username plus optional save_outputs, output_dir, refresh, incremental and token_budget
+        
+    Returns:
+        Same body as the /instagram/{username}/full-service route, plus the
+        run's trace summary under "timings"
+    """
+    stats = {}
+    with start_trace("job full-service") as trace:
+        recommendations, output_files = await get_recommendations_from_instagram_async(
+            username=params["username"],
+            save_outputs=params.get("save_outputs", False),
+            output_dir=params.get("output_dir", "outputs"),
+            stats=stats,
+            refresh=params.get("refresh", False),
+            incremental=params.get("incremental", False),
+            token_budget=token_budget_for("full_service", params.get("token_budget"))
+        )
+    return {
+        "username": params["username"],
+        "recommendations": recommendations,
+        "output_files": output_files,
+        "stats": stats,
+        "timings": trace.summary()
+    }
+
+async def run_analysis_job(params: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Job handler for "analysis" jobs.
+    
+    Args:
+        params: username plus optional refresh, incremental and token_budget
+        
+    Returns:
+        Same body as the /instagram/{username}/analysis route, plus the
+        run's trace summary under "timings"
+    """
+    with start_trace("job analysis") as trace:
+        result = await analyze_user_async(
+            params["username"],
+            refresh=params.get("refresh", False),
+            incremental=params.get("incremental", False),
+            token_budget=token_budget_for("analysis", params.get("token_budget"))
+        )
+    return {
+        "username": params["username"],
+        "analysis": result["analysis"],
+        "stats": dict(result["stats"]),
+        "cache": result["instagram_data"].get("cache"),
+        "timings": trace.summary()
+    }
+
+def _serializable_instagram_data(instagram_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Copy of profile data with its Posts converted to plain dictionaries.
+    """
+    return {**instagram_data, "data": posts_to_dicts(instagram_data.get("data", []))}
+
+def _save_json(path: str, data: Dict[str, Any]) -> None:
+    """
+    Write a dictionary to a pretty-printed JSON file.
+    
+    Args:
+        path: Path to the output JSON file
+        data: Dictionary to serialize
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+
+async def run_recommendations_job(params: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Job handler for "recommendations" jobs.
+    
+    Args:
+        params: username plus optional refresh, incremental and token_budget
+        
+    Returns:
+        Same body as the /instagram/{username}/restaurant-recommendations
+        route, plus the run's trace summary under "timings"
+    """
+    with start_trace("job recommendations") as trace:
+        result = await recommend_for_user_async(
+            params["username"],
+            refresh=params.get("refresh", False),
+            incremental=params.get("incremental", False),
+            token_budget=token_budget_for("analysis", params.get("token_budget"))
+        )
+    return {
+        "username": params["username"],
+        "recommendations": result["recommendations"],
+        "cache": result["instagram_data"].get("cache"),
+        "timings": trace.summary()
+    }
+
+async def get_recommendations_from_instagram_async(
     username: str, 
     save_outputs: bool = True,
-    output_dir: str = "outputs"
+    output_dir: str = "outputs",
+    stats: Optional[Dict[str, Any]] = None,
+    refresh: bool = False,
+    incremental: bool = False,
+    store_results: bool = True,
+    token_budget: Optional[int] = None,
+    output_files: Optional[Dict[str, str]] = None,
+    raise_errors: bool = False
 ) -> Tuple[List[Dict[str, str]], Dict[str, str]]:
     """
     Main function that connects all services to get restaurant recommendations
-    based on Instagram user analysis.
+    based on Instagram user analysis. Every stage is awaited, so the event
+    loop stays free for other requests while Apify and Gemini are working.
     
     Args:
         username: Instagram username to analyze
-        save_outputs: Whether to save intermediate and final outputs to files
+        save_outputs: Whether to also export intermediate and final outputs to files
         output_dir: Directory to save output files
+        stats: Optional dictionary that is filled with per-request statistics
+            (including result_id, the run's id in the result store)
+        refresh: Bypass the profile cache and scrape now
+        incremental: Only send posts that weren't analyzed before, merged into the stored profile
+        store_results: Whether to record the outputs in the result store
+        token_budget: Prompt tokens the analysis may use (default: the content planner's)
+        output_files: Optional dictionary that is filled with the paths written,
+            also when the run fails
+        raise_errors: Re-raise a failure after recording it, instead of
+            returning no recommendations
         
     Returns:
         Tuple containing:
@@ -62,61 +473,68 @@ def get_recommendations_from_instagram(
         - Dictionary with paths to all generated output files
     """
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_files = {}
+    output_files = {} if output_files is None else output_files
     
     # Create output directory if it doesn't exist and save_outputs is True
     if save_outputs:
         os.makedirs(output_dir, exist_ok=True)
     
     try:
-        # Step 1: Get Instagram data
-        print(f"Fetching Instagram data for user: {username}")
-        instagram_data = get_instagram_data(username)
+        # Steps 1-3: Get Instagram data, analyze it and generate recommendations.
+        # This is shared with any concurrent request for the same username.
+        logger.info("Fetching, analyzing and recommending for Instagram user: %s", username)
+        result = await recommend_for_user_async(username, refresh=refresh, incremental=incremental, token_budget=token_budget)
+        instagram_data = _serializable_instagram_data(result["instagram_data"])
+        analysis_result = result["analysis"]
+        recommendations = result["recommendations"]
+        if stats is not None:
+            stats.update(result["stats"])
         
-        if save_outputs:
-            instagram_data_file = f"{output_dir}/{username}_instagram_data_{timestamp}.json"
-            with open(instagram_data_file, 'w', encoding='utf-8') as f:
-                json.dump(instagram_data, f, indent=2)
-            output_files["instagram_data"] = instagram_data_file
-            print(f"Instagram data saved to {instagram_data_file}")
-        
-        # Step 2: Analyze Instagram posts
-        print(f"Analyzing Instagram posts for user: {username}")
-        analysis_result = analyze_instagram_posts(instagram_data)
+        if store_results:
+            # Queued for the store's writer thread; doesn't wait on disk
+            result_id = get_result_store().write(username, {
+                "instagram_data": instagram_data,
+                "analysis": analysis_result,
+                "recommendations": recommendations
+            })
+            if stats is not None:
+                stats["result_id"] = result_id
         
         if save_outputs:
+            instagram_data_file = f"{output_dir}/{username}_instagram_data_{timestamp}.json"
             analysis_file = f"{output_dir}/{username}_analysis_{timestamp}.json"
+            recommendations_file = f"{output_dir}/{username}_recommendations_{timestamp}.json"
             analysis_data = {
                 "timestamp": datetime.now().isoformat(),
                 "username": username,
                 "analysis": analysis_result
             }
-            with open(analysis_file, 'w', encoding='utf-8') as f:
-                json.dump(analysis_data, f, indent=2)
-            output_files["analysis"] = analysis_file
-            print(f"Analysis saved to {analysis_file}")
-        
-        # Step 3: Generate restaurant recommendations
-        print(f"Generating restaurant recommendations based on analysis")
-        recommendations = get_restaurant_recommendations(analysis_result)
-        
-        if save_outputs:
-            recommendations_file = f"{output_dir}/{username}_recommendations_{timestamp}.json"
             recommendations_data = {
                 "timestamp": datetime.now().isoformat(),
                 "username": username,
                 "recommendations": recommendations
             }
-            with open(recommendations_file, 'w', encoding='utf-8') as f:
-                json.dump(recommendations_data, f, indent=2)
+            with span("save_outputs"):
+                await asyncio.gather(
+                    asyncio.to_thread(_save_json, instagram_data_file, instagram_data),
+                    asyncio.to_thread(_save_json, analysis_file, analysis_data),
+                    asyncio.to_thread(_save_json, recommendations_file, recommendations_data)
+                )
+            output_files["instagram_data"] = instagram_data_file
+            output_files["analysis"] = analysis_file
             output_files["recommendations"] = recommendations_file
-            print(f"Recommendations saved to {recommendations_file}")
+            logger.debug("Outputs saved to %s: %s", output_dir, ", ".join(output_files.values()))
         
         return recommendations, output_files
     
     except Exception as e:
         error_msg = f"Error in get_recommendations_from_instagram: {str(e)}"
-        print(error_msg)
+        logger.warning(error_msg)
+        
+        if store_results:
+            result_id = get_result_store().write(username, {"error": error_msg})
+            if stats is not None:
+                stats["result_id"] = result_id
         
         if save_outputs:
             error_file = f"{output_dir}/{username}_error_{timestamp}.json"
@@ -125,13 +543,42 @@ def get_recommendations_from_instagram(
                 "username": username,
                 "error": error_msg
             }
-            with open(error_file, 'w', encoding='utf-8') as f:
-                json.dump(error_data, f, indent=2)
+            await asyncio.to_thread(_save_json, error_file, error_data)
             output_files["error"] = error_file
-            print(f"Error saved to {error_file}")
+            logger.debug("Error saved to %s", error_file)
         
+        if raise_errors:
+            raise
         return [], output_files
 
+def get_recommendations_from_instagram(
+    username: str, 
+    save_outputs: bool = True,
+    output_dir: str = "outputs",
+    incremental: bool = False
+) -> Tuple[List[Dict[str, str]], Dict[str, str]]:
+    """
+    Synchronous wrapper around get_recommendations_from_instagram_async, kept
+    for the CLI and scripts. Must not be called from inside a running event loop.
+    
+    Args:
+        username: Instagram username to analyze
+        save_outputs: Whether to save intermediate and final outputs to files
+        output_dir: Directory to save output files
+        incremental: Only send posts that weren't analyzed before, merged into the stored profile
+        
+    Returns:
+        Tuple containing:
+        - List of restaurant recommendations
+        - Dictionary with paths to all generated output files
+    """
+    return asyncio.run(get_recommendations_from_instagram_async(
+        username=username,
+        save_outputs=save_outputs,
+        output_dir=output_dir,
+        incremental=incremental
+    ))
+
 def main():
     """
     Main entry point for the Instagram Restaurant Recommendation service.
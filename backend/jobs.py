@@ -0,0 +1,507 @@
+import asyncio
+import contextvars
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from metrics import get_logger
+
+logger = get_logger("jobs")
+
+JobHandler = Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]
+
+TERMINAL_STATUSES = ("succeeded", "failed", "cancelled")
+
+# Priority classes; higher runs first
+PRIORITY_INTERACTIVE = 10
+PRIORITY_DEFAULT = 0
+PRIORITY_BATCH = -10
+
+_current_priority: contextvars.ContextVar[int] = contextvars.ContextVar("priority", default=PRIORITY_DEFAULT)
+
+def current_priority() -> int:
+    """
+    Return the priority of the work running in this context (PRIORITY_DEFAULT if none was set).
+    """
+    return _current_priority.get()
+
+def use_priority(priority: int) -> contextvars.Token:
+    """
+    Run the current context, and every task started from it, at a priority.
+    Shared resources such as the Gemini quota serve higher priorities first.
+
+    Args:
+        priority: e.g. PRIORITY_INTERACTIVE or PRIORITY_BATCH
+
+    Returns:
+        Token that can be passed to reset_priority
+    """
+    return _current_priority.set(priority)
+
+def reset_priority(token: contextvars.Token) -> None:
+    """
+    Restore the priority that was in effect before use_priority.
+    """
+    _current_priority.reset(token)
+
+class JobQueue:
+    """
+    Durable job queue backed by SQLite.
+
+    Jobs are claimed with a lease that the running worker keeps renewing. If
+    a process dies mid-job, the lease runs out and another worker (or the
+    same process after a restart) picks the job up again, so nothing is lost
+    across restarts. Several processes on the same host can share the file.
+    A job whose lease has run out max_attempts times (it keeps taking its
+    worker down) is failed instead of being claimed again.
+    """
+
+    def __init__(self, path: str = "cache/jobs.sqlite3", lease_seconds: float = 60, max_attempts: int = 3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                params TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                lease_until REAL,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (status, priority DESC, created_at)")
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        job["cancel_requested"] = bool(job["cancel_requested"])
+        return job
+
+    def submit(self, kind: str, params: Dict[str, Any], priority: int = PRIORITY_DEFAULT, claimed: bool = False) -> Dict[str, Any]:
+        """
+        Add a job to the queue.
+
+        Args:
+            kind: Name of a registered handler
+            params: JSON-serializable handler parameters
+            priority: Higher priorities are claimed first
+            claimed: Store the job as already claimed by the caller, who
+                must run it and keep its lease renewed
+
+        Returns:
+            The stored job
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            if claimed:
+                self._conn.execute(
+                    "INSERT INTO jobs (id, kind, params, priority, status, created_at, attempts, started_at, lease_until) "
+                    "VALUES (?, ?, ?, ?, 'running', ?, 1, ?, ?)",
+                    (job_id, kind, json.dumps(params), priority, now, now, now + self.lease_seconds),
+                )
+            else:
+                self._conn.execute(
+                    "INSERT INTO jobs (id, kind, params, priority, status, created_at) VALUES (?, ?, ?, ?, 'queued', ?)",
+                    (job_id, kind, json.dumps(params), priority, now),
+                )
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up a job by id.
+
+        Returns:
+            The job, or None if it doesn't exist
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row is not None else None
+
+    def list(self, status: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """
+        List the most recent jobs, optionally filtered by status.
+        """
+        query = "SELECT * FROM jobs"
+        params: List[Any] = []
+        if status:
+            query += " WHERE status = ?"
+            params.append(status)
+        query += " ORDER BY created_at DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def claim(self, kinds: List[str]) -> Optional[Dict[str, Any]]:
+        """
+        Atomically take the highest-priority runnable job: a queued job, or a
+        running job whose worker stopped renewing its lease and that has
+        attempts left. Expired jobs without attempts left are failed, and
+        expired jobs whose cancellation was requested are cancelled.
+
+        Args:
+            kinds: Job kinds this worker can run
+
+        Returns:
+            The claimed job, or None if there is nothing to do
+        """
+        if not kinds:
+            return None
+        now = time.time()
+        placeholders = ",".join("?" for _ in kinds)
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock up front so two processes can't claim the same job
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # The worker that would have seen the cancellation request is gone
+                self._conn.execute(
+                    f"""
+                    UPDATE jobs SET status = 'cancelled', finished_at = ?, lease_until = NULL
+                    WHERE kind IN ({placeholders}) AND status = 'running' AND lease_until < ? AND cancel_requested = 1
+                    """,
+                    (now, *kinds, now),
+                )
+                self._conn.execute(
+                    f"""
+                    UPDATE jobs SET status = 'failed', error = ?, finished_at = ?, lease_until = NULL
+                    WHERE kind IN ({placeholders}) AND status = 'running' AND lease_until < ? AND attempts >= ?
+                    """,
+                    (f"Gave up after {self.max_attempts} attempts", now, *kinds, now, self.max_attempts),
+                )
+                row = self._conn.execute(
+                    f"""
+                    SELECT id FROM jobs
+                    WHERE kind IN ({placeholders})
+                      AND cancel_requested = 0
+                      AND (status = 'queued' OR (status = 'running' AND lease_until < ?))
+                    ORDER BY priority DESC, created_at
+                    LIMIT 1
+                    """,
+                    (*kinds, now),
+                ).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ?, lease_until = ? WHERE id = ?",
+                    (now, now + self.lease_seconds, row["id"]),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return self.get(row["id"])
+
+    def renew(self, job_id: str) -> bool:
+        """
+        Extend a running job's lease.
+
+        Returns:
+            True if cancellation of the job has been requested
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND status = 'running'",
+                (time.time() + self.lease_seconds, job_id),
+            )
+            row = self._conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row["cancel_requested"])
+
+    def finish(self, job_id: str, status: str, result: Optional[Dict[str, Any]] = None, error: Optional[str] = None) -> None:
+        """
+        Record a job's outcome.
+
+        Args:
+            job_id: Job id
+            status: One of TERMINAL_STATUSES
+            result: Handler result for succeeded jobs
+            error: Error message for failed jobs
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, lease_until = NULL WHERE id = ?",
+                (status, json.dumps(result) if result is not None else None, error, time.time(), job_id),
+            )
+
+    def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Cancel a job. Queued jobs are cancelled immediately; running jobs are
+        flagged and stopped by their worker at the next lease renewal.
+
+        Returns:
+            The updated job, or None if it doesn't exist
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'cancelled', cancel_requested = 1, finished_at = ? WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id),
+            )
+            self._conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,))
+        return self.get(job_id)
+
+    def purge(self, older_than_seconds: float) -> int:
+        """
+        Delete finished jobs older than the given age.
+
+        Returns:
+            Number of jobs deleted
+        """
+        placeholders = ",".join("?" for _ in TERMINAL_STATUSES)
+        with self._lock:
+            return self._conn.execute(
+                f"DELETE FROM jobs WHERE status IN ({placeholders}) AND finished_at < ?",
+                (*TERMINAL_STATUSES, time.time() - older_than_seconds),
+            ).rowcount
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return job counts per status.
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+class JobWorkerPool:
+    """
+    Async workers that pull jobs from a JobQueue and run registered handlers.
+
+    Jobs can also be run in the calling task with run(), which doesn't wait
+    for a free worker; the HTTP routes use it so the pool size never caps
+    interactive traffic. Finished jobs (with their results) are deleted once they are older than
+    retention_seconds, checked every purge_interval seconds; 0 keeps them.
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        workers: int = 16,
+        poll_interval: float = 1.0,
+        retention_seconds: float = 86400,
+        purge_interval: float = 600,
+    ):
+        self.queue = queue
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.retention_seconds = retention_seconds
+        self.purge_interval = purge_interval
+        self._handlers: Dict[str, JobHandler] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        # Set when a job run here finishes, for as long as anyone is waiting on it
+        self._finished: Dict[str, asyncio.Event] = {}
+        self._waiters: Dict[str, int] = {}
+        # Ids of the jobs running in this process, which need no polling to wait on
+        self._running: set = set()
+
+    def register(self, kind: str, handler: JobHandler) -> None:
+        """
+        Register the coroutine function that runs jobs of a kind.
+        """
+        self._handlers[kind] = handler
+
+    def start(self) -> None:
+        """
+        Start the worker tasks on the running event loop.
+        """
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+        if self.retention_seconds > 0:
+            self._tasks.append(asyncio.ensure_future(self._purge_periodically()))
+
+    async def stop(self) -> None:
+        """
+        Stop the workers. Interrupted jobs are picked up again once their lease expires.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, kind: str, params: Dict[str, Any], priority: int = PRIORITY_DEFAULT) -> Dict[str, Any]:
+        """
+        Queue a job and wake an idle worker.
+        """
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job = await asyncio.to_thread(self.queue.submit, kind, params, priority)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job
+
+    async def run(self, kind: str, params: Dict[str, Any], priority: int = PRIORITY_DEFAULT) -> Dict[str, Any]:
+        """
+        Run a job in the calling task instead of waiting for a worker.
+
+        The job is stored already claimed, so its status can be looked up
+        and cancelled like any other, and a worker retries it if this
+        process dies mid-run. If the caller is cancelled, so is the job.
+
+        Returns:
+            The finished job
+        """
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job = await asyncio.to_thread(self.queue.submit, kind, params, priority, True)
+        try:
+            await self._run(job)
+        except asyncio.CancelledError:
+            # Nobody is left to receive the result, so don't leave it for a worker to retry
+            await asyncio.shield(asyncio.to_thread(self.queue.finish, job["id"], "cancelled", None, "Caller was cancelled"))
+            raise
+        return await asyncio.to_thread(self.queue.get, job["id"])
+
+    async def wait(self, job_id: str, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """
+        Wait until a job reaches a terminal status or the timeout expires.
+
+        A job running in this process wakes the waiter when it finishes;
+        jobs queued or run by other processes are noticed by polling.
+
+        Returns:
+            The job as of when waiting stopped, or None if it doesn't exist
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        event = self._finished.setdefault(job_id, asyncio.Event())
+        self._waiters[job_id] = self._waiters.get(job_id, 0) + 1
+        try:
+            while True:
+                job = await asyncio.to_thread(self.queue.get, job_id)
+                if job is None or job["status"] in TERMINAL_STATUSES:
+                    return job
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return job
+                poll = None if job_id in self._running else self.poll_interval
+                if remaining is not None:
+                    poll = remaining if poll is None else min(poll, remaining)
+                try:
+                    await asyncio.wait_for(event.wait(), poll)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            # The last waiter removes the event, whether or not the job finished here
+            self._waiters[job_id] -= 1
+            if not self._waiters[job_id]:
+                del self._waiters[job_id]
+                self._finished.pop(job_id, None)
+
+    async def _purge_periodically(self) -> None:
+        while True:
+            try:
+                purged = await asyncio.to_thread(self.queue.purge, self.retention_seconds)
+                if purged:
+                    logger.info("Purged %d finished jobs older than %gs", purged, self.retention_seconds)
+            except Exception as e:
+                logger.error("Error purging finished jobs: %s", e)
+            await asyncio.sleep(self.purge_interval)
+
+    async def _work(self) -> None:
+        while True:
+            # Cleared before claiming, so a job submitted while the claim runs still wakes us
+            self._wakeup.clear()
+            job = await asyncio.to_thread(self.queue.claim, list(self._handlers))
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+
+    async def _run(self, job: Dict[str, Any]) -> None:
+        # The handler's task copies the context, so it runs at the job's priority
+        token = use_priority(job["priority"])
+        try:
+            task = asyncio.ensure_future(self._handlers[job["kind"]](job["params"]))
+        finally:
+            reset_priority(token)
+        self._running.add(job["id"])
+        status, result, error = "failed", None, None
+        try:
+            while True:
+                # Renewing often also keeps cancellation responsive
+                done, _ = await asyncio.wait({task}, timeout=min(self.queue.lease_seconds / 3, 5))
+                if done:
+                    if task.cancelled():
+                        # Cancelled from inside the handler, not by shutdown or a cancel request
+                        error = "Job handler was cancelled"
+                    else:
+                        result = task.result()
+                        status = "succeeded"
+                    break
+                if await asyncio.to_thread(self.queue.renew, job["id"]):
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    status = "cancelled"
+                    break
+        except asyncio.CancelledError:
+            # Worker shutdown: leave the job running so its lease expires and it is retried
+            task.cancel()
+            self._running.discard(job["id"])
+            raise
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            logger.warning("Job %s (%s) failed: %s", job["id"], job["kind"], error)
+        try:
+            await asyncio.to_thread(self.queue.finish, job["id"], status, result, error)
+        finally:
+            self._running.discard(job["id"])
+            event = self._finished.pop(job["id"], None)
+            if event is not None:
+                event.set()
+
+_worker_pool: Optional[JobWorkerPool] = None
+
+def get_job_workers() -> JobWorkerPool:
+    """
+    Return the process-wide job queue and worker pool, configured from the environment.
+
+    Environment variables:
+        JOB_QUEUE_PATH: SQLite database file
+        JOB_WORKERS: Number of concurrent worker tasks
+        JOB_LEASE_SECONDS: How long a claimed job may go without a lease renewal
+        JOB_MAX_ATTEMPTS: Times a job is claimed before one that keeps losing its lease is failed
+        JOB_RETENTION_SECONDS: Age at which finished jobs and their results are deleted, 0 to keep them
+
+    Returns:
+        Shared JobWorkerPool instance
+    """
+    global _worker_pool
+    if _worker_pool is None:
+        queue = JobQueue(
+            path=os.getenv("JOB_QUEUE_PATH", "cache/jobs.sqlite3"),
+            lease_seconds=float(os.getenv("JOB_LEASE_SECONDS", "60")),
+            max_attempts=int(os.getenv("JOB_MAX_ATTEMPTS", "3")),
+        )
+        # Jobs are I/O bound, so workers are cheap; this caps concurrent queued jobs
+        # per process (the HTTP routes run theirs in-process with run())
+        _worker_pool = JobWorkerPool(
+            queue,
+            workers=int(os.getenv("JOB_WORKERS", "16")),
+            retention_seconds=float(os.getenv("JOB_RETENTION_SECONDS", "86400")),
+        )
+    return _worker_pool
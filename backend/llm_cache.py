@@ -0,0 +1,227 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional, Union
+
+def make_cache_key(namespace: str, model: str, prompt_version: str, parts: Iterable[Union[str, bytes]]) -> str:
+    """
+    Build a content hash for an LLM request.
+
+    Text parts are hashed as UTF-8 and binary parts (images) as their
+    SHA-256 digest, each length-prefixed so boundaries can't be confused.
+
+    Args:
+        namespace: Which call site the entry belongs to, e.g. "analysis"
+        model: Gemini model name
+        prompt_version: Version of the prompt template
+        parts: Prompt text, captions and image bytes in request order
+
+    Returns:
+        Hex digest identifying the request
+    """
+    digest = hashlib.sha256()
+    for field in (namespace, model, prompt_version):
+        encoded = field.encode("utf-8")
+        digest.update(len(encoded).to_bytes(8, "big") + encoded)
+    for part in parts:
+        if isinstance(part, bytes):
+            encoded = b"img:" + hashlib.sha256(part).digest()
+        else:
+            encoded = b"txt:" + part.encode("utf-8")
+        digest.update(len(encoded).to_bytes(8, "big") + encoded)
+    return digest.hexdigest()
+
+class LLMCache:
+    """
+    Persistent SQLite cache for LLM responses.
+
+    Entries expire after ttl_seconds. When the cache grows past max_entries
+    or max_bytes, the least recently used entries are evicted. Entries carry
+    their namespace and prompt version so a prompt change can invalidate
+    everything produced by the old prompt.
+    """
+
+    def __init__(
+        self,
+        path: str = "cache/llm_cache.sqlite3",
+        max_entries: int = 10000,
+        max_bytes: int = 100 * 1024 * 1024,
+        ttl_seconds: float = 7 * 24 * 3600,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._counters = {
+            "hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "evictions": 0,
+            "writes": 0,
+        }
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                namespace TEXT NOT NULL,
+                prompt_version TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_version ON llm_cache (namespace, prompt_version)")
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Look up a cached response.
+
+        Args:
+            key: Key from make_cache_key
+
+        Returns:
+            Cached response text, or None on a miss
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._counters["misses"] += 1
+                return None
+            value, created_at = row
+            if now - created_at > self.ttl_seconds:
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self._counters["expired"] += 1
+                self._counters["misses"] += 1
+                return None
+            self._conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._counters["hits"] += 1
+            return value
+
+    def put(self, key: str, value: str, namespace: str, prompt_version: str) -> None:
+        """
+        Store a response and evict old entries if the cache is over budget.
+
+        Args:
+            key: Key from make_cache_key
+            value: Response text
+            namespace: Which call site the entry belongs to
+            prompt_version: Version of the prompt template that produced it
+        """
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, namespace, prompt_version, value, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, namespace, prompt_version, value, size, now, now),
+            )
+            self._counters["writes"] += 1
+            self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        # Caller holds the lock
+        expired = self._conn.execute(
+            "DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl_seconds,)
+        ).rowcount
+        self._counters["expired"] += max(expired, 0)
+
+        count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        rows = self._conn.execute("SELECT key, size FROM llm_cache ORDER BY accessed_at").fetchall()
+        doomed = []
+        for key, size in rows:
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            doomed.append((key,))
+            count -= 1
+            total -= size
+        self._conn.executemany("DELETE FROM llm_cache WHERE key = ?", doomed)
+        self._counters["evictions"] += len(doomed)
+
+    def invalidate(self, namespace: Optional[str] = None, prompt_version: Optional[str] = None) -> int:
+        """
+        Delete cached entries, optionally filtered by namespace and prompt version.
+
+        Args:
+            namespace: Only delete entries from this call site
+            prompt_version: Only delete entries produced by this prompt version
+
+        Returns:
+            Number of entries deleted
+        """
+        clauses, params = [], []
+        if namespace is not None:
+            clauses.append("namespace = ?")
+            params.append(namespace)
+        if prompt_version is not None:
+            clauses.append("prompt_version = ?")
+            params.append(prompt_version)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            return self._conn.execute(f"DELETE FROM llm_cache{where}", params).rowcount
+
+    async def aget(self, key: str) -> Optional[str]:
+        """
+        Async variant of get; the query runs in a worker thread.
+        """
+        return await asyncio.to_thread(self.get, key)
+
+    async def aput(self, key: str, value: str, namespace: str, prompt_version: str) -> None:
+        """
+        Async variant of put; the write runs in a worker thread.
+        """
+        await asyncio.to_thread(self.put, key, value, namespace, prompt_version)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return hit/miss/eviction counters and entry counts per namespace.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT namespace, COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache GROUP BY namespace"
+            ).fetchall()
+            return {
+                **self._counters,
+                "namespaces": {namespace: {"entries": count, "bytes": size} for namespace, count, size in rows},
+            }
+
+_llm_cache: Optional[LLMCache] = None
+
+def get_llm_cache() -> LLMCache:
+    """
+    Return the process-wide LLM response cache, configured from the environment.
+
+    Environment variables:
+        LLM_CACHE_PATH: SQLite database file
+        LLM_CACHE_MAX_ENTRIES: Maximum number of cached responses
+        LLM_CACHE_MAX_MB: Maximum total response size, in MiB
+        LLM_CACHE_TTL: Seconds a response stays valid
+
+    Returns:
+        Shared LLMCache instance
+    """
+    global _llm_cache
+    if _llm_cache is None:
+        _llm_cache = LLMCache(
+            path=os.getenv("LLM_CACHE_PATH", "cache/llm_cache.sqlite3"),
+            max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000")),
+            max_bytes=int(float(os.getenv("LLM_CACHE_MAX_MB", "100")) * 1024 * 1024),
+            ttl_seconds=float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600))),
+        )
+    return _llm_cache
@@ -1,14 +1,45 @@
+import time
+# Startup time is measured from here; see STARTUP_TIME_TARGET_MS
+_startup_started = time.perf_counter()
+
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import os
-from apify_client import ApifyClient
-from typing import Dict, Any, List
-from instagram_analysis import analyze_instagram_posts
-from restaurant_recommendations import get_restaurant_recommendations
-import google.generativeai as genai
+import json
+import asyncio
+from typing import Dict, Any, List, Optional
+from instagram_analysis import analyze_instagram_posts_async
+from restaurant_recommendations import get_restaurant_recommendations_async
+from image_downloader import get_image_downloader
+from image_cache import get_image_cache
+from image_executor import get_image_executor
+from profile_fetcher import fetch_instagram_profile, get_profile_cache
+from singleflight import singleflight_stats
+from llm_cache import get_llm_cache
+from posts import parse_fields, posts_to_dicts
+from responses import CompressionMiddleware, FastJSONResponse
+from metrics import HTTP_IN_FLIGHT, HTTP_REQUEST_DURATION, HTTP_REQUESTS, get_logger, log_request, render_metrics
+from results_store import RESULT_KINDS, get_result_store
+from resilience import circuit_stats
+from tracing import TRACE_EXPORT_PATH, current_trace, export_trace, start_trace
+from instagram_restaurant_service import analyze_user_async, stream_recommendations_from_instagram
+from instagram_restaurant_service import resolve_batch_settings, run_batch_async, summarize_batch
+from instagram_restaurant_service import run_analysis_job, run_full_service_job, run_recommendations_job
+from content_planner import token_budget_for
+from jobs import PRIORITY_DEFAULT, PRIORITY_INTERACTIVE, TERMINAL_STATUSES, get_job_workers, reset_priority, use_priority
+from clients import get_gemini_model, record_startup, startup_stats, warm_up
+from gemini_scheduler import generate_content, get_gemini_scheduler
+from instagram_analysis import ANALYSIS_MODEL
+from restaurant_recommendations import RECOMMENDATIONS_MODEL
+
+logger = get_logger("main")
+
+# orjson rendering for every route; large responses skip jsonable_encoder by returning FastJSONResponse directly
+app = FastAPI(default_response_class=FastJSONResponse)
 
-app = FastAPI()
+# Compress large responses (brotli or gzip, as negotiated)
+app.add_middleware(CompressionMiddleware)
 
 # Configure CORS
 app.add_middleware(
@@ -19,93 +50,239 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+@app.on_event("startup")
+async def start_job_workers():
+    workers = get_job_workers()
+    workers.register("full-service", run_full_service_job)
+    workers.register("analysis", run_analysis_job)
+    workers.register("recommendations", run_recommendations_job)
+    workers.start()
+
+@app.on_event("startup")
+async def start_image_workers():
+    # Spawning the worker processes takes a while; do it in the background
+    # rather than delaying startup or the first requests with images
+    async def warm() -> None:
+        try:
+            await get_image_executor().warm_up()
+        except Exception:
+            logger.warning("Image worker warm-up failed", exc_info=True)
+    asyncio.ensure_future(warm())
+
+@app.on_event("startup")
+async def warm_up_clients():
+    # Registered last so the measurement covers the other startup hooks
+    warmup = None
+    if os.getenv("WARMUP_ON_STARTUP", "false").lower() == "true":
+        try:
+            warmup = await warm_up([ANALYSIS_MODEL, RECOMMENDATIONS_MODEL])
+        except Exception as e:
+            warmup = {"error": str(e)}
+            logger.warning("Client warm-up failed", exc_info=True)
+    record_startup(_startup_started, warmup)
+
+@app.on_event("shutdown")
+async def close_shared_clients():
+    # Stop job workers; interrupted jobs are retried once their lease expires
+    await get_job_workers().stop()
+    # Release pooled keep-alive connections held by the image downloader
+    await get_image_downloader().aclose()
+    # Stop the image worker processes
+    await asyncio.to_thread(get_image_executor().shutdown)
+
+def _with_timings(body: Dict[str, Any], timings: bool) -> Dict[str, Any]:
+    """
+    Add the current request's trace summary to a response body under
+    "timings" when the client asked for it with timings=true.
+    """
+    trace = current_trace()
+    if timings and trace is not None:
+        body["timings"] = trace.summary()
+    return body
+
+async def _run_job(kind: str, params: Dict[str, Any], timings: bool = False) -> Dict[str, Any]:
+    """
+    Run a job at interactive priority in this request's task and return its
+    result. The job is recorded in the queue, but doesn't wait for a free
+    worker. The job's spans are merged into the current request's trace.
+    
+    Args:
+        kind: Job kind
+        params: Job parameters
+        timings: Include the request's trace summary under "timings"
+        
+    Returns:
+        The job's result
+    """
+    job = await get_job_workers().run(kind, params, priority=PRIORITY_INTERACTIVE)
+    if job["status"] != "succeeded":
+        raise RuntimeError(job["error"] or f"job {job['id']} {job['status']}")
+    result = dict(job["result"])
+    trace = current_trace()
+    if trace is not None:
+        trace.merge(result.pop("timings", None))
+    return _with_timings(result, timings)
+
 ALLOWED_IP = "10.214.209.4"
 @app.middleware("http")
 async def check_ip_address(request: Request, call_next):
-    client_ip = request.client.host
+    client_ip = request.client.host if request.client else None
     is_production  = os.getenv("PRODUCTION", "false") == "true"
-    print(client_ip, is_production)
 
     #if is_production and client_ip != ALLOWED_IP:
         #raise HTTPException(status_code=403, detail="Forbidden: Access denied")
 
-    response = await call_next(request)
-    return response
+    started = time.perf_counter()
+    status = 500
+    with start_trace(f"{request.method} {request.url.path}") as trace:
+        # Work done for a request (including its Gemini calls) runs at interactive priority
+        priority_token = use_priority(PRIORITY_INTERACTIVE)
+        try:
+            with HTTP_IN_FLIGHT.track_inprogress():
+                response = await call_next(request)
+            status = response.status_code
+            # Streamed responses only carry the stages done before the first byte
+            response.headers["Server-Timing"] = trace.server_timing()
+            return response
+        finally:
+            reset_priority(priority_token)
+            # Label by route template, not raw path, to keep label cardinality bounded
+            route = getattr(request.scope.get("route"), "path", "unmatched")
+            duration = time.perf_counter() - started
+            HTTP_REQUESTS.inc(route=route, method=request.method, status=str(status))
+            HTTP_REQUEST_DURATION.observe(duration, route=route, method=request.method)
+            log_request(route, request.method, status, duration, client_ip=client_ip, production=is_production, trace_id=trace.trace_id)
+            if TRACE_EXPORT_PATH and trace.spans:
+                trace.name = f"{request.method} {route}"
+                await asyncio.to_thread(export_trace, trace)
 
 @app.get("/")
-def read_root():
+async def read_root():
     # Hardcoded test to display Instagram data for kyliejenner
-    return get_instagram_data("kyliejenner")
+    return await get_instagram_data("kyliejenner")
+
+@app.get("/health")
+async def health():
+    """
+    Report that the app is up, with how long startup took, the circuit
+    breaker state of each external dependency and the image worker pool.
+    
+    Returns:
+        JSON response with status, startup measurements, circuit states and image worker counters
+    """
+    return {"status": "ok", "startup": startup_stats(), "circuits": circuit_stats(), "image_workers": get_image_executor().stats()}
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Expose request and pipeline stage metrics in the Prometheus text format.
+    
+    Returns:
+        Plain-text metrics exposition
+    """
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/gemini/quota")
+async def gemini_quota():
+    """
+    Report the Gemini rate limits, how much of them is left, and queue
+    depth and wait times per priority class.
+    
+    Returns:
+        JSON response with the scheduler's statistics
+    """
+    return await asyncio.to_thread(get_gemini_scheduler().stats)
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """
+    Report hit/miss/eviction counters for the server-side caches and
+    coalescing counters for in-flight de-duplication.
+    
+    Returns:
+        JSON response with per-cache statistics
+    """
+    return {
+        "images": get_image_cache().stats(),
+        "profiles": get_profile_cache().stats(),
+        "llm": get_llm_cache().stats(),
+        "results": get_result_store().stats(),
+        "inflight": singleflight_stats()
+    }
+
+@app.delete("/cache/llm")
+async def invalidate_llm_cache(namespace: str = None, prompt_version: str = None):
+    """
+    Invalidate cached Gemini responses.
+    
+    Args:
+        namespace: Only invalidate entries from this call site (e.g. "analysis")
+        prompt_version: Only invalidate entries produced by this prompt version
+        
+    Returns:
+        JSON response with the number of deleted entries
+    """
+    deleted = await asyncio.to_thread(get_llm_cache().invalidate, namespace, prompt_version)
+    return {"deleted": deleted, "namespace": namespace, "prompt_version": prompt_version}
 
 @app.get("/items/{item_id}")
-def read_item(item_id: int, q: str = None):
+async def read_item(item_id: int, q: str = None):
     return {"item_id": item_id, "q": q}
 
 
 @app.get("/instagram/{username}")
-def get_instagram_data(username: str):
+async def get_instagram_data(username: str, refresh: bool = False, fields: str = None, include_raw: bool = False):
     """
     Retrieve Instagram data for a given username using Apify API.
+    Scrapes are cached per username; see profile_fetcher for the TTL and
+    stale-while-revalidate settings.
     
     Args:
         username: Instagram username to fetch data for
+        refresh: Bypass the profile cache and scrape now
+        fields: Comma-separated post fields to return, e.g. "id,displayUrl"
+        include_raw: Scrape now and return the full Apify items (never cached)
         
     Returns:
-        JSON response with Instagram profile data
+        JSON response with Instagram profile data and cache age
     """
     try:
-        # Initialize the ApifyClient with API token
-        client = ApifyClient("apify_api_NijTGDp3Pvbbd0dydzaDP9g4O78tnG3EHHSN")
-        
-        # Prepare the Actor input
-        run_input = {
-            "directUrls": [f"https://www.instagram.com/{username}"],
-            "resultsType": "posts",
-            "resultsLimit": 5,
-            "searchType": "hashtag",
-            "searchLimit": 1,
-            "addParentData": False,
-        }
-        
-        # Run the Actor and wait for it to finish
-        run = client.actor("shu8hvrXbJbY3Eb9W").call(run_input=run_input)
-        
-        # Fetch Actor results from the run's dataset
-        results = list(client.dataset(run["defaultDatasetId"]).iterate_items())
-        
-        return {"username": username, "data": results}
+        result = await fetch_instagram_profile(username, refresh=refresh, include_raw=include_raw)
+        return FastJSONResponse({**result, "data": posts_to_dicts(result["data"], parse_fields(fields))})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching Instagram data: {str(e)}")
 
 
 @app.get("/instagram/{username}/analysis")
-def analyze_instagram_user(username: str):
+async def analyze_instagram_user(username: str, refresh: bool = False, incremental: bool = False, timings: bool = False, token_budget: Optional[int] = None):
     """
     Analyze Instagram user posts using Gemini Vision API.
     
     Args:
         username: Instagram username to analyze
+        refresh: Bypass the profile cache and scrape now
+        incremental: Only analyze posts that weren't analyzed before, merged into the stored profile
+        timings: Include a per-stage timing breakdown under "timings"
+        token_budget: Prompt tokens the analysis may use (default: CONTENT_TOKEN_BUDGET_ANALYSIS)
         
     Returns:
         JSON response with analysis results
     """
     try:
-        # First get the Instagram data
-        instagram_data = get_instagram_data(username)
-        
-        # Analyze the posts using Gemini
-        analysis_result = analyze_instagram_posts(instagram_data)
-        
-        return {
+        # Run as an interactive-priority job and wait for it; concurrent
+        # requests for the same user share the underlying work
+        return FastJSONResponse(await _run_job("analysis", {
             "username": username,
-            "analysis": analysis_result
-        }
+            "refresh": refresh,
+            "incremental": incremental,
+            "token_budget": token_budget
+        }, timings))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error analyzing Instagram data: {str(e)}")
 
 
 @app.post("/instagram/analyze-test-data")
-def analyze_test_data(output_file: str = "analysis_output.json"):
+async def analyze_test_data(output_file: str = "analysis_output.json"):
     """
     Analyze test Instagram data from ig_test_data.json using Gemini Vision API.
     
@@ -123,45 +300,48 @@ def analyze_test_data(output_file: str = "analysis_output.json"):
             test_data = json.load(f)
         
         # Analyze the posts using Gemini and save to file
-        analysis_result = analyze_instagram_posts(test_data, save_to_file=True, output_file=output_file)
+        stats = {}
+        analysis_result = await analyze_instagram_posts_async(test_data, save_to_file=True, output_file=output_file, stats=stats)
         
         return {
             "analysis": analysis_result,
-            "output_file": output_file
+            "output_file": output_file,
+            "stats": stats
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error analyzing test data: {str(e)}")
 
 
 @app.get("/instagram/{username}/restaurant-recommendations")
-def get_restaurant_recommendations_for_user(username: str):
+async def get_restaurant_recommendations_for_user(username: str, refresh: bool = False, incremental: bool = False, timings: bool = False, token_budget: Optional[int] = None):
     """
     Generate restaurant recommendations based on Instagram user analysis.
     
     Args:
         username: Instagram username to analyze
+        refresh: Bypass the profile cache and scrape now
+        incremental: Only analyze posts that weren't analyzed before, merged into the stored profile
+        timings: Include a per-stage timing breakdown under "timings"
+        token_budget: Prompt tokens the analysis may use (default: CONTENT_TOKEN_BUDGET_ANALYSIS)
         
     Returns:
         JSON response with restaurant recommendations
     """
     try:
-        # First get the Instagram analysis
-        analysis_response = analyze_instagram_user(username)
-        analysis = analysis_response.get("analysis", "")
-        
-        # Generate restaurant recommendations based on the analysis
-        recommendations = get_restaurant_recommendations(analysis)
-        
-        return {
+        # Run as an interactive-priority job and wait for it; the analysis is
+        # shared with concurrent /analysis requests for the same user
+        return FastJSONResponse(await _run_job("recommendations", {
             "username": username,
-            "recommendations": recommendations
-        }
+            "refresh": refresh,
+            "incremental": incremental,
+            "token_budget": token_budget
+        }, timings))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating restaurant recommendations: {str(e)}")
 
 
 @app.post("/restaurant-recommendations")
-def get_recommendations_from_analysis(analysis: str):
+async def get_recommendations_from_analysis(analysis: str):
     """
     Generate restaurant recommendations based on provided customer profile analysis.
     
@@ -173,7 +353,7 @@ def get_recommendations_from_analysis(analysis: str):
     """
     try:
         # Generate restaurant recommendations based on the analysis
-        recommendations = get_restaurant_recommendations(analysis)
+        recommendations = await get_restaurant_recommendations_async(analysis)
         
         return {
             "recommendations": recommendations
@@ -183,70 +363,358 @@ def get_recommendations_from_analysis(analysis: str):
 
 
 @app.post("/restaurant-recommendations/from-file")
-def get_recommendations_from_file(analysis_file: str = "analysis_output.json"):
+async def get_recommendations_from_file(analysis_file: str = "analysis_output.json", username: str = None):
     """
-    Generate restaurant recommendations based on analysis from a file.
+    Generate restaurant recommendations based on analysis from a file, or
+    from the latest stored analysis of a username.
     
     Args:
         analysis_file: Path to the analysis JSON file
+        username: Use this user's latest analysis from the result store instead of a file
         
     Returns:
         JSON response with restaurant recommendations
     """
     try:
-        import json
-        
-        # Load analysis from file
-        with open(analysis_file, "r") as f:
-            data = json.load(f)
-        
-        analysis = data.get("analysis", "")
+        if username:
+            stored = await get_result_store().alatest(username, "analysis")
+            if stored is None:
+                raise HTTPException(status_code=404, detail=f"No stored analysis for {username}")
+            analysis = stored["data"]
+        else:
+            # Load analysis from file
+            with open(analysis_file, "r") as f:
+                data = json.load(f)
+            
+            analysis = data.get("analysis", "")
         
         # Generate restaurant recommendations based on the analysis
-        recommendations = get_restaurant_recommendations(analysis)
+        recommendations = await get_restaurant_recommendations_async(analysis)
         
+        if username:
+            return {
+                "recommendations": recommendations,
+                "result_id": stored["run_id"]
+            }
         return {
             "recommendations": recommendations,
             "analysis_file": analysis_file
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating restaurant recommendations from file: {str(e)}")
 
 
 @app.get("/instagram/{username}/full-service")
-def full_service_recommendations(username: str, save_outputs: bool = True, output_dir: str = "outputs"):
+async def full_service_recommendations(username: str, save_outputs: bool = False, output_dir: str = "outputs", refresh: bool = False, incremental: bool = False, timings: bool = False, token_budget: Optional[int] = None):
     """
     Complete service that fetches Instagram data, analyzes it, and generates restaurant recommendations.
-    All in one endpoint that connects all services.
+    All in one endpoint that connects all services. Outputs are always kept in
+    the result store (see /results/{username}); files are an optional export.
     
     Args:
         username: Instagram username to analyze
-        save_outputs: Whether to save intermediate and final outputs to files
+        save_outputs: Whether to also export intermediate and final outputs to files
         output_dir: Directory to save output files
+        refresh: Bypass the profile cache and scrape now
+        incremental: Only analyze posts that weren't analyzed before, merged into the stored profile
+        timings: Include a per-stage timing breakdown under "timings"
+        token_budget: Prompt tokens the analysis may use (default: CONTENT_TOKEN_BUDGET_FULL_SERVICE)
         
     Returns:
         JSON response with restaurant recommendations and paths to output files
     """
     try:
-        # Import here to avoid circular imports
-        from instagram_restaurant_service import get_recommendations_from_instagram
-        
-        # Use the integrated service to get recommendations
-        recommendations, output_files = get_recommendations_from_instagram(
-            username=username,
-            save_outputs=save_outputs,
-            output_dir=output_dir
-        )
-        
-        return {
+        # Run the integrated service as an interactive-priority job and wait for it
+        return FastJSONResponse(await _run_job("full-service", {
             "username": username,
-            "recommendations": recommendations,
-            "output_files": output_files
-        }
+            "save_outputs": save_outputs,
+            "output_dir": output_dir,
+            "refresh": refresh,
+            "incremental": incremental,
+            "token_budget": token_budget
+        }, timings))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error in full service recommendations: {str(e)}")
 
 
+@app.get("/instagram/{username}/full-service/stream")
+async def full_service_recommendations_stream(username: str, format: str = "ndjson", refresh: bool = False, token_budget: Optional[int] = None):
+    """
+    Streaming variant of the full service. Sends an event as each stage
+    finishes: posts_fetched, images_ready, analysis_chunk (the analysis text
+    as Gemini streams it), analysis_complete, one recommendation event per
+    restaurant, then done (or error).
+    
+    Args:
+        username: Instagram username to analyze
+        format: "ndjson" for one JSON object per line, or "sse" for Server-Sent Events
+        refresh: Bypass the profile cache and scrape now
+        token_budget: Prompt tokens the analysis may use (default: CONTENT_TOKEN_BUDGET_STREAM)
+        
+    Returns:
+        Streaming response of stage events
+    """
+    if format not in ("ndjson", "sse"):
+        raise HTTPException(status_code=400, detail="format must be 'ndjson' or 'sse'")
+    
+    async def encode_events():
+        async for event in stream_recommendations_from_instagram(username, refresh=refresh, token_budget=token_budget_for("stream", token_budget)):
+            if format == "sse":
+                yield f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+            else:
+                yield json.dumps(event) + "\n"
+    
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    # Disable proxy buffering so each event reaches the client as soon as it is sent
+    return StreamingResponse(encode_events(), media_type=media_type, headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.post("/batch/full-service")
+async def batch_full_service(data: Dict[str, Any]):
+    """
+    Run the full service for many usernames with a bounded worker pool.
+    
+    Args:
+        data: JSON body with:
+            usernames: List of Instagram usernames (required)
+            concurrency: Users processed at once
+            apify_concurrency, download_concurrency, gemini_concurrency: Per-stage limits
+            refresh: Bypass the profile cache and scrape every user now
+            incremental: Only analyze posts that weren't analyzed before
+            token_budget: Prompt tokens per analysis (default: CONTENT_TOKEN_BUDGET_BATCH)
+            save_outputs: Also export each user's outputs to files
+            output_dir: Directory to save output files (default: outputs)
+            stream: Return NDJSON lines as users finish instead of one JSON document
+        
+    Returns:
+        JSON response with per-user results (in input order) and a summary,
+        or an NDJSON stream of per-user results followed by a summary line
+    """
+    usernames = data.get("usernames")
+    if not isinstance(usernames, list) or not usernames or not all(isinstance(u, str) and u for u in usernames):
+        raise HTTPException(status_code=400, detail="usernames must be a non-empty list of strings")
+    
+    try:
+        settings = resolve_batch_settings(
+            concurrency=int(data["concurrency"]) if data.get("concurrency") else None,
+            stage_concurrency={
+                stage: int(data[f"{stage}_concurrency"])
+                for stage in ("apify", "download", "gemini")
+                if data.get(f"{stage}_concurrency")
+            },
+            token_budget=int(data["token_budget"]) if data.get("token_budget") else None
+        )
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="concurrency and token_budget settings must be integers")
+    
+    batch = run_batch_async(
+        usernames,
+        concurrency=settings["concurrency"],
+        stage_concurrency=settings["stage_concurrency"],
+        refresh=bool(data.get("refresh", False)),
+        incremental=bool(data.get("incremental", False)),
+        token_budget=settings["token_budget"],
+        save_outputs=bool(data.get("save_outputs", False)),
+        output_dir=str(data.get("output_dir") or "outputs")
+    )
+    started = time.monotonic()
+    
+    if data.get("stream"):
+        async def encode_results():
+            results = []
+            async for result in batch:
+                results.append(result)
+                yield json.dumps({"event": "result", **result}) + "\n"
+            summary = summarize_batch(results, time.monotonic() - started, settings)
+            yield json.dumps({"event": "summary", **summary}) + "\n"
+        
+        return StreamingResponse(encode_results(), media_type="application/x-ndjson")
+    
+    results = [result async for result in batch]
+    results.sort(key=lambda result: result["index"])
+    return FastJSONResponse({
+        "results": results,
+        "summary": summarize_batch(results, time.monotonic() - started, settings)
+    })
+
+
+@app.get("/results/{username}")
+async def latest_result(username: str, kind: str = "analysis"):
+    """
+    Get the latest stored result of a kind for a username.
+    
+    Args:
+        username: Instagram username
+        kind: instagram_data, analysis, recommendations or error
+        
+    Returns:
+        JSON response with the run id, timestamp and data
+    """
+    if kind not in RESULT_KINDS:
+        raise HTTPException(status_code=400, detail=f"kind must be one of {', '.join(RESULT_KINDS)}")
+    result = await get_result_store().alatest(username, kind)
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"No stored {kind} for {username}")
+    return FastJSONResponse(result)
+
+
+@app.get("/results/{username}/history")
+async def result_history(username: str, limit: int = 20):
+    """
+    List a username's stored runs, newest first.
+    
+    Args:
+        username: Instagram username
+        limit: Maximum number of runs
+        
+    Returns:
+        JSON response with run ids, timestamps and stored kinds
+    """
+    return {"username": username, "runs": await asyncio.to_thread(get_result_store().history, username, limit)}
+
+
+@app.get("/results/runs/{result_id}")
+async def result_run(result_id: str):
+    """
+    Get every record stored by one run.
+    
+    Args:
+        result_id: Run id, as returned in a full-service response's stats
+        
+    Returns:
+        JSON response with the run's data keyed by kind
+    """
+    result = await asyncio.to_thread(get_result_store().get_run, result_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Result not found")
+    return FastJSONResponse(result)
+
+
+@app.post("/results/compact")
+async def compact_results():
+    """
+    Apply the result retention policy and reclaim disk space.
+    
+    Returns:
+        JSON response with the database size before and after
+    """
+    return await asyncio.to_thread(get_result_store().compact)
+
+
+@app.post("/jobs", status_code=202)
+async def submit_job(data: Dict[str, Any]):
+    """
+    Queue a full-service or analysis job and return immediately.
+    
+    Args:
+        data: JSON body with kind ("full-service", "analysis" or "recommendations"), params
+            (username plus the same options as the matching route) and an
+            optional integer priority (higher runs first)
+        
+    Returns:
+        JSON response with the queued job, including its id
+    """
+    kind = data.get("kind")
+    params = data.get("params") or {}
+    if kind not in ("full-service", "analysis", "recommendations"):
+        raise HTTPException(status_code=400, detail="kind must be 'full-service', 'analysis' or 'recommendations'")
+    if not isinstance(params, dict) or not params.get("username"):
+        raise HTTPException(status_code=400, detail="params.username is required")
+    try:
+        priority = int(data.get("priority", PRIORITY_DEFAULT))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="priority must be an integer")
+    return await get_job_workers().submit(kind, params, priority=priority)
+
+
+@app.get("/jobs")
+async def list_jobs(status: str = None, limit: int = 100):
+    """
+    List recent jobs and the number of jobs per status.
+    
+    Args:
+        status: Only list jobs with this status
+        limit: Maximum number of jobs to list
+        
+    Returns:
+        JSON response with jobs and counts
+    """
+    queue = get_job_workers().queue
+    return {
+        "jobs": await asyncio.to_thread(queue.list, status, limit),
+        "counts": await asyncio.to_thread(queue.stats)
+    }
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = 0):
+    """
+    Get a job's status and, once finished, its result.
+    
+    Args:
+        job_id: Job id
+        wait: Seconds to wait for the job to finish before answering (long polling)
+        
+    Returns:
+        JSON response with the job
+    """
+    workers = get_job_workers()
+    job = await workers.wait(job_id, timeout=min(wait, 60)) if wait > 0 else await asyncio.to_thread(workers.queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """
+    Subscribe to a job's status changes as Server-Sent Events. The stream
+    ends when the job reaches a terminal status.
+    
+    Args:
+        job_id: Job id
+        
+    Returns:
+        Streaming response of job snapshots
+    """
+    workers = get_job_workers()
+    job = await asyncio.to_thread(workers.queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    async def encode_events():
+        current = job
+        last_status = None
+        while True:
+            if current["status"] != last_status:
+                last_status = current["status"]
+                yield f"event: {last_status}\ndata: {json.dumps(current)}\n\n"
+            if current["status"] in TERMINAL_STATUSES:
+                return
+            current = await workers.wait(job_id, timeout=15) or current
+    
+    return StreamingResponse(encode_events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """
+    Cancel a queued or running job.
+    
+    Args:
+        job_id: Job id
+        
+    Returns:
+        JSON response with the updated job
+    """
+    job = await asyncio.to_thread(get_job_workers().queue.cancel, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
 @app.post("/rewrite")
 async def rewrite_prompt(data: Dict[str, Any]):
     """
@@ -259,13 +727,6 @@ async def rewrite_prompt(data: Dict[str, Any]):
         JSON response with the new prompt
     """
     try:
-        # Configure Gemini API
-        GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-        if not GEMINI_API_KEY:
-            raise ValueError("GEMINI_API_KEY environment variable is not set")
-        
-        genai.configure(api_key=GEMINI_API_KEY)
-        
         # Get the current prompt used for analysis
         current_prompt = "Assume I am a business. I want to gain detailed insights about this potential customer (Instagram user) based on their latest post images and corresponding captions. Please examine these post images and captions and return relevant insights about this customer."
         
@@ -275,7 +736,7 @@ async def rewrite_prompt(data: Dict[str, Any]):
             try:
                 import json
                 analysis_file = data["output_files"]["analysis"]
-                print(f"Attempting to load analysis file: {analysis_file}")
+                logger.debug("Attempting to load analysis file: %s", analysis_file)
                 
                 # Check if file exists
                 if os.path.exists(analysis_file):
@@ -283,20 +744,26 @@ async def rewrite_prompt(data: Dict[str, Any]):
                         analysis_json = json.load(f)
                         analysis_data = analysis_json.get("analysis", "")
                 else:
-                    print(f"Analysis file does not exist: {analysis_file}")
+                    logger.warning("Analysis file does not exist: %s", analysis_file)
             except Exception as e:
-                print(f"Error loading analysis file: {str(e)}")
+                logger.warning("Error loading analysis file: %s", e)
+        
+        # Otherwise use the latest analysis recorded for the user
+        if not analysis_data and data.get("username"):
+            stored = await get_result_store().alatest(data["username"], "analysis")
+            if stored is not None:
+                analysis_data = stored["data"]
         
         # Format the recommendations with preferences for the prompt
         recommendations_with_preferences = []
         
         # Log the data structure for debugging
-        print(f"Data structure received: {data.keys()}")
+        logger.debug("Data structure received: %s", list(data.keys()))
         if "recommendations" in data:
-            print(f"Found {len(data['recommendations'])} recommendations")
+            logger.debug("Found %d recommendations", len(data["recommendations"]))
         
         for rec in data.get("recommendations", []):
-            print(f"Processing recommendation: {rec}")
+            logger.debug("Processing recommendation: %s", rec)
             if "preference" in rec:
                 rec_with_pref = {
                     "restaurant_name": rec.get("restaurant_name", ""),
@@ -309,7 +776,7 @@ async def rewrite_prompt(data: Dict[str, Any]):
         # Create the input for Gemini
         # If we don't have any recommendations with preferences, use a sample for testing
         if not recommendations_with_preferences:
-            print("No recommendations with preferences found, using sample data")
+            logger.info("No recommendations with preferences found, using sample data")
             recommendations_with_preferences = [
                 {
                     "restaurant_name": "Sample Restaurant 1",
@@ -342,11 +809,11 @@ async def rewrite_prompt(data: Dict[str, Any]):
         Please generate a new prompt that takes into account the recommendation validations that I were provided in the recommendations data, the current prompt, and the customer profile. Generate this prompt string and this prompt string only.
         """
         
-        # Initialize Gemini model
-        model = genai.GenerativeModel('gemini-2.0-flash')
+        # Shared Gemini model, configured on first use
+        model = get_gemini_model('gemini-2.0-flash')
         
         # Generate the new prompt
-        response = model.generate_content(input_text)
+        response = await generate_content(model, input_text)
         new_prompt = response.text.strip()
         
         return {
@@ -0,0 +1,305 @@
+import bisect
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from tracing import OpenSpan, span
+
+# Seconds; covers cache hits (milliseconds) up to slow actor runs (minutes)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Bytes; thumbnails up to full-size originals
+BYTE_BUCKETS = (1024, 4096, 16384, 65536, 131072, 262144, 524288, 1048576, 4194304)
+
+LabelValues = Tuple[str, ...]
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in pairs) + "}"
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(_Metric):
+    """
+    Monotonically increasing count, e.g. requests or errors.
+    """
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+class Gauge(_Metric):
+    """
+    Value that goes up and down, e.g. requests in flight.
+    """
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    @contextmanager
+    def track_inprogress(self, **labels: str) -> Iterator[None]:
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+class Histogram(_Metric):
+    """
+    Distribution of observations in cumulative buckets, e.g. latencies.
+    """
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [count per bucket (last is +Inf)], sum
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(counts), total[0]) for key, (counts, total) in self._values.items()]
+        lines = []
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', _format_value(bound)))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+_registry: List[_Metric] = []
+
+def render_metrics() -> str:
+    """
+    Render every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in list(_registry):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# HTTP
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests by route, method and status code", ("route", "method", "status"))
+HTTP_REQUEST_DURATION = Histogram("http_request_duration_seconds", "Time until the response starts, by route and method", ("route", "method"))
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests being handled")
+
+# Pipeline stages: apify_fetch, image_download, gemini_analysis, recommendations, result_write
+STAGE_DURATION = Histogram("pipeline_stage_duration_seconds", "Time spent per pipeline stage call", ("stage",))
+STAGE_IN_FLIGHT = Gauge("pipeline_stage_in_flight", "Pipeline stage calls in progress", ("stage",))
+STAGE_ERRORS = Counter("pipeline_stage_errors_total", "Pipeline stage calls that raised", ("stage",))
+IMAGE_BYTES = Histogram("image_bytes", "Size of post images before and after preprocessing", ("kind",), buckets=BYTE_BUCKETS)
+IMAGE_DUPLICATES = Counter("image_duplicates_dropped_total", "Near-identical post images left out of analysis requests")
+
+# Resilience, per dependency: apify, cdn, gemini
+RETRIES = Counter("dependency_retries_total", "Calls retried after a retryable error", ("dependency",))
+RETRIES_EXHAUSTED = Counter("dependency_retries_exhausted_total", "Calls that still failed after the last attempt", ("dependency",))
+HEDGES = Counter("dependency_hedged_requests_total", "Duplicate requests started because the first was slow", ("dependency",))
+HEDGE_WINS = Counter("dependency_hedge_wins_total", "Hedged requests that answered before the original", ("dependency",))
+CIRCUIT_STATE = Gauge("dependency_circuit_state", "Circuit breaker state: 0 closed, 1 half-open, 2 open", ("dependency",))
+CIRCUIT_TRANSITIONS = Counter("dependency_circuit_transitions_total", "Circuit breaker state changes", ("dependency", "state"))
+CIRCUIT_REJECTIONS = Counter("dependency_circuit_rejections_total", "Calls failed fast because the circuit was open", ("dependency",))
+
+# Gemini quota scheduler, per priority class: interactive, default, batch
+GEMINI_QUEUE_DEPTH = Gauge("gemini_queue_depth", "Gemini calls waiting for quota", ("priority",))
+GEMINI_QUEUE_WAIT = Histogram("gemini_queue_wait_seconds", "Time a Gemini call waited for quota", ("priority",))
+GEMINI_CALLS = Counter("gemini_calls_total", "Gemini calls let through by the quota scheduler", ("priority",))
+GEMINI_QUOTA_TIMEOUTS = Counter("gemini_quota_timeouts_total", "Gemini calls that gave up waiting for quota", ("priority",))
+GEMINI_PROMPT_TOKENS = Counter("gemini_prompt_tokens_total", "Prompt tokens of Gemini calls, estimated before the call and reported by Gemini", ("kind",))
+
+# In-flight de-duplication, per SingleFlight group (e.g. analysis, apify_scrape)
+SINGLEFLIGHT_EXECUTIONS = Counter("singleflight_executions_total", "Calls that started the shared work as its leader", ("group",))
+SINGLEFLIGHT_COALESCED = Counter("singleflight_coalesced_total", "Calls that joined work already in flight for the same key", ("group",))
+
+@contextmanager
+def track_stage(stage: str) -> Iterator[None]:
+    """
+    Time a pipeline stage call and count it as in flight while it runs.
+    Exceptions are counted and re-raised. The call is also recorded as a
+    span of the current request trace.
+
+    Args:
+        stage: Stage name, e.g. "gemini_analysis"
+    """
+    STAGE_IN_FLIGHT.inc(stage=stage)
+    started = time.perf_counter()
+    try:
+        with span(stage):
+            yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_DURATION.observe(time.perf_counter() - started, stage=stage)
+        STAGE_IN_FLIGHT.dec(stage=stage)
+
+class OpenStage:
+    """
+    track_stage for a stage that yields to the caller while it runs, such
+    as a streamed Gemini response: started when created and finished by
+    end(), recorded as an OpenSpan.
+    """
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.span = OpenSpan(stage)
+        self._started = time.perf_counter()
+        self._ended = False
+        STAGE_IN_FLIGHT.inc(stage=stage)
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        """
+        Finish the stage; later calls do nothing. An Exception given as
+        error is counted as a stage error.
+        """
+        if self._ended:
+            return
+        self._ended = True
+        if isinstance(error, Exception):
+            STAGE_ERRORS.inc(stage=self.stage)
+        STAGE_DURATION.observe(time.perf_counter() - self._started, stage=self.stage)
+        STAGE_IN_FLIGHT.dec(stage=self.stage)
+        self.span.end(error)
+
+# Sampled structured request logs, one JSON object per line on stderr
+ACCESS_LOG_SAMPLE_RATE = float(os.getenv("ACCESS_LOG_SAMPLE_RATE", "0.01"))
+# Requests at least this slow are always logged
+ACCESS_LOG_SLOW_SECONDS = float(os.getenv("ACCESS_LOG_SLOW_SECONDS", "10"))
+
+_access_logger = logging.getLogger("access")
+if not _access_logger.handlers:
+    _handler = logging.StreamHandler(sys.stderr)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    _access_logger.addHandler(_handler)
+    _access_logger.setLevel(logging.INFO)
+    _access_logger.propagate = False
+
+# Operational messages of the service modules (retries, dropped work, failures
+# in background tasks), one line each on stderr
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+_app_logger = logging.getLogger("app")
+if not _app_logger.handlers:
+    _handler = logging.StreamHandler(sys.stderr)
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    _app_logger.addHandler(_handler)
+    _app_logger.setLevel(LOG_LEVEL)
+    _app_logger.propagate = False
+
+def get_logger(module: str) -> logging.Logger:
+    """
+    Return the logger of a service module, which writes through the shared
+    "app" handler at LOG_LEVEL (INFO by default).
+
+    Args:
+        module: Module name, e.g. "jobs"
+    """
+    return logging.getLogger(f"app.{module}")
+
+def log_request(route: str, method: str, status: int, duration: float, **fields: object) -> None:
+    """
+    Log a request as a JSON line. Only a sample of requests is logged;
+    server errors and slow requests always are.
+
+    Args:
+        route: Route path template
+        method: HTTP method
+        status: Response status code
+        duration: Seconds until the response started
+        fields: Extra fields to include
+    """
+    if status < 500 and duration < ACCESS_LOG_SLOW_SECONDS and random.random() >= ACCESS_LOG_SAMPLE_RATE:
+        return
+    _access_logger.info(json.dumps({
+        "event": "request",
+        "ts": round(time.time(), 3),
+        "route": route,
+        "method": method,
+        "status": status,
+        "duration_ms": round(duration * 1000, 1),
+        **fields,
+    }))
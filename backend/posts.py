@@ -0,0 +1,130 @@
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Union
+
+class Post:
+    """
+    Compact view of an Apify Instagram post item.
+
+    Only the fields the pipeline reads are kept (attribute names match the
+    Apify keys), so comment threads, tagged users, signed video URLs and
+    the rest of the item are dropped at ingest. The full item is kept in
+    raw only when it was asked for. Supports post.get(key) and post[key]
+    so code written against raw items keeps working.
+    """
+
+    __slots__ = ("id", "shortCode", "displayUrl", "caption", "type", "timestamp", "commentsCount", "likesCount", "raw")
+
+    # Apify item keys projected onto a Post
+    FIELDS = ("id", "shortCode", "displayUrl", "caption", "type", "timestamp", "commentsCount", "likesCount")
+
+    def __init__(
+        self,
+        id: Optional[str] = None,
+        shortCode: Optional[str] = None,
+        displayUrl: Optional[str] = None,
+        caption: Optional[str] = None,
+        type: Optional[str] = None,
+        timestamp: Optional[str] = None,
+        commentsCount: Optional[int] = None,
+        likesCount: Optional[int] = None,
+        raw: Optional[Dict[str, Any]] = None,
+    ):
+        self.id = id
+        self.shortCode = shortCode
+        self.displayUrl = displayUrl
+        self.caption = caption
+        self.type = type
+        self.timestamp = timestamp
+        self.commentsCount = commentsCount
+        self.likesCount = likesCount
+        self.raw = raw
+
+    @classmethod
+    def from_item(cls, item: Dict[str, Any], keep_raw: bool = False) -> "Post":
+        """
+        Project an Apify post item onto a Post.
+
+        Args:
+            item: Raw Apify post item
+            keep_raw: Also keep the full item
+
+        Returns:
+            Post instance
+        """
+        return cls(*(item.get(field) for field in cls.FIELDS), raw=item if keep_raw else None)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key in self.FIELDS:
+            value = getattr(self, key)
+            return default if value is None else value
+        if self.raw is not None:
+            return self.raw.get(key, default)
+        return default
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def to_dict(self, fields: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+        """
+        Convert to a JSON-serializable dictionary.
+
+        Args:
+            fields: Keys to include, defaults to every projected field (plus
+                everything in raw when the full item was kept)
+
+        Returns:
+            Dictionary without missing fields
+        """
+        if fields is None:
+            base = dict(self.raw) if self.raw is not None else {}
+            base.update({field: getattr(self, field) for field in self.FIELDS if getattr(self, field) is not None})
+            return base
+        return {field: self.get(field) for field in fields if self.get(field) is not None}
+
+    def __repr__(self) -> str:
+        return f"Post(id={self.id!r}, shortCode={self.shortCode!r}, type={self.type!r})"
+
+PostLike = Union[Post, Dict[str, Any]]
+
+def project_posts(items: Iterable[Dict[str, Any]], keep_raw: bool = False) -> List[Post]:
+    """
+    Project raw Apify items onto Posts.
+    """
+    return [Post.from_item(item, keep_raw=keep_raw) for item in items]
+
+def posts_to_dicts(posts: Iterable[PostLike], fields: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+    """
+    Convert posts (Posts or raw items) to JSON-serializable dictionaries.
+
+    Args:
+        posts: Posts or raw Apify items
+        fields: Keys to include, defaults to all available
+
+    Returns:
+        List of dictionaries
+    """
+    result = []
+    for post in posts:
+        if isinstance(post, Post):
+            result.append(post.to_dict(fields))
+        elif fields is None:
+            result.append(post)
+        else:
+            result.append({field: post[field] for field in fields if post.get(field) is not None})
+    return result
+
+def parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """
+    Parse a comma-separated fields= query parameter.
+
+    Returns:
+        List of field names, or None when no projection was requested
+    """
+    if not fields:
+        return None
+    return [field.strip() for field in fields.split(",") if field.strip()]
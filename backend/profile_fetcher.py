@@ -0,0 +1,331 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set, Tuple
+
+from clients import get_apify_client
+from metrics import get_logger, track_stage
+from posts import Post
+from resilience import get_circuit_breaker
+from singleflight import SingleFlight
+from stage_limits import stage_slot
+
+logger = get_logger("profile_fetcher")
+
+INSTAGRAM_SCRAPER_ACTOR_ID = "shu8hvrXbJbY3Eb9W"
+# Seconds an actor run may take before it is aborted
+APIFY_RUN_DEADLINE = float(os.getenv("APIFY_RUN_DEADLINE", "300"))
+# Seconds between run status / dataset polls while the actor is running
+APIFY_POLL_INTERVAL = float(os.getenv("APIFY_POLL_INTERVAL", "2"))
+# Posts fetched per profile; the content planner picks the ones analyzed from these.
+# Apify bills per result, so raising this (e.g. to give the planner more than
+# CONTENT_MAX_POSTS to choose from) makes every scrape cost more
+APIFY_RESULTS_LIMIT = int(os.getenv("APIFY_RESULTS_LIMIT", "5"))
+
+_TERMINAL_RUN_STATUSES = {"SUCCEEDED", "FAILED", "ABORTED", "TIMED-OUT"}
+
+PostCallback = Callable[[Post], None]
+
+class ApifyRunFailed(RuntimeError):
+    """
+    Raised when an actor run ends in a status other than SUCCEEDED, so a
+    failed scrape is never mistaken for a profile without posts.
+    """
+
+    def __init__(self, run_id: str, status: str):
+        super().__init__(f"Apify run {run_id} ended with status {status}")
+        self.run_id = run_id
+        self.status = status
+
+async def iter_instagram_posts(
+    username: str, deadline: Optional[float] = None, fields: Optional[List[str]] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Run the Apify Instagram scraper actor for a username, yielding post items
+    as they land in the run's dataset instead of waiting for the run to finish.
+
+    Args:
+        username: Instagram username to fetch data for
+        deadline: Seconds the run may take, defaults to APIFY_RUN_DEADLINE
+        fields: Only download these item keys, defaults to the whole item
+
+    Yields:
+        Post items from the actor's dataset, in dataset order
+
+    Raises:
+        TimeoutError: If the run doesn't finish in time (the run is aborted)
+        ApifyRunFailed: If the run ends FAILED, ABORTED or TIMED-OUT (after
+            the items it did produce)
+    """
+    client = get_apify_client()
+    deadline = APIFY_RUN_DEADLINE if deadline is None else deadline
+
+    # Prepare the Actor input
+    run_input = {
+        "directUrls": [f"https://www.instagram.com/{username}"],
+        "resultsType": "posts",
+        "resultsLimit": APIFY_RESULTS_LIMIT,
+        "searchType": "hashtag",
+        "searchLimit": 1,
+        "addParentData": False,
+    }
+
+    async with stage_slot("apify"):
+        # Start the Actor without waiting for it to finish. The Apify client
+        # retries on its own; the breaker fails fast while Apify is down.
+        with get_circuit_breaker("apify").guard():
+            run = await client.actor(INSTAGRAM_SCRAPER_ACTOR_ID).start(run_input=run_input)
+        run_client = client.run(run["id"])
+        dataset = client.dataset(run["defaultDatasetId"])
+        expires_at = time.monotonic() + deadline
+        offset = 0
+        finished = False
+        try:
+            while True:
+                # Check the status before reading, so the read after the run
+                # has finished is guaranteed to see every item
+                run = await run_client.get() or run
+                finished = run.get("status") in _TERMINAL_RUN_STATUSES
+                page = await dataset.list_items(offset=offset, fields=fields)
+                offset += len(page.items)
+                for item in page.items:
+                    yield item
+                if finished:
+                    if run["status"] != "SUCCEEDED":
+                        raise ApifyRunFailed(run["id"], run["status"])
+                    return
+                if time.monotonic() >= expires_at:
+                    raise TimeoutError(f"Apify run for {username} did not finish within {deadline:g} seconds")
+                await asyncio.sleep(APIFY_POLL_INTERVAL)
+        finally:
+            if not finished:
+                # Timed out, cancelled or abandoned by the consumer: stop paying for the run
+                try:
+                    await run_client.abort()
+                except Exception as e:
+                    logger.warning("Error aborting Apify run %s: %s", run["id"], e)
+
+async def scrape_instagram_posts(
+    username: str, on_post: Optional[PostCallback] = None, keep_raw: bool = False
+) -> List[Post]:
+    """
+    Run the Apify Instagram scraper actor for a username and project each
+    item onto a Post as it arrives.
+
+    Args:
+        username: Instagram username to fetch data for
+        on_post: Called with each post as soon as it arrives
+        keep_raw: Download and keep the full Apify items, not just the Post fields
+
+    Returns:
+        List of posts from the actor's dataset
+    """
+    posts = []
+    with track_stage("apify_fetch"):
+        async for item in iter_instagram_posts(username, fields=None if keep_raw else list(Post.FIELDS)):
+            post = Post.from_item(item, keep_raw=keep_raw)
+            posts.append(post)
+            if on_post is not None:
+                on_post(post)
+    return posts
+
+class ProfileCache:
+    """
+    Per-username cache of scraped posts with stale-while-revalidate.
+
+    Entries younger than ttl_seconds are served as-is. Entries older than
+    that but within stale_seconds more are served immediately while a
+    background refresh runs. Anything older is scraped again before
+    returning. A scrape that finds no posts is returned but not cached, so
+    a hiccup doesn't hide a profile's posts for the whole TTL, and a
+    cached entry is never replaced by an empty one.
+    """
+
+    def __init__(self, ttl_seconds: float = 900, stale_seconds: float = 6 * 3600, max_entries: int = 1000):
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[List[Post], float]]" = OrderedDict()
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        # Callers waiting on an in-flight scrape that want posts as they arrive,
+        # and the posts that scrape has produced so far
+        self._listeners: Dict[str, List[PostCallback]] = {}
+        self._partial: Dict[str, List[Post]] = {}
+        self._background_tasks: Set[asyncio.Task] = set()
+        # Concurrent misses, refreshes and background revalidations for the
+        # same username share a single actor run
+        self._scrapes = SingleFlight("apify_scrape")
+        self._counters = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "refreshes": 0,
+            "background_refreshes": 0,
+            "background_refresh_errors": 0,
+            "empty_scrapes": 0,
+        }
+
+    def _store(self, username: str, posts: List[Post]) -> float:
+        fetched_at = time.time()
+        self._entries[username] = (posts, fetched_at)
+        self._entries.move_to_end(username)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return fetched_at
+
+    def _publish(self, username: str, post: Post) -> None:
+        self._partial.setdefault(username, []).append(post)
+        for listener in list(self._listeners.get(username, ())):
+            try:
+                listener(post)
+            except Exception as e:
+                logger.warning("Error in post listener for %s: %s", username, e)
+
+    async def _scrape_and_store(self, username: str, on_post: Optional[PostCallback] = None) -> Tuple[List[Post], float]:
+        async def scrape() -> Tuple[List[Post], float]:
+            try:
+                posts = await scrape_instagram_posts(username, on_post=lambda post: self._publish(username, post))
+            finally:
+                self._partial.pop(username, None)
+            if not posts:
+                self._counters["empty_scrapes"] += 1
+                return posts, time.time()
+            return posts, self._store(username, posts)
+
+        if on_post is not None:
+            # Joining a scrape that is already under way: catch up on what it has produced
+            for post in list(self._partial.get(username, ())):
+                on_post(post)
+            self._listeners.setdefault(username, []).append(on_post)
+        try:
+            return await self._scrapes.do(username, scrape)
+        finally:
+            if on_post is not None:
+                listeners = self._listeners.get(username, [])
+                listeners.remove(on_post)
+                if not listeners:
+                    self._listeners.pop(username, None)
+
+    async def _background_refresh(self, username: str) -> None:
+        try:
+            await self._scrape_and_store(username)
+        except Exception as e:
+            self._counters["background_refresh_errors"] += 1
+            logger.warning("Background refresh of Instagram data for %s failed: %s", username, e)
+        finally:
+            self._refreshing.pop(username, None)
+
+    def _schedule_refresh(self, username: str) -> None:
+        if username in self._refreshing:
+            return
+        self._counters["background_refreshes"] += 1
+        task = asyncio.ensure_future(self._background_refresh(username))
+        self._refreshing[username] = task
+        # Keep a strong reference so the task isn't garbage collected mid-flight
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def get(self, username: str, refresh: bool = False, on_post: Optional[PostCallback] = None) -> Dict[str, Any]:
+        """
+        Get the latest posts for a username, scraping only when needed.
+
+        Args:
+            username: Instagram username to fetch data for
+            refresh: Bypass the cache and scrape now (the result is still cached)
+            on_post: Called with each post item as it arrives when this call has
+                to wait for a scrape, so later stages can start early
+
+        Returns:
+            Dictionary with username, data (Posts) and cache metadata
+        """
+        key = username.lower()
+        now = time.time()
+        entry = None if refresh else self._entries.get(key)
+
+        if entry is not None:
+            posts, fetched_at = entry
+            age = now - fetched_at
+            if age <= self.ttl_seconds:
+                status = "hit"
+                self._counters["hits"] += 1
+                self._entries.move_to_end(key)
+            elif age <= self.ttl_seconds + self.stale_seconds:
+                status = "stale"
+                self._counters["stale_hits"] += 1
+                self._schedule_refresh(key)
+            else:
+                entry = None
+
+        if entry is None:
+            status = "refresh" if refresh else "miss"
+            self._counters["refreshes" if refresh else "misses"] += 1
+            posts, fetched_at = await self._scrape_and_store(key, on_post=on_post)
+
+        return {
+            "username": username,
+            "data": posts,
+            "cache": {
+                "status": status,
+                "age_seconds": round(time.time() - fetched_at, 3),
+                "fetched_at": fetched_at,
+            },
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return hit/miss counters and the number of cached usernames.
+        """
+        return {
+            **self._counters,
+            "entries": len(self._entries),
+            "refreshing": len(self._refreshing),
+        }
+
+_profile_cache: Optional[ProfileCache] = None
+
+def get_profile_cache() -> ProfileCache:
+    """
+    Return the process-wide profile cache, configured from the environment.
+
+    Environment variables:
+        PROFILE_CACHE_TTL: Seconds a scrape is served without revalidation
+        PROFILE_CACHE_STALE: Extra seconds a scrape may be served while it is refreshed in the background
+        PROFILE_CACHE_MAX_ENTRIES: Maximum number of cached usernames
+
+    Returns:
+        Shared ProfileCache instance
+    """
+    global _profile_cache
+    if _profile_cache is None:
+        _profile_cache = ProfileCache(
+            ttl_seconds=float(os.getenv("PROFILE_CACHE_TTL", "900")),
+            stale_seconds=float(os.getenv("PROFILE_CACHE_STALE", str(6 * 3600))),
+            max_entries=int(os.getenv("PROFILE_CACHE_MAX_ENTRIES", "1000")),
+        )
+    return _profile_cache
+
+async def fetch_instagram_profile(
+    username: str, refresh: bool = False, on_post: Optional[PostCallback] = None, include_raw: bool = False
+) -> Dict[str, Any]:
+    """
+    Retrieve Instagram data for a username through the shared profile cache.
+
+    Args:
+        username: Instagram username to fetch data for
+        refresh: Bypass the cache and scrape now
+        on_post: Called with each post as it arrives if a scrape is needed
+        include_raw: Scrape now and keep the full Apify items on each Post.
+            Raw items are never cached, so this always runs the actor.
+
+    Returns:
+        Dictionary with username, data (Posts) and cache metadata
+    """
+    if include_raw:
+        posts = await scrape_instagram_posts(username, on_post=on_post, keep_raw=True)
+        return {
+            "username": username,
+            "data": posts,
+            "cache": {"status": "bypass", "age_seconds": 0.0, "fetched_at": time.time()},
+        }
+    return await get_profile_cache().get(username, refresh=refresh, on_post=on_post)
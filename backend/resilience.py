@@ -0,0 +1,380 @@
+import asyncio
+import collections
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterator, Optional, TypeVar
+
+import httpx
+
+from metrics import (
+    CIRCUIT_REJECTIONS,
+    CIRCUIT_STATE,
+    CIRCUIT_TRANSITIONS,
+    HEDGE_WINS,
+    HEDGES,
+    RETRIES,
+    RETRIES_EXHAUSTED,
+    get_logger,
+)
+from tracing import span
+
+T = TypeVar("T")
+
+logger = get_logger("resilience")
+
+# External dependencies guarded by a circuit breaker
+DEPENDENCIES = ("apify", "cdn", "gemini")
+
+# Rate limited, or a transient server-side error
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+# Attempts per call (including the first) unless <DEPENDENCY>_RETRY_ATTEMPTS is set.
+# Apify isn't listed: its client already retries internally.
+_DEFAULT_ATTEMPTS = {"cdn": 2, "gemini": 3}
+
+class CircuitOpenError(RuntimeError):
+    """
+    Raised instead of calling a dependency whose circuit breaker is open.
+    """
+
+    def __init__(self, dependency: str, retry_in: float):
+        super().__init__(f"{dependency} is unavailable (circuit open, next attempt in {retry_in:.0f}s)")
+        self.dependency = dependency
+        self.retry_in = retry_in
+
+def _status_code(error: BaseException) -> Optional[int]:
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code
+    # google.api_core exceptions carry the HTTP status as code, Apify's as status_code
+    for attribute in ("code", "status_code"):
+        code = getattr(error, attribute, None)
+        if isinstance(code, int):
+            return code
+    return None
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Whether an error is transient: a timeout, a connection failure, a 429
+    or a 5xx. Client errors such as a 400 or 404 are not.
+    """
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, (asyncio.TimeoutError, httpx.TransportError, ConnectionError)):
+        return True
+    return _status_code(error) in RETRYABLE_STATUS
+
+def _retry_after(error: BaseException) -> Optional[float]:
+    if isinstance(error, httpx.HTTPStatusError):
+        try:
+            return float(error.response.headers.get("retry-after", ""))
+        except ValueError:
+            return None
+    return None
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter: before retry n the caller sleeps a
+    random time between 0 and min(max_delay, base_delay * 2 ** (n - 1)), so
+    callers that failed together don't retry together.
+    """
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt: int, error: Optional[BaseException] = None) -> float:
+        """
+        Seconds to wait after the given (1-based) failed attempt. A server's
+        Retry-After is honoured up to max_delay.
+        """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        retry_after = _retry_after(error) if error is not None else None
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+class CircuitBreaker:
+    """
+    Per-dependency circuit breaker.
+
+    After failure_threshold consecutive transient failures the circuit
+    opens and calls fail fast with CircuitOpenError. After
+    recovery_seconds one trial call is let through (half-open): success
+    closes the circuit, failure opens it again. Client errors count as
+    successes, since the dependency did answer.
+    """
+
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+    _STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, dependency: str, failure_threshold: int = 5, recovery_seconds: float = 30.0):
+        self.dependency = dependency
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._counters = {
+            "calls": 0,
+            "failures": 0,
+            "rejections": 0,
+            "opened": 0,
+        }
+        CIRCUIT_STATE.set(0, dependency=dependency)
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def _set_state(self, state: str) -> None:
+        # Caller holds the lock
+        if state == self._state:
+            return
+        self._state = state
+        CIRCUIT_STATE.set(self._STATE_VALUES[state], dependency=self.dependency)
+        CIRCUIT_TRANSITIONS.inc(dependency=self.dependency, state=state)
+        if state == self.OPEN:
+            self._counters["opened"] += 1
+            self._opened_at = time.monotonic()
+            logger.warning("Circuit for %s opened after %d failures", self.dependency, self._consecutive_failures)
+
+    def _before_call(self) -> None:
+        with self._lock:
+            if self._state == self.OPEN:
+                retry_in = self._opened_at + self.recovery_seconds - time.monotonic()
+                if retry_in > 0:
+                    self._reject(retry_in)
+                self._set_state(self.HALF_OPEN)
+                self._probe_in_flight = False
+            if self._state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    self._reject(0)
+                self._probe_in_flight = True
+            self._counters["calls"] += 1
+
+    def _reject(self, retry_in: float) -> None:
+        # Caller holds the lock
+        self._counters["rejections"] += 1
+        CIRCUIT_REJECTIONS.inc(dependency=self.dependency)
+        raise CircuitOpenError(self.dependency, retry_in)
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._consecutive_failures = 0
+            self._probe_in_flight = False
+            self._set_state(self.CLOSED)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._counters["failures"] += 1
+            self._consecutive_failures += 1
+            self._probe_in_flight = False
+            if self._state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                self._set_state(self.OPEN)
+
+    @contextmanager
+    def guard(self) -> Iterator[None]:
+        """
+        Run a block as one call to the dependency, failing fast with
+        CircuitOpenError while the circuit is open.
+        """
+        self._before_call()
+        try:
+            yield
+        except Exception as e:
+            if is_retryable(e):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        except BaseException:
+            # Cancelled (e.g. a losing hedge): no verdict, but free the probe slot
+            with self._lock:
+                self._probe_in_flight = False
+            raise
+        self.record_success()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return the state and call / failure / rejection counters.
+        """
+        with self._lock:
+            return {"state": self._state, "consecutive_failures": self._consecutive_failures, **self._counters}
+
+class LatencyTracker:
+    """
+    Recent latencies of a dependency, used to choose when to hedge: a
+    duplicate request is sent once the first has taken longer than the
+    given percentile of recent successful requests.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 95,
+        window: int = 200,
+        min_samples: int = 20,
+        default_delay: float = 1.0,
+        min_delay: float = 0.05,
+    ):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self._samples: Deque[float] = collections.deque(maxlen=window)
+
+    def observe(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def delay(self) -> float:
+        """
+        Seconds to wait before hedging; default_delay until min_samples
+        latencies have been seen.
+        """
+        samples = sorted(self._samples)
+        if len(samples) < self.min_samples:
+            return self.default_delay
+        index = min(len(samples) - 1, int(len(samples) * self.percentile / 100))
+        return max(self.min_delay, samples[index])
+
+async def hedged(dependency: str, fn: Callable[[], Awaitable[T]], delay: float) -> T:
+    """
+    Call fn(), and if it hasn't finished after delay seconds call it again;
+    return whichever succeeds first and cancel the other.
+
+    Args:
+        dependency: Dependency name for the metrics
+        fn: Zero-argument callable returning the coroutine to run; must be safe to run twice
+        delay: Seconds to wait before sending the duplicate
+
+    Returns:
+        Result of the first successful call
+
+    Raises:
+        The last error when both calls fail
+    """
+    first = asyncio.ensure_future(fn())
+    second: Optional[asyncio.Future] = None
+    try:
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+        HEDGES.inc(dependency=dependency)
+        second = asyncio.ensure_future(fn())
+        pending = {first, second}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        HEDGE_WINS.inc(dependency=dependency)
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in (first, second):
+            if task is not None and not task.done():
+                task.cancel()
+
+async def resilient_call(
+    dependency: str,
+    fn: Callable[[], Awaitable[T]],
+    retry: Optional[RetryPolicy] = None,
+) -> T:
+    """
+    Call a dependency through its circuit breaker, retrying transient
+    errors with jittered exponential backoff.
+
+    Args:
+        dependency: One of DEPENDENCIES
+        fn: Zero-argument callable returning the coroutine to run, called once per attempt
+        retry: Retry policy, defaults to the dependency's (see get_retry_policy)
+
+    Returns:
+        Result of the first successful attempt
+
+    Raises:
+        CircuitOpenError: If the dependency's circuit is open
+        The last error when it isn't retryable or attempts run out
+    """
+    breaker = get_circuit_breaker(dependency)
+    retry = retry or get_retry_policy(dependency)
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            with breaker.guard():
+                return await fn()
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            if attempt >= retry.max_attempts:
+                RETRIES_EXHAUSTED.inc(dependency=dependency)
+                raise
+            delay = retry.backoff(attempt, e)
+            RETRIES.inc(dependency=dependency)
+            logger.warning("%s call failed (%s), retry %d in %.2fs", dependency, str(e) or type(e).__name__, attempt, delay)
+            with span("retry_backoff", dependency=dependency, attempt=attempt, error=type(e).__name__):
+                await asyncio.sleep(delay)
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_retry_policies: Dict[str, RetryPolicy] = {}
+_registry_lock = threading.Lock()
+
+def get_circuit_breaker(dependency: str) -> CircuitBreaker:
+    """
+    Return the process-wide circuit breaker of a dependency, configured from the environment.
+
+    Environment variables:
+        CIRCUIT_FAILURE_THRESHOLD: Consecutive transient failures that open a circuit
+        CIRCUIT_RECOVERY_SECONDS: Seconds an open circuit waits before letting a trial call through
+
+    Returns:
+        Shared CircuitBreaker instance
+    """
+    breaker = _breakers.get(dependency)
+    if breaker is None:
+        with _registry_lock:
+            breaker = _breakers.get(dependency)
+            if breaker is None:
+                breaker = _breakers[dependency] = CircuitBreaker(
+                    dependency,
+                    failure_threshold=int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5")),
+                    recovery_seconds=float(os.getenv("CIRCUIT_RECOVERY_SECONDS", "30")),
+                )
+    return breaker
+
+def get_retry_policy(dependency: str) -> RetryPolicy:
+    """
+    Return the retry policy of a dependency, configured from the environment.
+
+    Environment variables:
+        <DEPENDENCY>_RETRY_ATTEMPTS: Attempts per call including the first, e.g. GEMINI_RETRY_ATTEMPTS
+        RETRY_BASE_DELAY: Backoff before the first retry, in seconds (doubles per retry)
+        RETRY_MAX_DELAY: Longest backoff, in seconds
+
+    Returns:
+        Shared RetryPolicy instance
+    """
+    policy = _retry_policies.get(dependency)
+    if policy is None:
+        policy = _retry_policies[dependency] = RetryPolicy(
+            max_attempts=int(os.getenv(f"{dependency.upper()}_RETRY_ATTEMPTS", str(_DEFAULT_ATTEMPTS.get(dependency, 1)))),
+            base_delay=float(os.getenv("RETRY_BASE_DELAY", "0.5")),
+            max_delay=float(os.getenv("RETRY_MAX_DELAY", "8")),
+        )
+    return policy
+
+def circuit_stats() -> Dict[str, Dict[str, Any]]:
+    """
+    Return the state and counters of every dependency's circuit breaker.
+    """
+    return {dependency: get_circuit_breaker(dependency).stats() for dependency in DEPENDENCIES}
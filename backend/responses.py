@@ -0,0 +1,174 @@
+import asyncio
+import gzip
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional; gzip is always available
+    brotli = None
+
+# Responses smaller than this aren't worth compressing
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))
+# Bodies at least this large are compressed in a worker thread, not on the event loop
+COMPRESSION_THREAD_MIN_BYTES = int(os.getenv("COMPRESSION_THREAD_MIN_BYTES", "65536"))
+
+# Streaming content types are left alone so events aren't held back by the compressor
+_UNCOMPRESSED_TYPES = (b"text/event-stream", b"application/x-ndjson")
+
+def _orjson_default(value: Any) -> Any:
+    # Only reached for types orjson doesn't know (e.g. pydantic models)
+    return jsonable_encoder(value)
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON response rendered with orjson.
+
+    Returned directly from a route, it also skips FastAPI's
+    jsonable_encoder walk, which dominates the cost of large plain
+    dict/list payloads. Unknown types still fall back to jsonable_encoder.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+def _parse_accept_encoding(accept_encoding: str) -> Dict[str, float]:
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, *params = part.split(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = min(max(float(value), 0.0), 1.0)
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+    return accepted
+
+def _choose_encoding(accept_encoding: str) -> Optional[str]:
+    """
+    Pick the response encoding for an Accept-Encoding header value.
+
+    The supported coding with the highest q-value wins; ties go to brotli,
+    then gzip, then identity. Codings the header doesn't name get the
+    q-value of "*", or are refused if there is none. Identity only
+    competes when named or covered by "*"; otherwise it is the fallback
+    when nothing else is acceptable.
+
+    Returns:
+        "br" or "gzip", or None to send the body uncompressed
+    """
+    accepted = _parse_accept_encoding(accept_encoding)
+    default = accepted.get("*", 0.0)
+    candidates = (["br"] if brotli is not None else []) + ["gzip"]
+    qualities = {name: accepted.get(name, default) for name in candidates}
+    qualities["identity"] = accepted.get("identity", default)
+    # max keeps the first of equal qualities, so the order above breaks ties
+    best = max(qualities, key=qualities.get)
+    if best == "identity" or qualities[best] <= 0:
+        return None
+    return best
+
+def compress(body: bytes, encoding: str) -> bytes:
+    """
+    Compress a response body with "br" or "gzip".
+    """
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+def _add_vary(headers: List[Tuple[bytes, bytes]]) -> List[Tuple[bytes, bytes]]:
+    # Merge Accept-Encoding into an existing Vary header instead of sending a second one
+    for i, (name, value) in enumerate(headers):
+        if name.lower() == b"vary":
+            fields = [field.strip().lower() for field in value.split(b",")]
+            if b"accept-encoding" not in fields and b"*" not in fields:
+                headers[i] = (name, value + b", Accept-Encoding")
+            return headers
+    return headers + [(b"vary", b"Accept-Encoding")]
+
+class CompressionMiddleware:
+    """
+    ASGI middleware that compresses complete responses with brotli or gzip,
+    whichever the client prefers and is available, once they reach
+    minimum_size bytes. Bodies of thread_min_size bytes or more are
+    compressed in a worker thread so the event loop isn't blocked.
+
+    Only single-message bodies are compressed; streamed responses
+    (NDJSON / SSE progress streams) pass through untouched so each event
+    reaches the client as soon as it is sent.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MIN_BYTES, thread_min_size: int = COMPRESSION_THREAD_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.thread_min_size = thread_min_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        encoding = _choose_encoding(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start: Optional[Message] = None
+        passthrough = False
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                # Hold the headers until we know whether the body is compressible
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            response_headers: List[Tuple[bytes, bytes]] = list(start.get("headers", []))
+            names = {name.lower(): value for name, value in response_headers}
+            if (
+                message.get("more_body", False)
+                or len(body) < self.minimum_size
+                or b"content-encoding" in names
+                or names.get(b"content-type", b"").startswith(_UNCOMPRESSED_TYPES)
+            ):
+                passthrough = True
+                await send(start)
+                await send(message)
+                return
+
+            if len(body) >= self.thread_min_size:
+                compressed = await asyncio.to_thread(compress, body, encoding)
+            else:
+                compressed = compress(body, encoding)
+            response_headers = [
+                (name, value) for name, value in response_headers if name.lower() != b"content-length"
+            ]
+            response_headers += [
+                (b"content-encoding", encoding.encode("latin-1")),
+                (b"content-length", str(len(compressed)).encode("latin-1")),
+            ]
+            response_headers = _add_vary(response_headers)
+            await send({**start, "headers": response_headers})
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_compressed)
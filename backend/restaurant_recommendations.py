@@ -1,60 +1,222 @@
-import os
 import json
-import google.generativeai as genai
-from dotenv import load_dotenv
-from typing import Dict, List, Any
+import asyncio
+from typing import AsyncIterator, Dict, List, Any
+from clients import get_gemini_model
+from gemini_scheduler import generate_content, stream_content
+from llm_cache import get_llm_cache, make_cache_key
+from singleflight import SingleFlight
+from stage_limits import stage_slot
+from metrics import get_logger, track_stage
 
-# Load environment variables from .env file if it exists
-load_dotenv()
+logger = get_logger("restaurant_recommendations")
 
-# Configure the Gemini API with your API key
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
-    raise ValueError("GEMINI_API_KEY environment variable is not set")
+RECOMMENDATIONS_MODEL = 'gemini-2.0-flash'
+RECOMMENDATIONS_PROMPT_TEMPLATE = """Given I have a customer with this profile-   "analysis": "{analysis}",
+Generate a list of best restaurant recommendations. Please output this as JSON with this schema- {{restaurant_name : string, restaurant_location  : string, restaurant_description : string }}[]. Generate this JSON array and this JSON only."""
+# Bump when RECOMMENDATIONS_PROMPT_TEMPLATE or the parsing changes, so cached recommendations are not reused
+RECOMMENDATIONS_PROMPT_VERSION = "1"
 
-genai.configure(api_key=GEMINI_API_KEY)
+# Identical concurrent requests share one Gemini call
+_recommendations_flight = SingleFlight("recommendations_generation")
 
-def get_restaurant_recommendations(analysis: str) -> List[Dict[str, str]]:
+def _build_recommendations_prompt(analysis: str) -> str:
     """
-    Generate restaurant recommendations based on customer profile analysis.
+    Build the Gemini prompt used to generate restaurant recommendations.
     
     Args:
         analysis: String containing the customer profile analysis
         
     Returns:
-        List of restaurant recommendations as dictionaries with name, location, and description
+        Prompt text
     """
-    # Initialize Gemini model
-    model = genai.GenerativeModel('gemini-2.0-flash')
+    return RECOMMENDATIONS_PROMPT_TEMPLATE.format(analysis=analysis)
+
+def _recommendations_cache_key(analysis: str) -> str:
+    """
+    Build the cache key for an analysis. Whitespace is normalized so that
+    analyses differing only in formatting share an entry.
     
-    # Prepare prompt for Gemini
-    prompt = f"""Given I have a customer with this profile-   "analysis": "{analysis}",
-Generate a list of best restaurant recommendations. Please output this as JSON with this schema- {{restaurant_name : string, restaurant_location  : string, restaurant_description : string }}[]. Generate this JSON array and this JSON only."""
+    Args:
+        analysis: String containing the customer profile analysis
+        
+    Returns:
+        Cache key
+    """
+    normalized = " ".join(analysis.split())
+    return make_cache_key(
+        "recommendations",
+        RECOMMENDATIONS_MODEL,
+        RECOMMENDATIONS_PROMPT_VERSION,
+        [RECOMMENDATIONS_PROMPT_TEMPLATE, normalized]
+    )
+
+def _parse_recommendations(response_text: str) -> List[Dict[str, str]]:
+    """
+    Parse the JSON array of recommendations out of a Gemini response.
     
-    try:
+    Args:
+        response_text: Raw text returned by Gemini
+        
+    Returns:
+        List of restaurant recommendations
+    """
+    # Sometimes the response might include markdown code blocks, so we need to extract the JSON
+    if "```json" in response_text:
+        json_start = response_text.find("```json") + 7
+        json_end = response_text.find("```", json_start)
+        json_str = response_text[json_start:json_end].strip()
+    elif "```" in response_text:
+        json_start = response_text.find("```") + 3
+        json_end = response_text.find("```", json_start)
+        json_str = response_text[json_start:json_end].strip()
+    else:
+        json_str = response_text.strip()
+    
+    # Parse the JSON string into a Python object
+    return json.loads(json_str)
+
+async def get_restaurant_recommendations_async(analysis: str) -> List[Dict[str, str]]:
+    """
+    Generate restaurant recommendations without blocking the event loop.
+    
+    Results are memoized in the persistent LLM cache, keyed on the normalized
+    analysis and the prompt template, and shared by every caller. Only
+    successfully parsed JSON is cached. Transient Gemini errors are retried.
+    
+    Args:
+        analysis: String containing the customer profile analysis
+        
+    Returns:
+        List of restaurant recommendations as dictionaries with name, location, and description
+        
+    Raises:
+        Exception: When Gemini still fails after retries or its answer isn't
+            valid JSON, so a failure is never stored as an empty result
+    """
+    llm_cache = get_llm_cache()
+    cache_key = _recommendations_cache_key(analysis)
+    
+    async def generate() -> List[Dict[str, str]]:
+        cached = await llm_cache.aget(cache_key)
+        if cached is not None:
+            return json.loads(cached)
+        
+        # Shared Gemini model
+        model = get_gemini_model(RECOMMENDATIONS_MODEL)
+        
         # Generate content using Gemini
-        response = model.generate_content(prompt)
-        response_text = response.text
-        
-        # Sometimes the response might include markdown code blocks, so we need to extract the JSON
-        if "```json" in response_text:
-            json_start = response_text.find("```json") + 7
-            json_end = response_text.find("```", json_start)
-            json_str = response_text[json_start:json_end].strip()
-        elif "```" in response_text:
-            json_start = response_text.find("```") + 3
-            json_end = response_text.find("```", json_start)
-            json_str = response_text[json_start:json_end].strip()
-        else:
-            json_str = response_text.strip()
-        
-        # Parse the JSON string into a Python object
-        recommendations = json.loads(json_str)
+        async with stage_slot("gemini"):
+            with track_stage("recommendations"):
+                response = await generate_content(model, _build_recommendations_prompt(analysis))
+        recommendations = _parse_recommendations(response.text)
+        if isinstance(recommendations, list):
+            await llm_cache.aput(cache_key, json.dumps(recommendations), "recommendations", RECOMMENDATIONS_PROMPT_VERSION)
         return recommendations
+    
+    try:
+        return await _recommendations_flight.do(cache_key, generate)
     except Exception as e:
-        error_msg = f"Error generating restaurant recommendations: {str(e)}"
-        print(error_msg)
-        return []
+        logger.warning("Error generating restaurant recommendations: %s", e)
+        raise
+
+class _IncrementalArrayParser:
+    """
+    Pull complete objects out of a JSON array while its text is still
+    arriving. Any prose or markdown fence before the opening bracket is
+    skipped.
+    """
+    
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._position = None  # Index just inside the array, once "[" is seen
+    
+    def feed(self, text: str) -> List[Any]:
+        """
+        Add text and return any array elements completed by it.
+        
+        Args:
+            text: Next piece of the streamed response
+            
+        Returns:
+            Newly completed elements, in order
+        """
+        self._buffer += text
+        if self._position is None:
+            start = self._buffer.find("[")
+            if start == -1:
+                return []
+            self._position = start + 1
+        
+        items = []
+        while True:
+            # Skip whitespace and separators between elements
+            while self._position < len(self._buffer) and self._buffer[self._position] in " \t\r\n,":
+                self._position += 1
+            if self._position >= len(self._buffer) or self._buffer[self._position] == "]":
+                return items
+            try:
+                item, end = self._decoder.raw_decode(self._buffer, self._position)
+            except json.JSONDecodeError:
+                # Element is incomplete; wait for more text
+                return items
+            items.append(item)
+            self._position = end
+
+async def stream_restaurant_recommendations(analysis: str) -> AsyncIterator[Dict[str, str]]:
+    """
+    Generate restaurant recommendations, yielding each one as soon as it has
+    been parsed from the streamed Gemini response.
+    
+    Cached recommendations are yielded immediately. A fully parsed response
+    is stored in the LLM cache under the same key as
+    get_restaurant_recommendations_async.
+    
+    Args:
+        analysis: String containing the customer profile analysis
+        
+    Yields:
+        Restaurant recommendation dictionaries
+    """
+    llm_cache = get_llm_cache()
+    cache_key = _recommendations_cache_key(analysis)
+    cached = await llm_cache.aget(cache_key)
+    if cached is not None:
+        for recommendation in json.loads(cached):
+            yield recommendation
+        return
+    
+    model = get_gemini_model(RECOMMENDATIONS_MODEL)
+    parser = _IncrementalArrayParser()
+    chunks = []
+    # The Gemini slot is released once the response is read, however slowly the client reads
+    async for text in stream_content(model, _build_recommendations_prompt(analysis), "recommendations"):
+        chunks.append(text)
+        for recommendation in parser.feed(text):
+            yield recommendation
+    
+    try:
+        recommendations = _parse_recommendations("".join(chunks))
+    except Exception as e:
+        logger.warning("Streamed recommendations were not valid JSON, not caching: %s", e)
+        return
+    if isinstance(recommendations, list):
+        await llm_cache.aput(cache_key, json.dumps(recommendations), "recommendations", RECOMMENDATIONS_PROMPT_VERSION)
+
+def get_restaurant_recommendations(analysis: str) -> List[Dict[str, str]]:
+    """
+    Generate restaurant recommendations based on customer profile analysis.
+    
+    Synchronous wrapper around get_restaurant_recommendations_async. Must not
+    be called from inside a running event loop.
+    
+    Args:
+        analysis: String containing the customer profile analysis
+        
+    Returns:
+        List of restaurant recommendations as dictionaries with name, location, and description
+    """
+    return asyncio.run(get_restaurant_recommendations_async(analysis))
 
 def test_with_analysis_file(analysis_file: str = "analysis_output.json", save_to_file: bool = False, output_file: str = "restaurant_recommendations.json") -> List[Dict[str, str]]:
     """
@@ -0,0 +1,315 @@
+import asyncio
+import atexit
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from typing import Any, Dict, List, Optional
+
+from metrics import get_logger, track_stage
+
+logger = get_logger("results_store")
+
+# Kinds of record written for each full-service run
+RESULT_KINDS = ("instagram_data", "analysis", "recommendations", "error")
+
+def _serialize(data: Any) -> bytes:
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+def _decode(payload: bytes) -> Any:
+    return json.loads(zlib.decompress(payload).decode("utf-8"))
+
+class ResultStore:
+    """
+    Compressed SQLite store of full-service results, indexed by username,
+    kind and time.
+
+    Each run writes one record per kind (scraped data, analysis,
+    recommendations or error) under a shared run id. Writes are queued and
+    applied by a background thread so the request path never waits on
+    disk; a read waits for queued writes of the username or run it asks
+    for, so it always sees a run whose id was already handed out. Records
+    older than retention_seconds, and all but the newest max_per_user runs
+    per username and kind, are deleted periodically.
+    """
+
+    def __init__(
+        self,
+        path: str = "cache/results.sqlite3",
+        retention_seconds: float = 30 * 24 * 3600,
+        max_per_user: int = 20,
+        retention_every: int = 100,
+    ):
+        self.path = path
+        self.retention_seconds = retention_seconds
+        self.max_per_user = max_per_user
+        self.retention_every = retention_every
+        self._lock = threading.Lock()
+        self._counters = {
+            "writes": 0,
+            "write_errors": 0,
+            "raw_bytes": 0,
+            "stored_bytes": 0,
+            "expired": 0,
+            "trimmed": 0,
+        }
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # Must be set before the first table is created to take effect
+        self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                run_id TEXT NOT NULL,
+                username TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                payload BLOB NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_user_kind ON results (username, kind, created_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_run ON results (run_id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_created ON results (created_at)")
+
+        # Queued writes per username and per run id, for reads to wait on
+        self._pending: Dict[str, int] = {}
+        self._pending_changed = threading.Condition()
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="result-store-writer", daemon=True)
+        self._writer.start()
+
+    def write(self, username: str, records: Dict[str, Any]) -> str:
+        """
+        Queue the records of one run for writing and return immediately.
+
+        Args:
+            username: Instagram username the run was for
+            records: Data keyed by kind (see RESULT_KINDS)
+
+        Returns:
+            Run id the records will be stored under
+        """
+        run_id = uuid.uuid4().hex
+        username = username.lower()
+        with self._pending_changed:
+            for key in (username, run_id):
+                self._pending[key] = self._pending.get(key, 0) + 1
+        self._queue.put((run_id, username, time.time(), records))
+        return run_id
+
+    def _wait_for_writes(self, key: str) -> None:
+        # Block until the queued writes of a username or run id are applied
+        with self._pending_changed:
+            self._pending_changed.wait_for(lambda: key not in self._pending)
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                with track_stage("result_write"):
+                    self._insert(*item)
+            except Exception as e:
+                with self._lock:
+                    self._counters["write_errors"] += 1
+                logger.error("Error writing results for %s: %s", item[1], e)
+            finally:
+                if item is not None:
+                    with self._pending_changed:
+                        for key in (item[1], item[0]):
+                            self._pending[key] -= 1
+                            if not self._pending[key]:
+                                del self._pending[key]
+                        self._pending_changed.notify_all()
+                self._queue.task_done()
+
+    def _insert(self, run_id: str, username: str, created_at: float, records: Dict[str, Any]) -> None:
+        rows, raw_bytes, stored_bytes = [], 0, 0
+        for kind, data in records.items():
+            raw = _serialize(data)
+            payload = zlib.compress(raw, 6)
+            raw_bytes += len(raw)
+            stored_bytes += len(payload)
+            rows.append((run_id, username, kind, created_at, payload))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO results (run_id, username, kind, created_at, payload) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self._counters["writes"] += 1
+            self._counters["raw_bytes"] += raw_bytes
+            self._counters["stored_bytes"] += stored_bytes
+            if self._counters["writes"] % self.retention_every == 0:
+                self._apply_retention()
+
+    def _apply_retention(self) -> None:
+        # Caller holds the lock
+        self._counters["expired"] += max(self._conn.execute(
+            "DELETE FROM results WHERE created_at < ?", (time.time() - self.retention_seconds,)
+        ).rowcount, 0)
+        self._counters["trimmed"] += max(self._conn.execute(
+            """
+            DELETE FROM results WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, ROW_NUMBER() OVER (PARTITION BY username, kind ORDER BY created_at DESC, id DESC) AS rank
+                    FROM results
+                ) WHERE rank > ?
+            )
+            """,
+            (self.max_per_user,),
+        ).rowcount, 0)
+        self._conn.execute("PRAGMA incremental_vacuum")
+
+    def compact(self) -> Dict[str, Any]:
+        """
+        Apply the retention policy now and rebuild the database file to
+        reclaim the space of deleted records.
+
+        Returns:
+            Dictionary with the file size before and after
+        """
+        self.flush()
+        before = os.path.getsize(self.path)
+        with self._lock:
+            self._apply_retention()
+            self._conn.execute("VACUUM")
+        return {"bytes_before": before, "bytes_after": os.path.getsize(self.path)}
+
+    def latest(self, username: str, kind: str = "analysis") -> Optional[Dict[str, Any]]:
+        """
+        Get the most recent record of a kind for a username.
+
+        Args:
+            username: Instagram username
+            kind: One of RESULT_KINDS
+
+        Returns:
+            Dictionary with run_id, username, kind, created_at and data, or None
+        """
+        self._wait_for_writes(username.lower())
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT run_id, created_at, payload FROM results WHERE username = ? AND kind = ? "
+                "ORDER BY created_at DESC, id DESC LIMIT 1",
+                (username.lower(), kind),
+            ).fetchone()
+        if row is None:
+            return None
+        return {"run_id": row[0], "username": username.lower(), "kind": kind, "created_at": row[1], "data": _decode(row[2])}
+
+    def get_run(self, run_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get every record written by one run.
+
+        Args:
+            run_id: Id returned by write
+
+        Returns:
+            Dictionary with run_id, username, created_at and data keyed by kind, or None
+        """
+        self._wait_for_writes(run_id)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT username, kind, created_at, payload FROM results WHERE run_id = ?", (run_id,)
+            ).fetchall()
+        if not rows:
+            return None
+        return {
+            "run_id": run_id,
+            "username": rows[0][0],
+            "created_at": rows[0][2],
+            "data": {kind: _decode(payload) for _, kind, _, payload in rows},
+        }
+
+    def history(self, username: str, limit: int = 20) -> List[Dict[str, Any]]:
+        """
+        List a username's runs, newest first, without their data.
+
+        Args:
+            username: Instagram username
+            limit: Maximum number of runs
+
+        Returns:
+            List of dictionaries with run_id, created_at and the kinds stored
+        """
+        self._wait_for_writes(username.lower())
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT run_id, MIN(created_at), GROUP_CONCAT(kind) FROM results WHERE username = ? "
+                "GROUP BY run_id ORDER BY MIN(created_at) DESC LIMIT ?",
+                (username.lower(), limit),
+            ).fetchall()
+        return [{"run_id": run_id, "created_at": created_at, "kinds": kinds.split(",")} for run_id, created_at, kinds in rows]
+
+    async def alatest(self, username: str, kind: str = "analysis") -> Optional[Dict[str, Any]]:
+        """
+        Async variant of latest; the query (and any wait for queued writes)
+        runs in a worker thread.
+        """
+        return await asyncio.to_thread(self.latest, username, kind)
+
+    def flush(self) -> None:
+        """
+        Block until every queued write has been applied.
+        """
+        self._queue.join()
+
+    def close(self) -> None:
+        """
+        Apply queued writes and stop the writer thread.
+        """
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return write counters, record counts and the compression ratio.
+        """
+        with self._lock:
+            records, usernames = self._conn.execute("SELECT COUNT(*), COUNT(DISTINCT username) FROM results").fetchone()
+            counters = dict(self._counters)
+        raw, stored = counters["raw_bytes"], counters["stored_bytes"]
+        return {
+            **counters,
+            "pending_writes": self._queue.qsize(),
+            "records": records,
+            "usernames": usernames,
+            "compression_ratio": round(raw / stored, 2) if stored else None,
+        }
+
+_result_store: Optional[ResultStore] = None
+
+def get_result_store() -> ResultStore:
+    """
+    Return the process-wide result store, configured from the environment.
+
+    Environment variables:
+        RESULTS_STORE_PATH: SQLite database file
+        RESULTS_RETENTION_DAYS: Days a result is kept
+        RESULTS_MAX_PER_USER: Runs kept per username and kind
+
+    Returns:
+        Shared ResultStore instance
+    """
+    global _result_store
+    if _result_store is None:
+        _result_store = ResultStore(
+            path=os.getenv("RESULTS_STORE_PATH", "cache/results.sqlite3"),
+            retention_seconds=float(os.getenv("RESULTS_RETENTION_DAYS", "30")) * 24 * 3600,
+            max_per_user=int(os.getenv("RESULTS_MAX_PER_USER", "20")),
+        )
+        # Don't lose queued writes when a CLI run exits
+        atexit.register(_result_store.close)
+    return _result_store
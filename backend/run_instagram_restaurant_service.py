@@ -4,8 +4,55 @@ Command-line interface for the Instagram Restaurant Recommendation service.
 This script provides a simple way to run the full service from the terminal.
 """
 import argparse
+import asyncio
 import json
+import time
 from instagram_restaurant_service import get_recommendations_from_instagram
+from instagram_restaurant_service import resolve_batch_settings, run_batch_async, summarize_batch
+
+def run_batch(usernames, args):
+    """
+    Run the full service for several usernames concurrently and print each
+    result as it finishes, followed by a summary. Outputs are saved per user
+    as in single-user mode unless --no-save is given.
+    """
+    settings = resolve_batch_settings(
+        concurrency=args.concurrency,
+        stage_concurrency={
+            "apify": args.apify_concurrency,
+            "download": args.download_concurrency,
+            "gemini": args.gemini_concurrency
+        }
+    )
+    
+    async def run():
+        results = []
+        started = time.monotonic()
+        async for result in run_batch_async(
+            usernames,
+            concurrency=settings["concurrency"],
+            stage_concurrency=settings["stage_concurrency"],
+            incremental=args.incremental,
+            save_outputs=not args.no_save,
+            output_dir=args.output_dir
+        ):
+            results.append(result)
+            if args.json_only:
+                print(json.dumps(result), flush=True)
+            else:
+                print(f"[{len(results)}/{len(usernames)}] @{result['username']}: {result['status']} "
+                      f"({len(result['recommendations'])} recommendations, {result['duration_seconds']}s)"
+                      + (f" - {result['error']}" if result["status"] == "error" else ""), flush=True)
+        return summarize_batch(results, time.monotonic() - started, settings)
+    
+    summary = asyncio.run(run())
+    if args.json_only:
+        print(json.dumps({"summary": summary}))
+    else:
+        print("\nBatch summary:")
+        for key, value in summary.items():
+            print(f"{key}: {value}")
+    return 1 if summary["errors"] == summary["total"] else 0
 
 def main():
     """
@@ -15,9 +62,35 @@ def main():
         description='Get restaurant recommendations based on Instagram profile analysis'
     )
     parser.add_argument(
-        'username', 
+        'usernames', 
+        type=str, 
+        nargs='*',
+        help='Instagram username(s) to analyze; more than one runs in batch mode'
+    )
+    parser.add_argument(
+        '--batch-file', 
         type=str, 
-        help='Instagram username to analyze'
+        help='File with one Instagram username per line to run in batch mode'
+    )
+    parser.add_argument(
+        '--concurrency', 
+        type=int, 
+        help='Batch mode: users processed at once'
+    )
+    parser.add_argument(
+        '--apify-concurrency', 
+        type=int, 
+        help='Batch mode: Apify actor runs at once'
+    )
+    parser.add_argument(
+        '--download-concurrency', 
+        type=int, 
+        help='Batch mode: users downloading images at once'
+    )
+    parser.add_argument(
+        '--gemini-concurrency', 
+        type=int, 
+        help='Batch mode: Gemini calls at once'
     )
     parser.add_argument(
         '--no-save', 
@@ -30,6 +103,11 @@ def main():
         default='outputs', 
         help='Directory to save output files'
     )
+    parser.add_argument(
+        '--incremental', 
+        action='store_true', 
+        help='Only analyze posts that were not analyzed in an earlier run'
+    )
     parser.add_argument(
         '--json-only', 
         action='store_true', 
@@ -38,12 +116,23 @@ def main():
     
     args = parser.parse_args()
     
+    usernames = list(args.usernames)
+    if args.batch_file:
+        with open(args.batch_file, "r") as f:
+            usernames.extend(line.strip().lstrip("@") for line in f if line.strip() and not line.startswith("#"))
+    if not usernames:
+        parser.error("give a username or --batch-file")
+    if len(usernames) > 1 or args.batch_file:
+        return run_batch(usernames, args)
+    args.username = usernames[0]
+    
     try:
         # Run the integrated service
         recommendations, output_files = get_recommendations_from_instagram(
             username=args.username,
             save_outputs=not args.no_save,
-            output_dir=args.output_dir
+            output_dir=args.output_dir,
+            incremental=args.incremental
         )
         
         if args.json_only:
@@ -0,0 +1,75 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, TypeVar
+
+from metrics import SINGLEFLIGHT_COALESCED, SINGLEFLIGHT_EXECUTIONS
+
+T = TypeVar("T")
+
+_groups: List["SingleFlight"] = []
+
+class SingleFlight:
+    """
+    In-flight de-duplication of async work.
+
+    Concurrent callers of do() with the same key share one task: the first
+    caller starts it and everyone else awaits the same result (or
+    exception). Once the task finishes the key is released, so later calls
+    start fresh work. A caller being cancelled does not cancel the shared
+    task for the other waiters.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[Any, asyncio.Future] = {}
+        self._counters = {
+            "calls": 0,
+            "executions": 0,
+            "coalesced": 0,
+        }
+        _groups.append(self)
+
+    async def do(self, key: Any, factory: Callable[[], Awaitable[T]]) -> T:
+        """
+        Run factory() for key unless a run for key is already in flight.
+
+        Args:
+            key: Identity of the work, e.g. a normalized username
+            factory: Zero-argument callable returning the coroutine to run
+
+        Returns:
+            Result of the shared run
+        """
+        self._counters["calls"] += 1
+        task = self._inflight.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            self._counters["executions"] += 1
+            SINGLEFLIGHT_EXECUTIONS.inc(group=self.name)
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done, key=key: self._release(key, done))
+        else:
+            self._counters["coalesced"] += 1
+            SINGLEFLIGHT_COALESCED.inc(group=self.name)
+        return await asyncio.shield(task)
+
+    def _release(self, key: Any, task: asyncio.Future) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Mark the exception as retrieved when every waiter has gone away
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return call/execution/coalesced counters and current in-flight keys.
+        """
+        return {
+            **self._counters,
+            "inflight": len(self._inflight),
+        }
+
+def singleflight_stats() -> Dict[str, Dict[str, Any]]:
+    """
+    Return stats for every SingleFlight group in the process, by name.
+    """
+    return {group.name: group.stats() for group in _groups}
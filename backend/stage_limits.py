@@ -0,0 +1,67 @@
+import asyncio
+import contextvars
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+from tracing import span
+
+# Pipeline stages that can be throttled independently
+STAGES = ("apify", "download", "gemini")
+
+class StageLimits:
+    """
+    Per-stage concurrency limits for a group of pipeline runs (e.g. one batch).
+
+    Each stage gets its own semaphore, so a batch can run many users at once
+    while keeping, say, Gemini calls within quota. Stages without a limit
+    are unbounded.
+    """
+
+    def __init__(self, limits: Dict[str, int]):
+        self.limits = {stage: limit for stage, limit in limits.items() if limit}
+        self._semaphores = {stage: asyncio.Semaphore(limit) for stage, limit in self.limits.items()}
+
+    def semaphore(self, stage: str) -> Optional[asyncio.Semaphore]:
+        return self._semaphores.get(stage)
+
+_current_limits: contextvars.ContextVar[Optional[StageLimits]] = contextvars.ContextVar("stage_limits", default=None)
+
+def use_stage_limits(limits: Optional[StageLimits]) -> contextvars.Token:
+    """
+    Apply limits to the current context and every task started from it.
+
+    Args:
+        limits: Limits to apply, or None to remove them
+
+    Returns:
+        Token that can be passed to reset_stage_limits
+    """
+    return _current_limits.set(limits)
+
+def reset_stage_limits(token: contextvars.Token) -> None:
+    """
+    Restore the limits that were in effect before use_stage_limits.
+    """
+    _current_limits.reset(token)
+
+@asynccontextmanager
+async def stage_slot(stage: str) -> AsyncIterator[None]:
+    """
+    Hold a slot of the given stage for the duration of the block. A no-op
+    unless limits were applied with use_stage_limits.
+
+    Args:
+        stage: One of STAGES
+    """
+    limits = _current_limits.get()
+    semaphore = limits.semaphore(stage) if limits is not None else None
+    if semaphore is None:
+        yield
+        return
+    # Time spent waiting for a slot shows up as its own span
+    with span(f"{stage}_queue"):
+        await semaphore.acquire()
+    try:
+        yield
+    finally:
+        semaphore.release()
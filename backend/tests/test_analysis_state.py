@@ -0,0 +1,32 @@
+import json
+
+from analysis_state import load_state_from_outputs
+
+def write_outputs(directory, username, timestamp="20240101_120000"):
+    with open(directory / f"{username}_analysis_{timestamp}.json", "w") as f:
+        json.dump({"analysis": f"{username} likes ramen."}, f)
+    with open(directory / f"{username}_instagram_data_{timestamp}.json", "w") as f:
+        json.dump({"data": [{"id": "1", "displayUrl": "https://cdn.example/1.jpg", "caption": "ramen"}]}, f)
+
+def test_state_is_rebuilt_from_outputs(tmp_path):
+    write_outputs(tmp_path, "foodie")
+
+    state = load_state_from_outputs("foodie", output_dir=str(tmp_path))
+
+    assert state["analysis"] == "foodie likes ramen."
+    assert state["post_keys"] == ["id-1"]
+
+def test_glob_characters_in_usernames_match_literally(tmp_path):
+    write_outputs(tmp_path, "foodie")
+    write_outputs(tmp_path, "[f]oodie")
+
+    assert load_state_from_outputs("[f]oodie", output_dir=str(tmp_path))["analysis"] == "[f]oodie likes ramen."
+    assert load_state_from_outputs("*", output_dir=str(tmp_path)) is None
+
+def test_usernames_with_path_separators_are_rejected(tmp_path):
+    outputs = tmp_path / "outputs"
+    outputs.mkdir()
+    write_outputs(tmp_path, "foodie")
+
+    assert load_state_from_outputs("../foodie", output_dir=str(outputs)) is None
+    assert load_state_from_outputs("..", output_dir=str(outputs)) is None
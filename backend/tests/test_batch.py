@@ -0,0 +1,72 @@
+import asyncio
+import json
+
+import pytest
+
+import instagram_restaurant_service
+from instagram_restaurant_service import run_batch_async
+
+class FakeResultStore:
+    def __init__(self):
+        self.records = []
+
+    def write(self, username, records):
+        self.records.append((username, records))
+        return f"run-{len(self.records)}"
+
+@pytest.fixture
+def store(monkeypatch):
+    store = FakeResultStore()
+    monkeypatch.setattr(instagram_restaurant_service, "get_result_store", lambda: store)
+
+    async def recommend_for_user_async(username, refresh=False, incremental=False, token_budget=None):
+        if username == "broken":
+            raise RuntimeError("Apify run failed")
+        recommendations = [{"name": "Noma"}] if username == "foodie" else []
+        analysis = "A long analysis of the profile. " * 20 if recommendations else "No posts found in the provided data."
+        return {
+            "instagram_data": {"username": username, "data": []},
+            "analysis": analysis,
+            "recommendations": recommendations,
+            "stats": {"posts_selected": len(recommendations)},
+        }
+
+    monkeypatch.setattr(instagram_restaurant_service, "recommend_for_user_async", recommend_for_user_async)
+    return store
+
+def run_batch(usernames, **kwargs):
+    async def run():
+        return [result async for result in run_batch_async(usernames, concurrency=2, **kwargs)]
+    return {result["username"]: result for result in asyncio.run(run())}
+
+def test_batch_records_every_user_in_the_result_store(store):
+    results = run_batch(["foodie", "quiet", "broken"])
+
+    assert sorted(username for username, _ in store.records) == ["broken", "foodie", "quiet"]
+    stored = dict(store.records)
+    assert stored["foodie"]["recommendations"] == [{"name": "Noma"}]
+    assert "error" in stored["broken"]
+    for result in results.values():
+        assert result["stats"]["result_id"].startswith("run-")
+
+def test_batch_statuses_keep_the_analysis_out_of_the_error_field(store):
+    results = run_batch(["foodie", "quiet", "broken"])
+
+    assert (results["foodie"]["status"], results["foodie"]["error"]) == ("ok", None)
+    assert (results["quiet"]["status"], results["quiet"]["error"]) == ("empty", None)
+    assert results["broken"]["status"] == "error"
+    assert results["broken"]["error"] == "Apify run failed"
+
+def test_batch_saves_outputs_to_output_dir(store, tmp_path):
+    results = run_batch(["foodie", "broken"], save_outputs=True, output_dir=str(tmp_path))
+
+    with open(results["foodie"]["output_files"]["recommendations"]) as f:
+        assert json.load(f)["recommendations"] == [{"name": "Noma"}]
+    assert set(results["broken"]["output_files"]) == {"error"}
+    assert all(path.startswith(str(tmp_path)) for result in results.values() for path in result["output_files"].values())
+
+def test_batch_saves_nothing_by_default(store, tmp_path):
+    results = run_batch(["foodie"], output_dir=str(tmp_path))
+
+    assert results["foodie"]["output_files"] == {}
+    assert list(tmp_path.iterdir()) == []
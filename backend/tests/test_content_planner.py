@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+import content_planner
+import instagram_analysis
+from content_planner import DEFAULT_TOKEN_BUDGET, MAX_POSTS, caption_tokens, plan_posts
+from gemini_scheduler import IMAGE_TOKENS, estimate_prompt_tokens
+from instagram_analysis import ANALYSIS_PROMPT, analyze_instagram_posts_incremental_async
+
+def make_posts(count, caption_chars=400):
+    return [
+        {"id": str(i), "shortCode": f"p{i}", "type": "Image", "displayUrl": f"https://cdn.example/{i}.jpg",
+         "caption": ("word " * caption_chars)[:caption_chars - 1]}
+        for i in range(count)
+    ]
+
+def test_default_budget_fits_max_posts_with_full_captions():
+    plan = plan_posts(make_posts(12), reserved_tokens=estimate_prompt_tokens([ANALYSIS_PROMPT]))
+
+    assert plan["selected"] == MAX_POSTS
+    assert plan["captions_shortened"] == 0
+    assert MAX_POSTS * (IMAGE_TOKENS + caption_tokens("x" * 400)) <= DEFAULT_TOKEN_BUDGET
+
+def test_small_budget_selects_fewer_posts():
+    plan = plan_posts(make_posts(12), token_budget=3 * IMAGE_TOKENS + 100)
+
+    assert 0 < plan["selected"] < MAX_POSTS
+    assert plan["estimated_tokens"] <= plan["token_budget"]
+
+class FakeStateStore:
+    def __init__(self, state):
+        self.state = state
+        self.put = None
+
+    async def aget(self, username):
+        return self.state
+
+    async def aput(self, username, post_keys, analysis):
+        self.put = (post_keys, analysis)
+
+@pytest.fixture
+def planner_calls(monkeypatch):
+    calls = []
+
+    def counting_plan_posts(*args, **kwargs):
+        calls.append(kwargs.get("token_budget"))
+        return plan_posts(*args, **kwargs)
+
+    monkeypatch.setattr(instagram_analysis, "plan_posts", counting_plan_posts)
+    return calls
+
+def test_incremental_analysis_plans_once(monkeypatch, planner_calls):
+    store = FakeStateStore({"post_keys": ["id-0", "id-1"], "analysis": "Likes ramen."})
+    monkeypatch.setattr(instagram_analysis, "get_analysis_state_store", lambda: store)
+    sent = {}
+
+    async def build_analysis_request(posts, stats=None, prompt=None, context=None, token_budget=None, plan=None):
+        sent.update(posts=[post.get("id") for post in posts], plan=plan)
+        return {"error": "Could not process any images from the provided posts."}
+
+    monkeypatch.setattr(instagram_analysis, "build_analysis_request", build_analysis_request)
+    stats = {}
+
+    result = asyncio.run(analyze_instagram_posts_incremental_async({"data": make_posts(4)}, "foodie", stats=stats, token_budget=1600))
+
+    assert result == "Likes ramen."
+    assert planner_calls == [1600]
+    assert sent["posts"] == ["2", "3"]
+    assert sent["plan"]["selected"] == 2
+    assert stats["incremental"]["new_posts"] == 2
+
+def test_build_analysis_request_uses_a_given_plan(planner_calls):
+    plan = plan_posts(make_posts(2), token_budget=0)
+    stats = {}
+
+    request = asyncio.run(instagram_analysis.build_analysis_request(make_posts(2), stats=stats, plan=plan))
+
+    assert request["error"] == "Could not process any images from the provided posts."
+    assert planner_calls == []
+    assert stats["posts_selected"] == 0
@@ -0,0 +1,155 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import gemini_scheduler
+from gemini_scheduler import GeminiScheduler, QuotaWaitTimeout, _LocalBuckets, _SharedBuckets, estimate_prompt_tokens
+from jobs import PRIORITY_BATCH, PRIORITY_DEFAULT, PRIORITY_INTERACTIVE
+
+def drain(scheduler: GeminiScheduler) -> None:
+    # Empty the request bucket so the next callers have to queue
+    scheduler._buckets.adjust({"requests": scheduler.budgets["requests"]})
+
+def test_estimate_prompt_tokens_counts_text_and_images():
+    assert estimate_prompt_tokens("x" * 400) == 101
+    assert estimate_prompt_tokens(["x" * 40, {"inline_data": {}}]) == 11 + 258
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(gemini_scheduler, "time", SimpleNamespace(time=lambda: clock.now, monotonic=time.monotonic))
+    return clock
+
+def test_buckets_refill_at_the_budget_rate(clock):
+    buckets = _LocalBuckets({"requests": 600, "tokens": 0})
+    buckets.adjust({"requests": 600})
+
+    assert buckets.take({"requests": 1, "tokens": 0}, PRIORITY_DEFAULT, dict) == pytest.approx(0.1)
+    clock.now += 1
+    for _ in range(10):
+        assert buckets.take({"requests": 1, "tokens": 0}, PRIORITY_DEFAULT, dict) <= 0
+    assert buckets.take({"requests": 1, "tokens": 0}, PRIORITY_DEFAULT, dict) == pytest.approx(0.1)
+
+def test_buckets_refill_no_further_than_one_minutes_budget(clock):
+    buckets = _LocalBuckets({"requests": 60, "tokens": 1000})
+    buckets.adjust({"requests": 60, "tokens": 1000})
+    clock.now += 3600
+
+    assert buckets.levels() == {"requests": 60, "tokens": 1000}
+
+def test_call_bigger_than_the_token_budget_waits_for_a_full_bucket(clock):
+    buckets = _LocalBuckets({"requests": 60, "tokens": 1000})
+
+    assert buckets.take({"requests": 1, "tokens": 5000}, PRIORITY_DEFAULT, dict) <= 0
+    assert buckets.levels()["tokens"] == -4000
+    # Paying off the debt and refilling the bucket takes five minutes
+    assert buckets.take({"requests": 1, "tokens": 5000}, PRIORITY_DEFAULT, dict) == pytest.approx(300)
+
+def test_settle_corrects_the_estimate(clock):
+    async def run():
+        scheduler = GeminiScheduler(requests_per_minute=60, tokens_per_minute=1000)
+        await scheduler.acquire(100)
+        await scheduler.settle(100, 400)
+        return scheduler._buckets.levels()["tokens"]
+
+    assert asyncio.run(run()) == 600
+
+def test_shared_buckets_refill_across_processes(clock, tmp_path):
+    path = str(tmp_path / "quota.sqlite3")
+    first = _SharedBuckets({"requests": 60, "tokens": 0}, path)
+    second = _SharedBuckets({"requests": 60, "tokens": 0}, path)
+    first.adjust({"requests": 60})
+
+    assert second.take({"requests": 1, "tokens": 0}, PRIORITY_DEFAULT, dict) == pytest.approx(1)
+    clock.now += 1
+    assert second.take({"requests": 1, "tokens": 0}, PRIORITY_DEFAULT, dict) <= 0
+    assert first.levels()["requests"] == pytest.approx(0)
+
+def test_waiting_call_is_admitted_once_the_bucket_refills():
+    async def run():
+        scheduler = GeminiScheduler(requests_per_minute=600, tokens_per_minute=0, max_wait=5)
+        drain(scheduler)
+        return await scheduler.acquire(1)
+
+    assert 0.05 <= asyncio.run(run()) < 1
+
+def test_interactive_call_overtakes_waiting_batch_call():
+    async def run():
+        scheduler = GeminiScheduler(requests_per_minute=600, tokens_per_minute=0, max_wait=5)
+        drain(scheduler)
+        order = []
+
+        async def call(name, priority):
+            await scheduler.acquire(1, priority=priority)
+            order.append(name)
+
+        batch = asyncio.ensure_future(call("batch", PRIORITY_BATCH))
+        await asyncio.sleep(0.01)
+        interactive = asyncio.ensure_future(call("interactive", PRIORITY_INTERACTIVE))
+        await asyncio.gather(batch, interactive)
+        return order
+
+    assert asyncio.run(run()) == ["interactive", "batch"]
+
+def test_waiting_calls_go_by_priority_then_arrival():
+    async def run():
+        scheduler = GeminiScheduler(requests_per_minute=1200, tokens_per_minute=0, max_wait=5)
+        drain(scheduler)
+        order = []
+
+        async def call(name, priority):
+            await scheduler.acquire(1, priority=priority)
+            order.append(name)
+
+        calls = []
+        for name, priority in (("batch", PRIORITY_BATCH), ("default 1", PRIORITY_DEFAULT), ("default 2", PRIORITY_DEFAULT), ("interactive", PRIORITY_INTERACTIVE)):
+            calls.append(asyncio.ensure_future(call(name, priority)))
+            await asyncio.sleep(0.001)
+        await asyncio.gather(*calls)
+        return order
+
+    assert asyncio.run(run()) == ["interactive", "default 1", "default 2", "batch"]
+
+def test_gives_up_after_max_wait():
+    async def run():
+        scheduler = GeminiScheduler(requests_per_minute=1, tokens_per_minute=0, max_wait=0.2)
+        drain(scheduler)
+        with pytest.raises(QuotaWaitTimeout):
+            await scheduler.acquire(1)
+        return scheduler.stats()
+
+    stats = asyncio.run(run())
+    assert stats["priorities"]["default"]["timeouts"] == 1
+    assert sum(stats["queue_depth"].values()) == 0
+
+def test_cancelled_waiter_leaves_queue():
+    async def run():
+        scheduler = GeminiScheduler(requests_per_minute=60, tokens_per_minute=0, max_wait=5)
+        drain(scheduler)
+        task = asyncio.ensure_future(scheduler.acquire(1))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return scheduler._head()
+
+    assert asyncio.run(run()) is None
+
+def test_cancel_while_enqueueing_does_not_block_later_calls(tmp_path):
+    async def run():
+        scheduler = GeminiScheduler(
+            requests_per_minute=600, tokens_per_minute=0, state_path=str(tmp_path / "quota.sqlite3"), max_wait=2
+        )
+        # The shared queue is published from a thread, so the first await of
+        # acquire is inside the enqueue; cancel the caller right there
+        task = asyncio.ensure_future(scheduler.acquire(1))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert scheduler._head() is None
+        return await scheduler.acquire(1)
+
+    assert asyncio.run(run()) < 1
@@ -0,0 +1,78 @@
+import builtins
+
+import pytest
+
+import image_cache
+from image_cache import ImageCache
+
+@pytest.fixture
+def make_cache(tmp_path):
+    def make(**kwargs):
+        return ImageCache(directory=str(tmp_path / "images"), **kwargs)
+    return make
+
+def test_memory_hit(make_cache):
+    cache = make_cache()
+    cache.put("id-1", b"image")
+
+    assert cache.get("id-1") == b"image"
+    assert cache.stats()["memory_hits"] == 1
+
+def test_lru_evicts_the_least_recently_used_entry(make_cache):
+    cache = make_cache(memory_budget_bytes=10)
+    cache.put("id-1", b"a" * 4)
+    cache.put("id-2", b"b" * 4)
+    cache.get("id-1")
+    cache.put("id-3", b"c" * 4)
+
+    stats = cache.stats()
+    assert stats["memory_evictions"] == 1
+    assert stats["memory_bytes"] == 8
+    # id-2 was evicted from memory but is still on disk
+    assert cache.get("id-2") == b"b" * 4
+    assert cache.stats()["disk_hits"] == 1
+
+def test_disk_tier_serves_a_new_instance(make_cache):
+    make_cache().put("id-1", b"image")
+
+    cache = make_cache()
+
+    assert cache.get("id-1") == b"image"
+    assert cache.get("id-1") == b"image"
+    assert (cache.stats()["disk_hits"], cache.stats()["memory_hits"]) == (1, 1)
+
+def test_expired_entries_are_misses(make_cache):
+    cache = make_cache(ttl_seconds=-1)
+    cache.put("id-1", b"image")
+
+    assert cache.get("id-1") is None
+    assert cache.stats()["disk_entries"] == 0
+
+def test_hashes_are_evicted_with_the_memory_lru(make_cache):
+    cache = make_cache(memory_budget_bytes=10)
+    for i in range(20):
+        cache.put(f"id-{i}", b"x" * 4)
+        cache.put_hashes(f"id-{i}", {"dhash": str(i)})
+
+    assert cache.stats()["hashed_entries"] == 2
+    # Evicted hashes are still read back from disk
+    assert cache.get_hashes("id-0") == {"dhash": "0"}
+    assert cache.stats()["hashed_entries"] == 2
+
+def test_disk_read_racing_a_put_doesnt_promote_the_replaced_image(make_cache, monkeypatch):
+    cache = make_cache(memory_budget_bytes=10)
+    cache.put("id-1", b"old")
+    cache.put("id-2", b"x" * 10)
+
+    def open_then_put(path, *args, **kwargs):
+        # The old file is open when the new image lands
+        f = builtins.open(path, *args, **kwargs)
+        if path.endswith(".img"):
+            monkeypatch.undo()
+            cache.put("id-1", b"new")
+        return f
+
+    monkeypatch.setattr(image_cache, "open", open_then_put, raising=False)
+
+    assert cache.get("id-1") == b"old"
+    assert cache.get("id-1") == b"new"
@@ -0,0 +1,36 @@
+import asyncio
+from types import SimpleNamespace
+
+from image_downloader import ImageDownloader
+
+class FakeClient:
+    """
+    Serves every URL at once, except those on slow.example, which wait
+    until release is set.
+    """
+
+    def __init__(self):
+        self.release = asyncio.Event()
+
+    async def get(self, url, timeout=None):
+        if "slow.example" in url:
+            await self.release.wait()
+        return SimpleNamespace(status_code=200, content=url.encode(), raise_for_status=lambda: None)
+
+def test_download_queued_behind_a_busy_host_leaves_global_slots_free():
+    async def run():
+        downloader = ImageDownloader(max_concurrency=2, per_host_concurrency=1, hedge=False)
+        client = FakeClient()
+        downloader._get_state().client = client
+        slow = [asyncio.ensure_future(downloader.fetch(f"https://slow.example/{i}.jpg")) for i in range(2)]
+        await asyncio.sleep(0.01)
+        # One slow download runs and one waits for its host; the other host
+        # must still get the second global slot
+        other = await asyncio.wait_for(downloader.fetch("https://fast.example/a.jpg"), 1)
+        client.release.set()
+        return other, await asyncio.gather(*slow)
+
+    other, slow = asyncio.run(run())
+
+    assert other == b"https://fast.example/a.jpg"
+    assert slow == [b"https://slow.example/0.jpg", b"https://slow.example/1.jpg"]
@@ -0,0 +1,53 @@
+import io
+
+from PIL import Image, ImageDraw
+
+from image_hashing import group_near_duplicates, hamming_distances, image_hashes
+
+def make_photo(shapes, size=(640, 480)):
+    image = Image.new("RGB", size)
+    draw = ImageDraw.Draw(image)
+    for x in range(size[0]):
+        draw.line([(x, 0), (x, size[1])], fill=(x * 255 // size[0], 90, 160))
+    for box, color in shapes:
+        draw.ellipse([coordinate * size[i % 2] // 100 for i, coordinate in enumerate(box)], fill=color)
+    return image
+
+def encode(image, size=None, format="JPEG", **kwargs):
+    if size:
+        image = image.resize(size, Image.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **kwargs)
+    return buffer.getvalue()
+
+PHOTO = make_photo([((10, 10, 45, 60), (250, 220, 40)), ((55, 40, 95, 90), (30, 30, 30))])
+OTHER_PHOTO = make_photo([((50, 5, 95, 45), (240, 240, 240)), ((5, 50, 40, 95), (200, 20, 20))])
+
+def test_recompressed_and_resized_copies_are_grouped_apart_from_a_different_image():
+    hashes = [
+        image_hashes(encode(PHOTO, quality=95)),
+        image_hashes(encode(OTHER_PHOTO, quality=95)),
+        image_hashes(encode(PHOTO, size=(320, 240), quality=40)),
+        image_hashes(encode(PHOTO, format="PNG")),
+    ]
+
+    assert group_near_duplicates(hashes) == [[0, 2, 3], [1]]
+
+def test_images_without_hashes_stay_on_their_own():
+    hashes = [image_hashes(encode(PHOTO)), image_hashes(b"not an image"), image_hashes(encode(PHOTO))]
+
+    assert hashes[1] is None
+    assert group_near_duplicates(hashes) == [[0, 2], [1]]
+
+def test_max_distance_zero_only_groups_identical_hashes():
+    hashes = [{"dhash": "00000000000000ff", "phash": "0000000000000000"}, {"dhash": "00000000000000fe", "phash": "0000000000000000"}]
+
+    assert group_near_duplicates(hashes, max_distance=0) == [[0], [1]]
+    assert group_near_duplicates(hashes, max_distance=1) == [[0, 1]]
+
+def test_hamming_distances():
+    assert hamming_distances(["0000000000000000", "ffffffffffffffff", "000000000000000f"]).tolist() == [
+        [0, 64, 4],
+        [64, 0, 60],
+        [4, 60, 0],
+    ]
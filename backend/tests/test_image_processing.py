@@ -0,0 +1,36 @@
+import io
+import random
+
+from PIL import Image
+
+from image_processing import prepare_image
+
+def make_jpeg_with_metadata():
+    exif = Image.Exif()
+    exif[0x010F] = "Camera maker"
+    buffer = io.BytesIO()
+    noise = random.Random(0).randbytes(64 * 64 * 3)
+    # Noisy and compressed harder than the default quality, so re-encoding it doesn't make it smaller
+    Image.frombytes("RGB", (64, 64), noise).save(buffer, format="JPEG", quality=30, exif=exif.tobytes(), icc_profile=b"\0" * 64)
+    return buffer.getvalue()
+
+def test_metadata_is_stripped_even_when_no_resize_is_needed():
+    original = make_jpeg_with_metadata()
+
+    prepared = prepare_image(original)
+
+    image = Image.open(io.BytesIO(prepared["data"]))
+    assert prepared["mime_type"] == "image/jpeg"
+    assert image.size == (64, 64)
+    assert not image.getexif()
+    assert "icc_profile" not in image.info
+    assert "exif" not in image.info
+
+def test_large_images_are_downscaled():
+    buffer = io.BytesIO()
+    Image.new("RGB", (2000, 1000), (10, 120, 10)).save(buffer, format="PNG")
+
+    prepared = prepare_image(buffer.getvalue(), max_edge=768)
+
+    assert (prepared["width"], prepared["height"]) == (768, 384)
+    assert prepared["source_format"] == "PNG"
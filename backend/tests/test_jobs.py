@@ -0,0 +1,227 @@
+import asyncio
+import time
+
+import pytest
+
+from jobs import PRIORITY_BATCH, PRIORITY_INTERACTIVE, JobQueue, JobWorkerPool
+
+@pytest.fixture
+def queue(tmp_path):
+    # Leases short enough to let them run out within a test
+    return JobQueue(path=str(tmp_path / "jobs.sqlite3"), lease_seconds=0.05, max_attempts=2)
+
+def expire_lease(queue):
+    time.sleep(queue.lease_seconds * 1.5)
+
+def test_claims_highest_priority_first(queue):
+    queue.submit("analysis", {"username": "batch"}, priority=PRIORITY_BATCH)
+    queue.submit("analysis", {"username": "interactive"}, priority=PRIORITY_INTERACTIVE)
+    assert queue.claim(["analysis"])["params"]["username"] == "interactive"
+    assert queue.claim(["analysis"])["params"]["username"] == "batch"
+    assert queue.claim(["analysis"]) is None
+
+def test_only_claims_registered_kinds(queue):
+    queue.submit("full-service", {"username": "someone"})
+    assert queue.claim(["analysis"]) is None
+    assert queue.claim([]) is None
+
+def test_running_job_is_reclaimed_after_its_lease_expires(queue):
+    job = queue.submit("analysis", {"username": "someone"})
+    assert queue.claim(["analysis"])["id"] == job["id"]
+    assert queue.claim(["analysis"]) is None
+    expire_lease(queue)
+    reclaimed = queue.claim(["analysis"])
+    assert reclaimed["id"] == job["id"]
+    assert reclaimed["attempts"] == 2
+
+def test_renewed_lease_is_not_reclaimed(queue):
+    job = queue.submit("analysis", {"username": "someone"})
+    queue.claim(["analysis"])
+    time.sleep(queue.lease_seconds / 2)
+    assert queue.renew(job["id"]) is False
+    time.sleep(queue.lease_seconds / 2)
+    assert queue.claim(["analysis"]) is None
+
+def test_job_that_keeps_losing_its_lease_is_failed(queue):
+    job = queue.submit("analysis", {"username": "someone"})
+    for _ in range(queue.max_attempts):
+        assert queue.claim(["analysis"])["id"] == job["id"]
+        expire_lease(queue)
+    assert queue.claim(["analysis"]) is None
+    failed = queue.get(job["id"])
+    assert failed["status"] == "failed"
+    assert failed["attempts"] == queue.max_attempts
+    assert "attempts" in failed["error"]
+
+def test_cancel_queued_job_is_immediate(queue):
+    job = queue.submit("analysis", {"username": "someone"})
+    assert queue.cancel(job["id"])["status"] == "cancelled"
+    assert queue.claim(["analysis"]) is None
+
+def test_cancel_running_job_is_reported_by_renew(queue):
+    job = queue.submit("analysis", {"username": "someone"})
+    queue.claim(["analysis"])
+    assert queue.cancel(job["id"])["status"] == "running"
+    assert queue.renew(job["id"]) is True
+
+def test_cancelled_job_whose_worker_died_ends_cancelled(queue):
+    job = queue.submit("analysis", {"username": "someone"})
+    queue.claim(["analysis"])
+    queue.cancel(job["id"])
+    expire_lease(queue)
+    assert queue.claim(["analysis"]) is None
+    assert queue.get(job["id"])["status"] == "cancelled"
+
+def test_purge_deletes_only_old_finished_jobs(queue):
+    finished = queue.submit("analysis", {"username": "done"})
+    queue.claim(["analysis"])
+    queue.finish(finished["id"], "succeeded", result={"analysis": "..."})
+    pending = queue.submit("analysis", {"username": "pending"})
+    time.sleep(0.05)
+    assert queue.purge(older_than_seconds=60) == 0
+    assert queue.purge(older_than_seconds=0.01) == 1
+    assert queue.get(finished["id"]) is None
+    assert queue.get(pending["id"]) is not None
+
+def test_worker_pool_purges_on_a_schedule(queue):
+    job = queue.submit("analysis", {"username": "done"})
+    queue.finish(job["id"], "succeeded", result={})
+    time.sleep(0.05)
+
+    async def run():
+        pool = JobWorkerPool(queue, workers=0, retention_seconds=0.01, purge_interval=60)
+        pool.start()
+        await asyncio.sleep(0.1)
+        await pool.stop()
+
+    asyncio.run(run())
+    assert queue.get(job["id"]) is None
+
+def test_wait_leaves_no_event_behind(queue):
+    running = queue.submit("analysis", {"username": "slow"})
+    queue.claim(["analysis"])
+    elsewhere = queue.submit("analysis", {"username": "other process"})
+
+    async def run():
+        pool = JobWorkerPool(queue, workers=0, poll_interval=0.01)
+        assert (await pool.wait(running["id"], timeout=0.05))["status"] == "running"
+        # Finished by another process: noticed by polling, not by the event
+        await asyncio.to_thread(queue.finish, elsewhere["id"], "succeeded", {})
+        assert (await pool.wait(elsewhere["id"], timeout=1))["status"] == "succeeded"
+        return pool
+
+    pool = asyncio.run(run())
+    assert pool._finished == {} and pool._waiters == {}
+
+def test_handler_cancelled_from_inside_fails_the_job_and_keeps_the_worker(queue):
+    async def cancelled_handler(params):
+        raise asyncio.CancelledError()
+
+    async def ok_handler(params):
+        return {"username": params["username"]}
+
+    first = queue.submit("broken", {"username": "first"})
+    second = queue.submit("analysis", {"username": "second"})
+
+    async def run():
+        pool = JobWorkerPool(queue, workers=1, poll_interval=0.01, retention_seconds=0)
+        pool.register("broken", cancelled_handler)
+        pool.register("analysis", ok_handler)
+        pool.start()
+        try:
+            return await pool.wait(first["id"], timeout=2), await pool.wait(second["id"], timeout=2)
+        finally:
+            await pool.stop()
+
+    broken, ok = asyncio.run(run())
+    assert broken["status"] == "failed"
+    assert ok["status"] == "succeeded" and ok["result"] == {"username": "second"}
+
+def test_run_is_not_capped_by_the_worker_pool(queue):
+    async def run():
+        started = 0
+        release = asyncio.Event()
+
+        async def handler(params):
+            nonlocal started
+            started += 1
+            await release.wait()
+            return {"n": params["n"]}
+
+        pool = JobWorkerPool(queue, workers=0)
+        pool.register("analysis", handler)
+        runs = [asyncio.ensure_future(pool.run("analysis", {"n": n})) for n in range(20)]
+        while started < 20:
+            await asyncio.sleep(0.01)
+        release.set()
+        return await asyncio.gather(*runs)
+
+    jobs = asyncio.run(run())
+    assert [job["result"] for job in jobs] == [{"n": n} for n in range(20)]
+    assert all(job["status"] == "succeeded" for job in jobs)
+
+def test_cancelled_run_cancels_its_job(queue):
+    async def run():
+        async def handler(params):
+            await asyncio.sleep(60)
+
+        pool = JobWorkerPool(queue, workers=0)
+        pool.register("analysis", handler)
+        task = asyncio.ensure_future(pool.run("analysis", {}))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run())
+    (job,) = queue.list()
+    assert job["status"] == "cancelled"
+
+def test_waiting_on_a_job_running_here_doesnt_poll(queue):
+    async def run():
+        async def handler(params):
+            await asyncio.sleep(0.05)
+            return {}
+
+        pool = JobWorkerPool(queue, workers=0, poll_interval=60)
+        pool.register("analysis", handler)
+        task = asyncio.ensure_future(pool.run("analysis", {}))
+        await asyncio.sleep(0.01)
+        (job,) = await asyncio.to_thread(queue.list)
+        started = time.monotonic()
+        finished = await pool.wait(job["id"], timeout=5)
+        await task
+        return finished, time.monotonic() - started
+
+    job, waited = asyncio.run(run())
+    assert job["status"] == "succeeded"
+    assert waited < 1
+
+def test_job_submitted_during_an_empty_claim_wakes_the_worker(queue):
+    async def run():
+        async def handler(params):
+            return {}
+
+        pool = JobWorkerPool(queue, workers=1, poll_interval=60, retention_seconds=0)
+        pool.register("analysis", handler)
+        loop = asyncio.get_running_loop()
+        claim = queue.claim
+        submitted = []
+
+        def claim_racing_a_submit(kinds):
+            job = claim(kinds)
+            if not submitted:
+                # Lands after the claim saw an empty queue, before the worker goes to sleep
+                submitted.append(queue.submit("analysis", {}))
+                loop.call_soon_threadsafe(pool._wakeup.set)
+            return job
+
+        queue.claim = claim_racing_a_submit
+        pool.start()
+        try:
+            while not submitted:
+                await asyncio.sleep(0.01)
+            return await pool.wait(submitted[0]["id"], timeout=2)
+        finally:
+            await pool.stop()
+
+    assert asyncio.run(run())["status"] == "succeeded"
@@ -0,0 +1,71 @@
+import pytest
+
+from llm_cache import LLMCache, make_cache_key
+
+@pytest.fixture
+def make_cache(tmp_path):
+    caches = []
+
+    def make(**kwargs):
+        cache = LLMCache(path=str(tmp_path / "llm_cache.sqlite3"), **kwargs)
+        caches.append(cache)
+        return cache
+
+    yield make
+    for cache in caches:
+        cache._conn.close()
+
+def key(model="gemini-2.0-flash", prompt="Describe this profile", version="1", image=b"jpeg"):
+    return make_cache_key("analysis", model, version, [prompt, image])
+
+def test_hit_on_the_same_prompt_and_model(make_cache):
+    cache = make_cache()
+    cache.put(key(), "Likes ramen.", "analysis", "1")
+
+    assert cache.get(key()) == "Likes ramen."
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (1, 0)
+
+@pytest.mark.parametrize("changed", [
+    {"model": "gemini-1.5-pro"},
+    {"prompt": "Describe this profile briefly"},
+    {"version": "2"},
+    {"image": b"another jpeg"},
+])
+def test_miss_when_any_part_of_the_request_changes(make_cache, changed):
+    cache = make_cache()
+    cache.put(key(), "Likes ramen.", "analysis", "1")
+
+    assert key(**changed) != key()
+    assert cache.get(key(**changed)) is None
+    assert cache.stats()["misses"] == 1
+
+def test_part_boundaries_are_part_of_the_key():
+    assert make_cache_key("analysis", "m", "1", ["ab", "c"]) != make_cache_key("analysis", "m", "1", ["a", "bc"])
+    assert make_cache_key("analysis", "m", "1", ["abc"]) != make_cache_key("analysis", "m", "1", [b"abc"])
+
+def test_expired_entries_are_misses(make_cache):
+    cache = make_cache(ttl_seconds=-1)
+    cache.put(key(), "Likes ramen.", "analysis", "1")
+
+    assert cache.get(key()) is None
+    assert cache.stats()["expired"] >= 1
+
+def test_least_recently_used_entry_is_evicted(make_cache):
+    cache = make_cache(max_entries=2)
+    cache.put("a", "A", "analysis", "1")
+    cache.put("b", "B", "analysis", "1")
+    cache.get("a")
+    cache.put("c", "C", "analysis", "1")
+
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == ("A", "C")
+    assert cache.stats()["evictions"] == 1
+
+def test_entries_survive_a_restart_and_can_be_invalidated_by_version(make_cache):
+    make_cache().put("old", "A", "analysis", "1")
+    cache = make_cache()
+    cache.put("new", "B", "analysis", "2")
+
+    assert cache.get("old") == "A"
+    assert cache.invalidate(namespace="analysis", prompt_version="1") == 1
+    assert (cache.get("old"), cache.get("new")) == (None, "B")
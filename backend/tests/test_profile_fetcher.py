@@ -0,0 +1,87 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import profile_fetcher
+from profile_fetcher import ApifyRunFailed, ProfileCache, scrape_instagram_posts
+
+class FakeApifyClient:
+    """
+    Just enough of ApifyClientAsync for iter_instagram_posts: every run
+    finishes at once with the given status and dataset items.
+    """
+
+    def __init__(self, status="SUCCEEDED", items=()):
+        self.status = status
+        self.items = list(items)
+        self.runs = 0
+
+    def actor(self, actor_id):
+        async def start(run_input):
+            self.runs += 1
+            return {"id": f"run-{self.runs}", "defaultDatasetId": "dataset", "status": "RUNNING"}
+        return SimpleNamespace(start=start)
+
+    def run(self, run_id):
+        async def get():
+            return {"id": run_id, "status": self.status}
+
+        async def abort():
+            pass
+        return SimpleNamespace(get=get, abort=abort)
+
+    def dataset(self, dataset_id):
+        async def list_items(offset=0, fields=None):
+            return SimpleNamespace(items=self.items[offset:])
+        return SimpleNamespace(list_items=list_items)
+
+@pytest.fixture
+def apify(monkeypatch):
+    client = FakeApifyClient()
+    monkeypatch.setattr(profile_fetcher, "get_apify_client", lambda: client)
+    return client
+
+def post(i):
+    return {"id": str(i), "shortCode": f"code{i}", "displayUrl": f"https://cdn.example/{i}.jpg", "caption": f"post {i}"}
+
+def test_failed_run_raises_after_its_items(apify):
+    apify.status = "FAILED"
+    apify.items = [post(1)]
+    seen = []
+    with pytest.raises(ApifyRunFailed) as error:
+        asyncio.run(scrape_instagram_posts("someone", on_post=seen.append))
+    assert error.value.status == "FAILED"
+    assert [p.id for p in seen] == ["1"]
+
+def test_failed_scrape_is_not_cached(apify):
+    apify.status = "ABORTED"
+    cache = ProfileCache()
+
+    async def run():
+        with pytest.raises(ApifyRunFailed):
+            await cache.get("someone")
+        apify.status = "SUCCEEDED"
+        apify.items = [post(1), post(2)]
+        return await cache.get("someone")
+
+    result = asyncio.run(run())
+    assert result["cache"]["status"] == "miss"
+    assert len(result["data"]) == 2
+    assert apify.runs == 2
+
+def test_empty_scrape_is_not_cached_as_fresh(apify):
+    cache = ProfileCache()
+
+    async def run():
+        first = await cache.get("someone")
+        apify.items = [post(1)]
+        second = await cache.get("someone")
+        third = await cache.get("someone")
+        return first, second, third
+
+    first, second, third = asyncio.run(run())
+    assert first["data"] == [] and first["cache"]["status"] == "miss"
+    assert second["cache"]["status"] == "miss" and len(second["data"]) == 1
+    assert third["cache"]["status"] == "hit"
+    assert apify.runs == 2
@@ -0,0 +1,52 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import restaurant_recommendations
+from llm_cache import LLMCache
+from restaurant_recommendations import get_restaurant_recommendations_async
+
+@pytest.fixture
+def gemini(monkeypatch, tmp_path):
+    cache = LLMCache(path=str(tmp_path / "llm_cache.sqlite3"))
+    calls = []
+    answer = {"text": '[{"restaurant_name": "Noma"}]'}
+
+    async def generate_content(model, contents, stream=False):
+        calls.append(contents)
+        await asyncio.sleep(0.01)
+        return SimpleNamespace(text=answer["text"])
+
+    monkeypatch.setattr(restaurant_recommendations, "get_llm_cache", lambda: cache)
+    monkeypatch.setattr(restaurant_recommendations, "get_gemini_model", lambda name: None)
+    monkeypatch.setattr(restaurant_recommendations, "generate_content", generate_content)
+    yield SimpleNamespace(calls=calls, answer=answer, cache=cache)
+    cache._conn.close()
+
+def recommend(analysis):
+    return asyncio.run(get_restaurant_recommendations_async(analysis))
+
+def test_recommendations_are_memoized_on_the_normalized_analysis(gemini):
+    assert recommend("Likes ramen.\n\nLives in Tokyo.") == [{"restaurant_name": "Noma"}]
+    assert recommend("  Likes ramen. Lives in   Tokyo. ") == [{"restaurant_name": "Noma"}]
+
+    assert len(gemini.calls) == 1
+    assert recommend("Likes tacos.") == [{"restaurant_name": "Noma"}]
+    assert len(gemini.calls) == 2
+
+def test_concurrent_requests_share_one_gemini_call(gemini):
+    async def run():
+        return await asyncio.gather(*(get_restaurant_recommendations_async("Likes ramen.") for _ in range(3)))
+
+    assert asyncio.run(run()) == [[{"restaurant_name": "Noma"}]] * 3
+    assert len(gemini.calls) == 1
+
+def test_unparseable_answers_are_not_cached(gemini):
+    gemini.answer["text"] = "Sorry, I can't help with that."
+    with pytest.raises(ValueError):
+        recommend("Likes ramen.")
+
+    gemini.answer["text"] = '[{"restaurant_name": "Noma"}]'
+    assert recommend("Likes ramen.") == [{"restaurant_name": "Noma"}]
+    assert len(gemini.calls) == 2
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+import gemini_scheduler
+import resilience
+from gemini_scheduler import GeminiScheduler, QuotaWaitTimeout, generate_content
+from resilience import CircuitBreaker, CircuitOpenError, RetryPolicy, resilient_call
+
+class StatusError(Exception):
+    def __init__(self, code):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+def fail(breaker, error):
+    with pytest.raises(type(error)):
+        with breaker.guard():
+            raise error
+
+def succeed(breaker):
+    with breaker.guard():
+        pass
+
+@pytest.fixture
+def breaker():
+    return CircuitBreaker("test", failure_threshold=2, recovery_seconds=0.05)
+
+@pytest.fixture
+def fresh_breakers(monkeypatch):
+    monkeypatch.setattr(resilience, "_breakers", {})
+    monkeypatch.setattr(resilience, "_retry_policies", {"gemini": RetryPolicy(max_attempts=3, base_delay=0)})
+
+def test_opens_after_consecutive_transient_failures(breaker):
+    fail(breaker, ConnectionError())
+    assert breaker.state == CircuitBreaker.CLOSED
+    fail(breaker, StatusError(503))
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        succeed(breaker)
+    assert breaker.stats()["rejections"] == 1
+
+def test_client_errors_and_successes_reset_the_count(breaker):
+    fail(breaker, ConnectionError())
+    fail(breaker, StatusError(404))
+    fail(breaker, ConnectionError())
+    assert breaker.state == CircuitBreaker.CLOSED
+
+def test_half_open_lets_one_probe_through(breaker):
+    fail(breaker, ConnectionError())
+    fail(breaker, ConnectionError())
+    asyncio.run(asyncio.sleep(0.06))
+    with breaker.guard():
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        with pytest.raises(CircuitOpenError):
+            succeed(breaker)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+def test_failed_probe_opens_the_circuit_again(breaker):
+    fail(breaker, ConnectionError())
+    fail(breaker, ConnectionError())
+    asyncio.run(asyncio.sleep(0.06))
+    fail(breaker, ConnectionError())
+    assert breaker.state == CircuitBreaker.OPEN
+
+def test_cancelled_probe_frees_the_slot(breaker):
+    fail(breaker, ConnectionError())
+    fail(breaker, ConnectionError())
+    asyncio.run(asyncio.sleep(0.06))
+    with pytest.raises(asyncio.CancelledError):
+        with breaker.guard():
+            raise asyncio.CancelledError()
+    succeed(breaker)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+def test_resilient_call_retries_transient_errors(fresh_breakers):
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise StatusError(503)
+        return "ok"
+
+    assert asyncio.run(resilient_call("gemini", flaky)) == "ok"
+    assert len(attempts) == 3
+
+def test_resilient_call_does_not_retry_client_errors(fresh_breakers):
+    attempts = []
+
+    async def bad_request():
+        attempts.append(1)
+        raise StatusError(400)
+
+    with pytest.raises(StatusError):
+        asyncio.run(resilient_call("gemini", bad_request))
+    assert len(attempts) == 1
+
+def test_quota_wait_is_outside_the_gemini_breaker(fresh_breakers, monkeypatch):
+    scheduler = GeminiScheduler(requests_per_minute=1, tokens_per_minute=0, max_wait=0.1)
+    scheduler._buckets.adjust({"requests": 1})
+    monkeypatch.setattr(gemini_scheduler, "get_gemini_scheduler", lambda: scheduler)
+
+    class Model:
+        async def generate_content_async(self, contents, stream=False):
+            raise AssertionError("called without quota")
+
+    with pytest.raises(QuotaWaitTimeout):
+        asyncio.run(generate_content(Model(), "hello"))
+    assert resilience.get_circuit_breaker("gemini").stats()["calls"] == 0
@@ -0,0 +1,89 @@
+import asyncio
+import gzip
+import threading
+
+import pytest
+
+import responses
+from responses import CompressionMiddleware, _choose_encoding
+
+def make_app(body, headers=()):
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json"), *headers]})
+        await send({"type": "http.response.body", "body": body})
+    return app
+
+def call(middleware, accept_encoding=b"gzip"):
+    messages = []
+
+    async def receive():
+        return {"type": "http.request"}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "headers": [(b"accept-encoding", accept_encoding)]}
+    asyncio.run(middleware(scope, receive, send))
+    start, body = messages
+    return [(name.lower(), value) for name, value in start["headers"]], body["body"]
+
+def test_existing_vary_header_is_merged():
+    app = make_app(b"x" * 2000, [(b"vary", b"Origin")])
+
+    headers, body = call(CompressionMiddleware(app, minimum_size=1000))
+
+    assert [value for name, value in headers if name == b"vary"] == [b"Origin, Accept-Encoding"]
+    assert gzip.decompress(body) == b"x" * 2000
+
+def test_vary_header_is_added_once():
+    for vary in ([], [(b"vary", b"accept-encoding")]):
+        headers, _ = call(CompressionMiddleware(make_app(b"x" * 2000, vary), minimum_size=1000))
+        assert len([name for name, _ in headers if name == b"vary"]) == 1
+
+def test_large_bodies_are_compressed_off_the_event_loop(monkeypatch):
+    threads = []
+    compress = responses.compress
+
+    def recording_compress(body, encoding):
+        threads.append(threading.get_ident())
+        return compress(body, encoding)
+
+    monkeypatch.setattr(responses, "compress", recording_compress)
+    loop_thread = threading.get_ident()
+
+    call(CompressionMiddleware(make_app(b"x" * 2000), minimum_size=1000, thread_min_size=4000))
+    call(CompressionMiddleware(make_app(b"x" * 5000), minimum_size=1000, thread_min_size=4000))
+
+    assert threads[0] == loop_thread
+    assert threads[1] != loop_thread
+
+@pytest.mark.parametrize("accept_encoding, expected", [
+    ("gzip", "gzip"),
+    ("br, gzip", "br"),
+    ("br;q=0.5, gzip;q=0.8", "gzip"),
+    ("br;q=0, gzip", "gzip"),
+    ("gzip;q=0", None),
+    ("GZIP; Q=0.3", "gzip"),
+    ("*", "br"),
+    ("*;q=0.5, br;q=0", "gzip"),
+    ("gzip;q=0.5, identity", None),
+    ("identity;q=0, gzip;q=0.1", "gzip"),
+    ("*;q=0", None),
+    ("", None),
+])
+def test_encoding_follows_q_values(monkeypatch, accept_encoding, expected):
+    monkeypatch.setattr(responses, "brotli", object())
+
+    assert _choose_encoding(accept_encoding) == expected
+
+def test_brotli_is_skipped_when_unavailable(monkeypatch):
+    monkeypatch.setattr(responses, "brotli", None)
+
+    assert _choose_encoding("br, gzip;q=0.5") == "gzip"
+    assert _choose_encoding("br") is None
+
+def test_refused_encoding_is_not_used():
+    headers, body = call(CompressionMiddleware(make_app(b"x" * 2000), minimum_size=1000), accept_encoding=b"gzip;q=0")
+
+    assert b"content-encoding" not in dict(headers)
+    assert body == b"x" * 2000
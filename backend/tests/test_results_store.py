@@ -0,0 +1,59 @@
+import threading
+
+import pytest
+
+import results_store
+from results_store import ResultStore
+
+@pytest.fixture
+def store(tmp_path):
+    store = ResultStore(path=str(tmp_path / "results.sqlite3"))
+    yield store
+    store.close()
+
+@pytest.fixture
+def slow_inserts(store, monkeypatch):
+    """
+    Hold every insert until the returned event is set.
+    """
+    release = threading.Event()
+    insert = store._insert
+
+    def held_insert(*item):
+        release.wait(5)
+        insert(*item)
+
+    monkeypatch.setattr(store, "_insert", held_insert)
+    return release
+
+def read_in_thread(read, *args):
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(value=read(*args)))
+    thread.start()
+    return thread, result
+
+def test_read_right_after_write_sees_the_run(store, slow_inserts):
+    run_id = store.write("Foodie", {"analysis": "likes ramen"})
+    thread, result = read_in_thread(store.get_run, run_id)
+    thread.join(0.1)
+    assert thread.is_alive()
+
+    slow_inserts.set()
+    thread.join(5)
+    assert result["value"]["data"] == {"analysis": "likes ramen"}
+    assert store.latest("foodie")["run_id"] == run_id
+    assert store._pending == {}
+
+def test_read_doesnt_wait_for_other_users_writes(store, slow_inserts):
+    store.write("someone_else", {"analysis": "likes tacos"})
+
+    assert store.latest("foodie") is None
+    slow_inserts.set()
+
+def test_failed_write_is_counted_and_doesnt_block_reads(store, monkeypatch):
+    monkeypatch.setattr(results_store, "_serialize", lambda data: 1 / 0)
+
+    run_id = store.write("foodie", {"analysis": "likes ramen"})
+
+    assert store.get_run(run_id) is None
+    assert store.stats()["write_errors"] == 1
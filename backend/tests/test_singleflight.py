@@ -0,0 +1,26 @@
+import asyncio
+
+from metrics import render_metrics
+from singleflight import SingleFlight
+
+def metric_value(name, group):
+    prefix = f'{name}{{group="{group}"}} '
+    return next(float(line[len(prefix):]) for line in render_metrics().splitlines() if line.startswith(prefix))
+
+def test_coalesced_calls_share_one_run_and_are_exported():
+    flight = SingleFlight("test_export")
+    runs = []
+
+    async def work():
+        runs.append(1)
+        await asyncio.sleep(0.01)
+        return "done"
+
+    async def run():
+        return await asyncio.gather(*(flight.do("foodie", work) for _ in range(3)))
+
+    assert asyncio.run(run()) == ["done"] * 3
+    assert len(runs) == 1
+    assert flight.stats() == {"calls": 3, "executions": 1, "coalesced": 2, "inflight": 0}
+    assert metric_value("singleflight_executions_total", "test_export") == 1
+    assert metric_value("singleflight_coalesced_total", "test_export") == 2
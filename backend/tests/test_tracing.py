@@ -0,0 +1,92 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import gemini_scheduler
+import restaurant_recommendations
+import tracing
+from restaurant_recommendations import stream_restaurant_recommendations
+from stage_limits import StageLimits, reset_stage_limits, stage_slot, use_stage_limits
+from tracing import OpenSpan, span, start_trace
+
+class FakeLLMCache:
+    async def aget(self, key):
+        return None
+
+    async def aput(self, key, value, kind, version):
+        pass
+
+@pytest.fixture
+def gemini_stream(monkeypatch):
+    async def generate_content(model, contents, stream=False):
+        with span("gemini_queue"):
+            await asyncio.sleep(0)
+
+        async def chunks():
+            for text in ('[{"restaurant_name": "A"},', ' {"restaurant_name": "B"},', ' {"restaurant_name": "C"}]'):
+                await asyncio.sleep(0)
+                yield SimpleNamespace(text=text)
+        return chunks()
+
+    monkeypatch.setattr(restaurant_recommendations, "get_llm_cache", lambda: FakeLLMCache())
+    monkeypatch.setattr(restaurant_recommendations, "get_gemini_model", lambda name: None)
+    monkeypatch.setattr(gemini_scheduler, "generate_content", generate_content)
+
+def test_stream_does_not_leak_its_span_to_the_consumer(gemini_stream):
+    async def run():
+        with start_trace("test") as trace:
+            seen = []
+            async for recommendation in stream_restaurant_recommendations("likes ramen"):
+                seen.append((recommendation["restaurant_name"], tracing._current_span.get()))
+        return trace, seen
+
+    trace, seen = asyncio.run(run())
+
+    assert seen == [("A", None), ("B", None), ("C", None)]
+    spans = {span["name"]: span for span in trace.spans}
+    assert spans["gemini_queue"]["parent"] == spans["recommendations"]["id"]
+
+def test_abandoned_stream_can_be_closed_from_another_context(gemini_stream):
+    async def run():
+        with start_trace("test") as trace:
+            stream = stream_restaurant_recommendations("likes ramen")
+            assert (await stream.__anext__())["restaurant_name"] == "A"
+        # Closed from a different task, as the event loop's async generator
+        # finalizer does with a stream its consumer dropped
+        await asyncio.create_task(stream.aclose())
+        return trace
+
+    trace = asyncio.run(run())
+
+    assert [span["name"] for span in trace.spans].count("recommendations") == 1
+
+def test_paused_stream_releases_the_gemini_slot_once_drained(gemini_stream):
+    async def run():
+        token = use_stage_limits(StageLimits({"gemini": 1}))
+        try:
+            stream = stream_restaurant_recommendations("likes ramen")
+            assert (await stream.__anext__())["restaurant_name"] == "A"
+            # The consumer is paused on the first item; the reader task finishes draining meanwhile
+            async with stage_slot("gemini"):
+                pass
+            await stream.aclose()
+        finally:
+            reset_stage_limits(token)
+
+    asyncio.run(asyncio.wait_for(run(), 2))
+
+def test_open_span_records_errors_once():
+    with start_trace("test") as trace:
+        opened = OpenSpan("work", size=3)
+        opened.end(ValueError("bad input"))
+        opened.end()
+
+    assert len(trace.spans) == 1
+    assert trace.spans[0]["attrs"] == {"size": 3, "error": "bad input"}
+
+def test_open_span_outside_a_trace_is_a_no_op():
+    opened = OpenSpan("work")
+    with opened.active():
+        assert tracing._current_span.get() is None
+    opened.end()
@@ -0,0 +1,282 @@
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+# Append finished request traces here in Chrome trace-event format (open in
+# chrome://tracing or ui.perfetto.dev); unset to disable
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH")
+
+_export_lock = threading.Lock()
+
+class Trace:
+    """
+    Timed spans recorded while handling one request or job.
+
+    Spans nest through a context variable, so stages running in child
+    tasks and worker threads are attributed to the right parent.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._lanes: Dict[int, int] = {}
+        self._lane_count = 0
+        self.spans: List[Dict[str, Any]] = []
+
+    def _lane(self) -> int:
+        # One lane per task / thread so concurrent spans don't overlap in a trace viewer
+        try:
+            owner = id(asyncio.current_task())
+        except RuntimeError:
+            owner = threading.get_ident()
+        with self._lock:
+            if owner not in self._lanes:
+                self._lanes[owner] = self._lane_count
+                self._lane_count += 1
+            return self._lanes[owner]
+
+    def _record(self, span_id: int, parent: Optional[int], name: str, started: float, ended: float, lane: int, attrs: Dict[str, Any]) -> None:
+        with self._lock:
+            self.spans.append({
+                "id": span_id,
+                "parent": parent,
+                "name": name,
+                "start_ms": round((started - self._started) * 1000, 3),
+                "duration_ms": round((ended - started) * 1000, 3),
+                "lane": lane,
+                "attrs": attrs,
+            })
+
+    def merge(self, timings: Optional[Dict[str, Any]]) -> None:
+        """
+        Add the spans of a trace recorded elsewhere (e.g. by a job worker),
+        placed on this trace's timeline by their wall-clock start.
+
+        Args:
+            timings: Result of the other trace's summary()
+        """
+        if not timings:
+            return
+        offset_ms = (timings["started_at"] - self.started_at) * 1000
+        with self._lock:
+            id_offset = max((span["id"] for span in self.spans), default=0)
+            lane_offset = self._lane_count
+            self._lane_count += timings["lanes"]
+            for span in timings["spans"]:
+                self.spans.append({
+                    **span,
+                    "id": span["id"] + id_offset,
+                    "parent": span["parent"] + id_offset if span["parent"] is not None else None,
+                    "start_ms": round(span["start_ms"] + offset_ms, 3),
+                    "lane": span["lane"] + lane_offset,
+                })
+
+    def stages(self) -> Dict[str, Dict[str, float]]:
+        """
+        Total time and call count per span name.
+        """
+        totals: Dict[str, Dict[str, float]] = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            entry = totals.setdefault(span["name"], {"count": 0, "total_ms": 0.0})
+            entry["count"] += 1
+            entry["total_ms"] = round(entry["total_ms"] + span["duration_ms"], 3)
+        return totals
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        JSON-serializable view of the trace, used for the timings block.
+        """
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span["start_ms"])
+            lanes = self._lane_count
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "total_ms": round((time.perf_counter() - self._started) * 1000, 3),
+            "lanes": lanes,
+            "stages": self.stages(),
+            "spans": spans,
+        }
+
+    def server_timing(self) -> str:
+        """
+        Server-Timing header value with the total time per stage.
+        """
+        entries = [
+            f'{name};dur={totals["total_ms"]:.1f};desc="{int(totals["count"])}x"'
+            for name, totals in self.stages().items()
+        ]
+        entries.append(f"total;dur={(time.perf_counter() - self._started) * 1000:.1f}")
+        return ", ".join(entries)
+
+    def chrome_events(self) -> List[Dict[str, Any]]:
+        """
+        Spans as Chrome trace "complete" events. Each trace is shown as its
+        own process, with the request on the first row and one row per lane.
+        """
+        base_us = self.started_at * 1_000_000
+        pid = int(self.trace_id[:7], 16)
+        with self._lock:
+            spans = list(self.spans)
+        events = [
+            {"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": f"{self.name} ({self.trace_id})"}},
+            {
+                "name": self.name,
+                "ph": "X",
+                "ts": base_us,
+                "dur": (time.perf_counter() - self._started) * 1_000_000,
+                "pid": pid,
+                "tid": 0,
+                "args": {"trace_id": self.trace_id},
+            },
+        ]
+        for span in spans:
+            events.append({
+                "name": span["name"],
+                "ph": "X",
+                "ts": base_us + span["start_ms"] * 1000,
+                "dur": span["duration_ms"] * 1000,
+                "pid": pid,
+                "tid": span["lane"] + 1,
+                "args": span["attrs"],
+            })
+        return events
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("trace", default=None)
+_current_span: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("trace_span", default=None)
+
+def current_trace() -> Optional[Trace]:
+    """
+    Return the trace being recorded in this context, if any.
+    """
+    return _current_trace.get()
+
+@contextmanager
+def start_trace(name: str) -> Iterator[Trace]:
+    """
+    Record spans opened in this context (and tasks started from it) into a new trace.
+
+    Args:
+        name: What is being traced, e.g. "GET /instagram/{username}/full-service"
+    """
+    trace = Trace(name)
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(None)
+    try:
+        yield trace
+    finally:
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Time a block as a span of the current trace. A no-op outside a trace.
+
+    Args:
+        name: Span name; spans with the same name are summed in Server-Timing
+        attrs: Attributes to attach; the yielded dict can be updated in the block
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield attrs
+        return
+    span_id = next(trace._ids)
+    parent = _current_span.get()
+    token = _current_span.set(span_id)
+    lane = trace._lane()
+    started = time.perf_counter()
+    try:
+        yield attrs
+    except Exception as e:
+        attrs["error"] = str(e) or type(e).__name__
+        raise
+    finally:
+        ended = time.perf_counter()
+        _current_span.reset(token)
+        trace._record(span_id, parent, name, started, ended, lane, attrs)
+
+class OpenSpan:
+    """
+    A span that is started when created and recorded by end(), for work
+    that is interleaved with the yields of an async generator. Unlike span()
+    it holds no context variable token, so it can be ended (or abandoned)
+    in whatever context the generator is finalized. A no-op outside a trace.
+    """
+
+    def __init__(self, name: str, **attrs: Any):
+        self.name = name
+        self.attrs = attrs
+        self._trace = _current_trace.get()
+        self._ended = self._trace is None
+        if self._trace is not None:
+            self._id = next(self._trace._ids)
+            self._parent = _current_span.get()
+            self._lane = self._trace._lane()
+            self._started = time.perf_counter()
+
+    @contextmanager
+    def active(self) -> Iterator[None]:
+        """
+        Make this the parent of spans opened in the block. The block must
+        not yield from a generator.
+        """
+        if self._trace is None:
+            yield
+            return
+        token = _current_span.set(self._id)
+        try:
+            yield
+        finally:
+            _current_span.reset(token)
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        """
+        Record the span; later calls do nothing.
+
+        Args:
+            error: Exception the work failed with, stored as the error attribute
+        """
+        if self._ended:
+            return
+        self._ended = True
+        if error is not None:
+            self.attrs["error"] = str(error) or type(error).__name__
+        self._trace._record(self._id, self._parent, self.name, self._started, time.perf_counter(), self._lane, self.attrs)
+
+def export_trace(trace: Trace, path: Optional[str] = None) -> None:
+    """
+    Append a trace to a Chrome trace-event file. The file is a JSON array
+    left open at the end, which the trace viewers accept.
+
+    Args:
+        trace: Finished trace
+        path: Output file, defaults to TRACE_EXPORT_PATH
+    """
+    path = path or TRACE_EXPORT_PATH
+    if not path:
+        return
+    lines = "".join(json.dumps(event) + ",\n" for event in trace.chrome_events())
+    with _export_lock:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        with open(path, "a", encoding="utf-8") as f:
+            if new_file:
+                f.write("[\n")
+            f.write(lines)